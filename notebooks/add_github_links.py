@@ -1,17 +1,37 @@
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from hashlib import md5
+import json
 import random
+import threading
 import time
 import os
 import re
+from urllib.parse import quote
 
 from github3 import login
 import nbformat as nbf
 
+from github_client import GitHubClient, GitHubError
 from link_fix import markdown_cells
 
 DEFAULT_COMMENT_GROUP = 'default-comment-group'
 
+# We'll make new branches off the initial commit to get a nice,
+# clean diff.
+FIRST_COMMIT = '6e20c1c2f5ef09206f02a5f5f67fcd818859a8c9'
+
+# Pull requests are made against this branch, which was also from the
+# first commit. Again, gives nice diffs.
+PR_BASE = 'for-making-comments'
+
+# Record of the branches and pull requests made for commenting, kept in the
+# directory of the original notebooks so a run that stops part way through
+# can pick up where it left off.
+COMMENT_RECORD = 'comment_prs.json'
+
 
 def github_magic(nb_file_for_book, original_notebook,
                  comment_group=DEFAULT_COMMENT_GROUP):
@@ -34,37 +54,62 @@ def github_magic(nb_file_for_book, original_notebook,
                                        highest_level=2,
                                        lowest_level=3)
 
+    book_nb = nbf.read(nb_file_for_book, as_version=4)
+    add_comment_links(book_nb, heading_in_original, base_url)
+    with open(nb_file_for_book, 'w') as fp:
+        nbf.write(book_nb, fp)
+
+
+def add_comment_links(notebook, headings, base_url):
+    """
+    Add a link for commenting after each heading in a notebook.
+
+    Parameters
+    ----------
+
+    notebook : ``nbformat.NotebookNode``
+        The notebook, which is changed in place.
+
+    headings : dict
+        Line number in the original notebook of each heading, as returned
+        by `find_headers`.
+
+    base_url : str
+        URL to which the line number is appended to make the link.
+    """
     comment_link_text = ('*Click here to comment on this section on '
                          'GitHub (opens in new tab).*')
 
     cell_content_to_insert = \
         {k: f'\n[{comment_link_text}]({base_url + str(v)})' +
              '{:target="_blank"}\n'
-            for k, v in heading_in_original.items()}
-
-    book_nb = nbf.read(nb_file_for_book, as_version=4)
+            for k, v in headings.items()}
 
-    for cell in markdown_cells(book_nb):
+    for cell in markdown_cells(notebook):
         for k, v in cell_content_to_insert.items():
-            if k in cell['source']:
+            # Leave alone headings that already have their link, so running
+            # this again doesn't add another.
+            if k in cell['source'] and k + v not in cell['source']:
                 pre, post = cell['source'].split(k)
                 new_source = pre + k + v + post
                 cell['source'] = new_source
-    with open(nb_file_for_book, 'w') as fp:
-        nbf.write(book_nb, fp)
 
 
-def get_github_repo(owner, repo):
-    """
-    Log in to github and retrieve a reference to the requested
-    repository.
-    """
+def _github_token():
     token = os.getenv('GITHUB_TOKEN')
 
     if not token:
         raise RuntimeError('Set GITHUB_TOKEN to a '
                            'github token before running.')
-    gh = login(token=token)
+    return token
+
+
+def get_github_repo(owner, repo):
+    """
+    Log in to github and retrieve a reference to the requested
+    repository.
+    """
+    gh = login(token=_github_token())
 
     return gh.repository(owner, repo)
 
@@ -105,23 +150,16 @@ def create_pr_for_commenting(original_nb, repo,
     label_color = md5(label_name.encode()).hexdigest()[:6]
     label_description = f'For commenting as part of {comment_group}'
 
-    # We'll make new branches off the initial commit to get a nice,
-    # clean diff.
-    first_commit = '6e20c1c2f5ef09206f02a5f5f67fcd818859a8c9'
-
-    # Pull requests are made against this branch, which was also from the
-    # first commit. Again, gives nice diffs.
-    pr_base = 'for-making-comments'
     branch_name = f'{comment_group}/{original_nb}'
     # 1. Add a branch for this file. Name is tag-file_name. <--- ORIG
-    _ = repo.create_branch_ref(branch_name, sha=first_commit)
+    _ = repo.create_branch_ref(branch_name, sha=FIRST_COMMIT)
     with open(original_nb, 'rb') as f:
         nb_content = f.read()
     file_name = f'notebooks/{original_nb}'
     commit_msg = f'Only for commenting, part of {comment_group}'
     repo.create_file(file_name, commit_msg, nb_content, branch=branch_name)
     pr_title = f'For commenting on {original_nb} (part of {comment_group})'
-    new_pr = repo.create_pull(pr_title, pr_base, branch_name)
+    new_pr = repo.create_pull(pr_title, PR_BASE, branch_name)
 
     # So labels get added to issues, not PRs...
     pr_issue = new_pr.issue()
@@ -149,25 +187,283 @@ def create_pr_for_commenting(original_nb, repo,
     return base_url_for_comment
 
 
+def ensure_label(client, owner, repo, comment_group):
+    """
+    Create the label ``comment_group``, or update its color and
+    description if it already exists.
+
+    Parameters
+    ----------
+
+    client : `github_client.GitHubClient`
+        Client used to talk to GitHub.
+
+    owner, repo : str
+        Owner and name of the repository.
+
+    comment_group : str
+        Name of the label.
+    """
+    # Same bling as in create_pr_for_commenting, but set once rather than
+    # for every pull request.
+    label = dict(name=comment_group,
+                 color=md5(comment_group.encode()).hexdigest()[:6],
+                 description=f'For commenting as part of {comment_group}')
+    try:
+        client.request('POST', f'/repos/{owner}/{repo}/labels', label)
+    except GitHubError as e:
+        # 422 means the label is already there.
+        if e.status != 422:
+            raise
+        client.request('PATCH', f'/repos/{owner}/{repo}/labels/'
+                                f'{quote(comment_group, safe="")}', label)
+
+
+def open_comment_pr(client, owner, repo, original_nb, comment_group,
+                    record, save):
+    """
+    Make the branch, file and labeled pull request for commenting on one
+    notebook, like `create_pr_for_commenting`, skipping whatever
+    ``record`` says has already been done.
+
+    Parameters
+    ----------
+
+    client : `github_client.GitHubClient`
+        Client used to talk to GitHub.
+
+    owner, repo : str
+        Owner and name of the repository.
+
+    original_nb : str or ``pathlib.Path``
+        The notebook for which the pull request is made.
+
+    comment_group : str
+        Label applied to the pull request, which is also the start of the
+        name of the branch.
+
+    record : dict
+        What has been done for this notebook so far.
+
+    save : callable
+        Called after each step with keyword arguments saying what was done,
+        which it is expected to add to ``record`` and save.
+
+    Returns
+    -------
+
+    str
+        URL to which the line number needs to be appended for a link directly
+        to this file/line in the github PR.
+    """
+    name = Path(original_nb).name
+    repo_path = f'/repos/{owner}/{repo}'
+    branch_name = f'{comment_group}/{name}'
+    file_name = f'notebooks/{name}'
+
+    # For each step a 422 means it was done before, on a run that stopped
+    # before it could be recorded.
+    if not record.get('branch'):
+        try:
+            client.request('POST', f'{repo_path}/git/refs',
+                           dict(ref=f'refs/heads/{branch_name}',
+                                sha=FIRST_COMMIT))
+        except GitHubError as e:
+            if e.status != 422:
+                raise
+        save(branch=branch_name)
+
+    if not record.get('file'):
+        with open(original_nb, 'rb') as f:
+            nb_content = f.read()
+        try:
+            client.request(
+                'PUT', f'{repo_path}/contents/{quote(file_name)}',
+                dict(message=f'Only for commenting, part of {comment_group}',
+                     content=b64encode(nb_content).decode(),
+                     branch=branch_name))
+        except GitHubError as e:
+            if e.status != 422:
+                raise
+        save(file=file_name)
+
+    if not record.get('pr'):
+        pr_title = f'For commenting on {name} (part of {comment_group})'
+        try:
+            pr = client.request('POST', f'{repo_path}/pulls',
+                                dict(title=pr_title, head=branch_name,
+                                     base=PR_BASE))
+        except GitHubError as e:
+            if e.status != 422:
+                raise
+            # The pull request was made before; it may have been closed
+            # since, so look at all of them, newest first.
+            found = client.request('GET', f'{repo_path}/pulls',
+                                   params=dict(head=f'{owner}:{branch_name}',
+                                               state='all'))
+            if not found:
+                raise RuntimeError(f'Could not open a pull request for '
+                                   f'{branch_name} ({e}) and there is no '
+                                   f'existing one.')
+            pr = found[0]
+        save(pr=pr['number'], html_url=pr['html_url'])
+
+    if not record.get('labeled'):
+        # So labels get added to issues, not PRs...
+        client.request('POST', f'{repo_path}/issues/{record["pr"]}/labels',
+                       dict(labels=[comment_group]))
+        save(labeled=True)
+
+    # The md5 has of the filename is part of the link for commenting, and
+    # the "R" is for the "right" side of the difference.
+    m = md5(file_name.encode())
+    return record['html_url'] + f'/files#diff-{m.hexdigest()}' + 'R'
+
+
 def commentify_all_notebooks(book_nb_path, original_nb_path,
-                             comment_group=DEFAULT_COMMENT_GROUP):
+                             comment_group=DEFAULT_COMMENT_GROUP,
+                             client=None, owner='astropy',
+                             repo='ccd-reduction-and-photometry-guide',
+                             max_workers=1, record_file=None):
     """
     Add comment-on-github links to each notebook in the book.
+
+    The pull requests are opened within GitHub's rate limits, and what has
+    been done is recorded in ``record_file`` so that running this again
+    only does what is left. The links are then added to the book notebooks
+    in one pass with `notebook_pipeline`, which leaves alone headings that
+    already have a link.
+
+    Parameters
+    ----------
+
+    book_nb_path : str
+        Directory of the notebooks for the book, to which links are added.
+
+    original_nb_path : str
+        Directory of the original notebooks.
+
+    comment_group : str, optional
+        Name of the label applied to the pull requests.
+
+    client : `github_client.GitHubClient`, optional
+        Client used to talk to GitHub; the default uses the token in
+        ``GITHUB_TOKEN``.
+
+    owner, repo : str, optional
+        Owner and name of the repository.
+
+    max_workers : int, optional
+        Number of notebooks for which pull requests are opened at once.
+        Requests that create things are still sent one at a time unless
+        the client allows more; see `github_client.GitHubClient`.
+
+    record_file : str, optional
+        Where to record the pull requests; the default is
+        ``comment_prs.json`` in ``original_nb_path``.
     """
+    # Imported here to avoid a circular import, since the pipeline imports
+    # this module for its comment_links step.
+    from notebook_pipeline import process_notebooks
+
     book_content_p = Path(book_nb_path)
     original_p = Path(original_nb_path)
 
-    to_comment = [b for b in book_content_p.glob('??-??-*.ipynb')]
+    to_comment = sorted(book_content_p.glob('??-??-*.ipynb'))
     originals = [original_p / book.name for book in to_comment]
 
     if not all(o.exists() for o in originals):
         raise RuntimeError('One of the files does not exist in originals')
 
-    for book, original in zip(to_comment, originals):
-        print(f'on {book.name}')
-        github_magic(str(book), str(original), comment_group=comment_group)
-        # Don't be greedy
-        time.sleep(1)
+    if client is None:
+        client = GitHubClient(token=_github_token())
+    if record_file is None:
+        record_file = original_p / COMMENT_RECORD
+
+    try:
+        with open(record_file) as f:
+            all_records = json.load(f)
+    except FileNotFoundError:
+        all_records = {}
+    records = all_records.setdefault(comment_group, {})
+    lock = threading.Lock()
+
+    def recorder(name):
+        def save(**done):
+            # Threads record their progress one at a time, so the file is
+            # never written while a record is being changed.
+            with lock:
+                records[name].update(done)
+                with open(record_file, 'w') as f:
+                    json.dump(all_records, f, indent=2, sort_keys=True)
+        return save
+
+    ensure_label(client, owner, repo, comment_group)
+
+    def open_pr(original):
+        with lock:
+            record = records.setdefault(original.name, {})
+        print(f'on {original.name}')
+        return open_comment_pr(client, owner, repo, original, comment_group,
+                               record, recorder(original.name))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        base_urls = dict(zip((o.name for o in originals),
+                             executor.map(open_pr, originals)))
+
+    process_notebooks(to_comment,
+                      [('comment_links',
+                        dict(base_urls=base_urls,
+                             original_dir=str(original_p)))])
+
+
+@lru_cache(maxsize=None)
+def _heading_pattern(highest_level, lowest_level):
+    # Generate the part of the regex pattern that represents the hashtags
+    # that are the beginning of a heading.
+    hashtags = []
+    for level in range(highest_level, lowest_level + 1):
+        hashtags.append('#' * level)
+
+    hashtags = '|'.join(hashtags)
+
+    return re.compile(r'(' + f'({hashtags})' + r' +[a-zA-Z].+?\n)')
+
+
+def heading_line_index(headings, lines):
+    """
+    Find the lines on which each of a set of headings appears, in one pass
+    over the lines.
+
+    Parameters
+    ----------
+
+    headings : iterable of str
+        Headings, each starting with ``#``.
+
+    lines : list of str
+        Lines to search.
+
+    Returns
+    -------
+
+    dict
+        The (zero-based) numbers of the lines that contain each heading.
+    """
+    found = {heading: [] for heading in headings}
+    lengths = sorted({len(heading) for heading in found})
+    for line_num, line in enumerate(lines):
+        # Every heading starts with #, so it can only be found where there
+        # is one.
+        position = line.find('#')
+        while position >= 0:
+            for length in lengths:
+                candidate = line[position:position + length]
+                if candidate in found and (not found[candidate] or
+                                           found[candidate][-1] != line_num):
+                    found[candidate].append(line_num)
+            position = line.find('#', position + 1)
+    return found
 
 
 def find_headers(notebook_name, highest_level=2, lowest_level=3):
@@ -200,34 +496,28 @@ def find_headers(notebook_name, highest_level=2, lowest_level=3):
     # seems to do the trick.
     line_number_offset = 1
 
-    # Generate the part of the regex pattern that represents the hashtags
-    # that are the beginning of a heading.
-    hashtags = []
-    for level in range(highest_level, lowest_level + 1):
-        hashtags.append('#' * level)
-
-    hashtags = '|'.join(hashtags)
+    header = _heading_pattern(highest_level, lowest_level)
 
-    header = re.compile(r'(' + f'({hashtags})' + r' +[a-zA-Z].+?\n)')
+    with open(notebook_name, 'r') as f:
+        nb_text = f.read()
 
-    notebook = nbf.read(notebook_name, as_version=4)
+    notebook = nbf.reads(nb_text, as_version=4)
     for cell in markdown_cells(notebook):
-        groups = [g for g in re.finditer(header, cell['source'])]
-        for g in groups:
+        for g in header.finditer(cell['source']):
             # We have a header, will get line numbers shortly
             headings[g.group(0)] = -1
 
-    with open(notebook_name, 'r') as f:
-        nb_lines = f.readlines()
+    line_index = heading_line_index({head[:-1] for head in headings},
+                                    nb_text.split('\n'))
 
     for head in headings.keys():
-        for line_num, line in enumerate(nb_lines):
-            if head[:-1] in line:
-                if headings[head] > 0:
-                    print(f'Oh no! Bad {notebook_name}')
-                    print(f'...duplicate heading: {head}')
-                    raise RuntimeError('oh no')
-                headings[head] = line_num + line_number_offset
+        line_nums = line_index[head[:-1]]
+        if len(line_nums) > 1:
+            print(f'Oh no! Bad {notebook_name}')
+            print(f'...duplicate heading: {head}')
+            raise RuntimeError('oh no')
+        if line_nums:
+            headings[head] = line_nums[0] + line_number_offset
 
     return headings
 
@@ -40,15 +40,32 @@ def add_cell_before(nbcells):
     return insert_before
 
 
-for nb_file in to_fix:
-    print(f"Examining {nb_file}")
-    with open(nb_file) as f:
-        notebook = nbf.read(f, as_version=4)
+def add_style_cell(notebook):
+    """
+    Insert the style cell into a notebook if it needs it.
+
+    Returns
+    -------
+
+    bool
+        ``True`` if the cell was inserted.
+    """
     insert_at = add_cell_before(notebook['cells'])
-    if insert_at is not None:
-        print(f"\tInserting style cell in {nb_file}")
-        notebook['cells'].insert(insert_at, style_cell)
-        with open(nb_file, 'w') as f:
-            nbf.write(notebook, f)
-    else:
-        print("\tNo insertion needed")
+    if insert_at is None:
+        return False
+    notebook['cells'].insert(insert_at,
+                             nbf.v4.new_code_cell(style_cell['source']))
+    return True
+
+
+if __name__ == '__main__':
+    for nb_file in to_fix:
+        print(f"Examining {nb_file}")
+        with open(nb_file) as f:
+            notebook = nbf.read(f, as_version=4)
+        if add_style_cell(notebook):
+            print(f"\tInserting style cell in {nb_file}")
+            with open(nb_file, 'w') as f:
+                nbf.write(notebook, f)
+        else:
+            print("\tNo insertion needed")
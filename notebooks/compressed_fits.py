@@ -0,0 +1,208 @@
+"""
+Write reduced images as tile-compressed FITS, and read them back.
+
+``CCDData.write`` stores a reduced image as uncompressed float64, 128 MB for
+a 4k x 4k frame. `write_reduced` can instead store the data as float32 in a
+RICE (or other) tile-compressed extension, which for sky-noise-limited data
+is several times smaller again. The data are quantized with a step that is
+a fraction of the noise (see ``quantize_level``); the mask and uncertainty
+are compressed without loss.
+
+The header goes in the primary HDU, which has no data, so
+``ccdp.ImageFileCollection`` still finds ``imagetyp``, ``exptime`` and the
+rest in the usual place. The image, mask and uncertainty are in extensions
+named ``SCI``, ``MASK`` and ``UNCERT``. `read_reduced` reads files written
+either way, and can read just a section of the image, in which case only
+the tiles that overlap it are decompressed.
+
+`write_reduced` is used by ``cosmic_rays.clean_file``,
+``frame_io.AsyncWriter`` and ``online_combine.OnlineCombiner.write``. The
+compression used when none is given is taken from the environment variable
+``CCD_GUIDE_COMPRESSION`` (e.g. ``RICE_1``); if it is not set files are
+written by ``CCDData.write`` exactly as before. Compression is opt-in
+because quantizing the image is lossy, and the notebooks compare their
+results with published values.
+"""
+import os
+
+import numpy as np
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.nddata import (InverseVariance, StdDevUncertainty,
+                            VarianceUncertainty)
+from astropy.wcs import WCS
+
+# Compression used by write_reduced when none is given.
+DEFAULT_COMPRESSION = os.getenv('CCD_GUIDE_COMPRESSION') or None
+
+# Uncertainty classes by the name stored in the UTYPE keyword, as CCDData
+# does.
+UNCERTAINTY_TYPES = {cls.__name__: cls for cls in
+                     (StdDevUncertainty, VarianceUncertainty,
+                      InverseVariance)}
+
+
+def to_compressed_hdulist(ccd, compression='RICE_1', quantize_level=16,
+                          dtype='float32', tile_shape=None):
+    """
+    ``HDUList`` with the image compressed and the mask and uncertainty
+    compressed losslessly.
+
+    Parameters
+    ----------
+
+    ccd : ``CCDData``
+        Reduced image.
+
+    compression : str, optional
+        Compression for the image, e.g. ``'RICE_1'``, ``'GZIP_2'`` or
+        ``'HCOMPRESS_1'``.
+
+    quantize_level : float, optional
+        Quantization step for the image, as a fraction of its noise; larger
+        is more faithful. 0 means no quantization, which only works with
+        the GZIP compressions.
+
+    dtype : str, optional
+        Type the image is stored as. The uncertainty keeps its own type.
+
+    tile_shape : tuple of int, optional
+        Shape of the compression tiles; the default is one row per tile.
+
+    Returns
+    -------
+
+    ``astropy.io.fits.HDUList``
+    """
+    header = fits.Header(ccd.meta)
+    image_header = fits.Header()
+    image_header['bunit'] = ccd.unit.to_string()
+    if ccd.wcs is not None:
+        image_header.extend(ccd.wcs.to_header(relax=True), update=True)
+
+    hdus = [fits.PrimaryHDU(header=header),
+            fits.CompImageHDU(np.asarray(ccd.data, dtype=dtype),
+                              header=image_header, name='SCI',
+                              compression_type=compression,
+                              quantize_level=quantize_level,
+                              tile_shape=tile_shape)]
+
+    if ccd.mask is not None:
+        # RICE is lossless for integers.
+        hdus.append(fits.CompImageHDU(ccd.mask.astype(np.uint8), name='MASK',
+                                      compression_type='RICE_1',
+                                      tile_shape=tile_shape))
+
+    if ccd.uncertainty is not None:
+        uncert_header = fits.Header()
+        uncert_header['utype'] = type(ccd.uncertainty).__name__
+        uncert_header['bunit'] = (ccd.uncertainty.unit or ccd.unit).to_string()
+        # Stored at its own precision, not dtype, so it comes back exactly.
+        hdus.append(fits.CompImageHDU(
+            np.asarray(ccd.uncertainty.array),
+            header=uncert_header, name='UNCERT', compression_type='GZIP_2',
+            quantize_level=0, tile_shape=tile_shape))
+
+    return fits.HDUList(hdus)
+
+
+def write_reduced(ccd, file_name, compression=DEFAULT_COMPRESSION,
+                  overwrite=False, **compression_kwargs):
+    """
+    Write a reduced image, compressed or not.
+
+    Parameters
+    ----------
+
+    ccd : ``CCDData``
+        The image.
+
+    file_name : str
+        Where to write it.
+
+    compression : str or None, optional
+        Compression for the image; see `to_compressed_hdulist`. If ``None``
+        the image is written with ``CCDData.write``.
+
+    overwrite : bool, optional
+        If ``True``, overwrite an existing file.
+
+    compression_kwargs
+        Passed to `to_compressed_hdulist`, e.g. ``quantize_level``.
+    """
+    if compression is None:
+        ccd.write(file_name, overwrite=overwrite)
+        return
+    hdul = to_compressed_hdulist(ccd, compression=compression,
+                                 **compression_kwargs)
+    hdul.writeto(file_name, overwrite=overwrite)
+
+
+def _read_section(hdu, section):
+    if section is None:
+        return hdu.data
+    # The section attribute decompresses only the tiles that are needed.
+    return hdu.section[section]
+
+
+def read_reduced(file_name, section=None, unit=None):
+    """
+    Read an image written by `write_reduced`, or any image ``CCDData`` reads.
+
+    Parameters
+    ----------
+
+    file_name : str
+        The file.
+
+    section : tuple of slice, optional
+        Part of the image to read, e.g.
+        ``(slice(1000, 1100), slice(2000, 2100))``.
+
+    unit : str or ``astropy.units.Unit``, optional
+        Unit of the data, if the file does not say.
+
+    Returns
+    -------
+
+    ``CCDData``
+    """
+    with fits.open(file_name) as hdul:
+        if 'SCI' not in hdul:
+            # CCDData.read lets unit override BUNIT; only pass it on if the
+            # header of the image (the first HDU with data, as CCDData.read
+            # picks) doesn't give one, as for SCI files below.
+            image = next((hdu for hdu in hdul
+                          if hdu.is_image and hdu.header.get('naxis')),
+                         hdul[0])
+            if 'bunit' in image.header:
+                unit = None
+            ccd = CCDData.read(file_name, unit=unit)
+            return ccd if section is None else ccd[section]
+
+        sci = hdul['SCI']
+        data = np.array(_read_section(sci, section))
+        unit = u.Unit(sci.header.get('bunit', unit or 'adu'))
+
+        mask = None
+        if 'MASK' in hdul:
+            mask = np.array(_read_section(hdul['MASK'], section)) > 0
+
+        uncertainty = None
+        if 'UNCERT' in hdul:
+            uncert = hdul['UNCERT']
+            uncertainty_type = UNCERTAINTY_TYPES[uncert.header['utype']]
+            uncertainty = uncertainty_type(
+                np.array(_read_section(uncert, section)),
+                unit=u.Unit(uncert.header.get('bunit', unit)))
+
+        wcs = None
+        if 'ctype1' in sci.header:
+            wcs = WCS(sci.header)
+            if section is not None:
+                wcs = wcs.slice(section)
+
+        return CCDData(data, unit=unit, mask=mask, uncertainty=uncertainty,
+                       wcs=wcs, meta=hdul[0].header.copy())
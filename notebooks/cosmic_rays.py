@@ -0,0 +1,207 @@
+"""
+Cosmic ray removal in parallel, over many frames or over tiles of one frame.
+
+``ccdp.cosmicray_lacosmic`` runs on one frame at a time and a single 4k frame
+takes a while. `clean_collection` cleans the frames of a collection in a
+process pool, and `tiled_lacosmic` splits one large frame into overlapping
+tiles that are cleaned in parallel and stitched back together. In both cases
+the bad pixel mask (e.g. the combined dark current and ``ccdmask`` mask from
+the masking notebooks) is used to pre-mask the image and is included in the
+final mask.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import ccdproc as ccdp
+
+from compressed_fits import read_reduced, write_reduced
+from tiling import overlapping_tiles
+
+# LA Cosmic uses median filters up to 7 pixels wide and grows detections by a
+# pixel on each iteration, so with the default four iterations nothing more
+# than about a dozen pixels away affects a pixel. This leaves some margin.
+DEFAULT_OVERLAP = 32
+
+
+def _clean_tile(tile_ccd, lacosmic_kwargs):
+    return ccdp.cosmicray_lacosmic(tile_ccd, **lacosmic_kwargs)
+
+
+def _with_mask(ccd, bad_pixel_mask):
+    """
+    Copy of ccd with ``bad_pixel_mask`` ORed into its mask.
+    """
+    ccd = ccd.copy()
+    if bad_pixel_mask is not None:
+        bad_pixel_mask = np.asarray(bad_pixel_mask, dtype=bool)
+        if ccd.mask is None:
+            ccd.mask = bad_pixel_mask.copy()
+        else:
+            ccd.mask = ccd.mask | bad_pixel_mask
+    return ccd
+
+
+def tiled_lacosmic(ccd, bad_pixel_mask=None, tile_size=1024,
+                   overlap=DEFAULT_OVERLAP, max_workers=None,
+                   **lacosmic_kwargs):
+    """
+    Run ``ccdp.cosmicray_lacosmic`` on overlapping tiles of an image in
+    parallel.
+
+    Parameters
+    ----------
+
+    ccd : ``CCDData``
+        The image to clean.
+
+    bad_pixel_mask : numpy array, optional
+        Known bad pixels. They are masked before looking for cosmic rays and
+        are included in the mask of the result.
+
+    tile_size : int, optional
+        Size of each tile, not counting the overlap.
+
+    overlap : int, optional
+        Padding added to each side of a tile.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    lacosmic_kwargs
+        Passed on to ``ccdp.cosmicray_lacosmic``.
+
+    Returns
+    -------
+
+    ``CCDData``
+        The cleaned image, with a mask that includes the cosmic rays, the
+        original mask and ``bad_pixel_mask``. The uncertainty is kept unless
+        the gain was applied, which changes the units of the data.
+    """
+    ccd = _with_mask(ccd, bad_pixel_mask)
+    tiles = overlapping_tiles(ccd.shape, tile_size, overlap)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_clean_tile, ccd[tile.padded],
+                                   lacosmic_kwargs)
+                   for tile in tiles]
+
+        result = None
+        for tile, future in zip(tiles, futures):
+            cleaned = future.result()
+            if result is None:
+                # The units may change if the gain is applied, so wait to
+                # make the result until the first tile is back.
+                result = ccd.copy()
+                result.unit = cleaned.unit
+                result.data = np.empty(ccd.shape, dtype=cleaned.data.dtype)
+                result.mask = np.empty(ccd.shape, dtype=bool)
+            # Only the core of each tile is kept, so pixels near tile edges
+            # were cleaned with their full neighborhood available.
+            result.data[tile.core] = cleaned.data[tile.core_in_padded]
+            result.mask[tile.core] = cleaned.mask[tile.core_in_padded]
+
+    if result.unit != ccd.unit:
+        # The gain was applied to the tiles, so the uncertainty, which is
+        # still in the original units, no longer matches the data.
+        result.uncertainty = None
+    return result
+
+
+def clean_file(file_name, bad_pixel_mask=None, output_dir=None,
+               overwrite=True, **lacosmic_kwargs):
+    """
+    Clean the cosmic rays from one file and write the result.
+
+    Parameters
+    ----------
+
+    file_name : str or ``pathlib.Path``
+        The file to clean.
+
+    bad_pixel_mask : numpy array, optional
+        Known bad pixels; see `tiled_lacosmic`.
+
+    output_dir : str or ``pathlib.Path``, optional
+        Directory in which to write the result. The default is to overwrite
+        the input file, as in the masking notebooks.
+
+    overwrite : bool, optional
+        If ``True``, overwrite an existing result.
+
+    lacosmic_kwargs
+        Passed on to ``ccdp.cosmicray_lacosmic``.
+
+    Returns
+    -------
+
+    tuple
+        The name of the file written and the number of pixels in its mask.
+    """
+    file_name = Path(file_name)
+    ccd = read_reduced(file_name)
+    masked = _with_mask(ccd, bad_pixel_mask)
+    cleaned = ccdp.cosmicray_lacosmic(masked, **lacosmic_kwargs)
+
+    # Keep the original data, like the guide does; only the mask changes.
+    ccd.mask = cleaned.mask
+
+    if output_dir is None:
+        destination = file_name
+    else:
+        destination = Path(output_dir) / file_name.name
+    write_reduced(ccd, destination, overwrite=overwrite)
+    return str(destination), int(ccd.mask.sum())
+
+
+def clean_collection(ifc, bad_pixel_mask=None, output_dir=None,
+                     max_workers=None, imagetyp='light', **lacosmic_kwargs):
+    """
+    Clean cosmic rays from the frames in a collection, in parallel.
+
+    Parameters
+    ----------
+
+    ifc : ``ccdp.ImageFileCollection``
+        Collection of calibrated images.
+
+    bad_pixel_mask : numpy array, optional
+        Known bad pixels; see `tiled_lacosmic`.
+
+    output_dir : str or ``pathlib.Path``, optional
+        Directory in which to write the results; by default the input files
+        are overwritten.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    imagetyp : str, optional
+        Only images of this type are cleaned.
+
+    lacosmic_kwargs
+        Passed on to ``ccdp.cosmicray_lacosmic``.
+
+    Returns
+    -------
+
+    dict
+        Number of masked pixels in each file written, keyed by file name.
+    """
+    files = ifc.files_filtered(imagetyp=imagetyp, include_path=True)
+    if bad_pixel_mask is not None:
+        bad_pixel_mask = np.asarray(bad_pixel_mask, dtype=bool)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(clean_file, name, bad_pixel_mask,
+                                   output_dir, **lacosmic_kwargs)
+                   for name in files]
+        for future in futures:
+            name, n_masked = future.result()
+            results[name] = n_masked
+
+    return results
@@ -1,21 +1,25 @@
+"""
+Download the data used in the notebooks.
+
+Run this as a script in the notebooks directory. The files are fetched in
+parallel and verified with `fetch_data`, which keeps a cache of everything
+it has downloaded, so running this again, or in a fresh copy of the
+repository, only downloads what is missing.
+"""
+import argparse
 from pathlib import Path
-import shutil
-import tarfile
 
-from astropy.utils.data import download_file
+from fetch_data import (DATA_FILES, ZENODO, fetch, fetch_all,
+                        fetch_and_extract, transcode_all)
 
-def move(p : Path, dest : str):
-    try:
-        p.rename(dest)
-    except OSError:
-        shutil.move(p, dest)
+# Compression used for each choice of --transcode.
+TRANSCODE_OPTIONS = {'plain': None, 'rice': 'RICE_1'}
 
-    return Path(dest).exists()
 
-
-def get_data(record : str, file_name : str, unzip=False):
+def get_data(record, file_name, unzip=False, base_url=ZENODO,
+             cache_dir=None):
     """
-    Get a blob from Zenodo and either move it or unzip it.
+    Get a blob from Zenodo and either put it here or unzip it.
 
     Parameters
     ----------
@@ -25,64 +29,41 @@ def get_data(record : str, file_name : str, unzip=False):
     file_name : str
         The file name to download.
 
-    """
-    url = f'https://zenodo.org/record/{record}/files/{file_name}?download=1'
-    print(f"\nDownloading {file_name}")
-    download = download_file(url, show_progress=True)
-    p = Path(download)
-    if p.exists():
-        print(f"File {p} successfully downloaded.")
-    else:
-        raise RuntimeError(f"File {p} not downloaded.")
+    unzip : bool, optional
+        If ``True`` the file is a tarball that is extracted here.
 
+    base_url, cache_dir
+        See `fetch_data.fetch`.
+    """
     if unzip:
-        print(f"Unzipping {file_name}")
-        tarball = tarfile.open(download)
-        tarball.extractall('.')
-        dir_name = file_name.split('.')[0]
-        p = Path(dir_name)
-        if p.exists():
-            print(f"File {p} successfully unzipped.")
-        else:
-            raise RuntimeError(f"File {p} not unzipped.")
+        fetch_and_extract(record, file_name, base_url=base_url,
+                          cache_dir=cache_dir)
     else:
-        moved = move(p, f'./{file_name}')
-        if not moved:
-            raise RuntimeError(f"File {file_name} not moved.")
-        else:
-            print(f"File {file_name} successfully moved.")
-
-
-# Get single images
-file_name = 'combined_bias_100_images.fit.bz2'
-record = 3320113
-get_data(record, file_name, unzip=False)
-
-# raise RuntimeError("This is a test error to see if the notebook stops running.")
-
-file_name = 'dark-test-0002d1000.fit.bz2'
-record = 3312535
-get_data(record, file_name, unzip=False)
-
-file_name = "single_bias_thermoelectric.fit.bz2"
-record = 5931364
-get_data(record, file_name, unzip=False)
-
-file_name = "combined_dark_300.000.fits.bz2"
-record = 3332818
-get_data(record, file_name, unzip=False)
-
-file_name = "combined_dark_exposure_1000.0.fit.bz2"
-record = 4302262
-get_data(record, file_name, unzip=False)
-
-# Get the tarball for the smaller example and extract it
-file_name = "example-cryo-LFC.tar.bz2"
-record = 3254683
-get_data(record, file_name, unzip=True)
-
-
-# Get the tarball for the bigger example and extract it
-file_name = "example-thermo-electric.tar.bz2"
-record = 3245296
-get_data(record, file_name, unzip=True)
+        fetch(record, file_name, base_url=base_url, cache_dir=cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--base-url', default=ZENODO,
+                        help='Zenodo or a mirror of it, e.g. a file:// URL')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory in which downloads are cached')
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help='Number of files to download at once')
+    parser.add_argument('--transcode', choices=TRANSCODE_OPTIONS,
+                        default=None,
+                        help='Also write each .bz2 FITS file as plain or '
+                             'RICE tile-compressed FITS')
+    args = parser.parse_args()
+
+    fetch_all(DATA_FILES, base_url=args.base_url, cache_dir=args.cache_dir,
+              max_workers=args.max_workers)
+
+    if args.transcode:
+        singles = [name for _, name, unzip in DATA_FILES if not unzip]
+        extracted = [name.split('.')[0] for _, name, unzip in DATA_FILES
+                     if unzip]
+        files = singles + [str(path) for directory in extracted
+                           for path in Path(directory).rglob('*.fit*.bz2')]
+        transcode_all(files,
+                      compression=TRANSCODE_OPTIONS[args.transcode])
@@ -0,0 +1,271 @@
+"""
+A stand-in for the parts of the GitHub API that ``add_github_links`` uses.
+
+`FakeGitHub` runs a small HTTP server on localhost in a background thread
+and keeps branches, files, pull requests and labels in memory, so the
+commenting code can be run end to end without a token or a real
+repository::
+
+    with FakeGitHub(rate_limit=50, max_concurrent=2) as github:
+        client = GitHubClient(api_url=github.url, secondary_wait=0.1)
+        commentify_all_notebooks('book', 'originals', client=client)
+        print(len(github.pulls), github.max_in_flight)
+
+It imposes a primary rate limit (``rate_limit`` requests per ``window``
+seconds, with the usual ``X-RateLimit-*`` headers) and, like GitHub's
+secondary limits, refuses requests when more than ``max_concurrent`` are in
+flight, with or without a ``Retry-After`` header.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+
+# (method, path pattern, name of the FakeGitHub method that handles it)
+ROUTES = [
+    ('POST', r'/repos/[^/]+/[^/]+/git/refs', '_create_ref'),
+    ('PUT', r'/repos/[^/]+/[^/]+/contents/(?P<path>.+)', '_create_file'),
+    ('POST', r'/repos/[^/]+/[^/]+/pulls', '_create_pull'),
+    ('GET', r'/repos/[^/]+/[^/]+/pulls', '_list_pulls'),
+    ('POST', r'/repos/[^/]+/[^/]+/labels', '_create_label'),
+    ('PATCH', r'/repos/[^/]+/[^/]+/labels/(?P<name>[^/]+)', '_update_label'),
+    ('POST', r'/repos/[^/]+/[^/]+/issues/(?P<number>\d+)/labels',
+     '_add_labels'),
+]
+
+
+class FakeGitHub:
+    """
+    In-memory GitHub API server for trying out the commenting code.
+
+    Parameters
+    ----------
+
+    rate_limit : int, optional
+        Requests allowed per ``window``.
+
+    window : float, optional
+        Length, in seconds, of the rate limit window.
+
+    max_concurrent : int or None, optional
+        Requests allowed in flight at once; more are refused with a 403.
+        ``None`` means no limit.
+
+    retry_after : bool, optional
+        If ``True``, requests refused because too many were in flight say
+        when to try again with ``Retry-After``; if ``False`` they don't, as
+        GitHub's secondary rate limits often don't either.
+
+    latency : float, optional
+        Seconds each request takes.
+
+    Attributes
+    ----------
+
+    refs, files, pulls, labels : dict
+        What has been created, keyed by branch, path, number and name.
+
+    requests : list
+        Method and path of each request that was handled.
+
+    refused : int
+        Number of requests refused because of a rate limit.
+
+    max_in_flight : int
+        Most requests that were being handled at once.
+
+    max_writes_in_flight : int
+        Most requests other than ``GET`` that were being handled at once.
+    """
+    def __init__(self, rate_limit=5000, window=3600, max_concurrent=None,
+                 retry_after=True, latency=0.01, port=0):
+        self.rate_limit = rate_limit
+        self.window = window
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.latency = latency
+        self.refs = {}
+        self.files = {}
+        self.pulls = {}
+        self.labels = {}
+        self.requests = []
+        self.refused = 0
+        self.max_in_flight = 0
+        self.max_writes_in_flight = 0
+        self._in_flight = 0
+        self._writes_in_flight = 0
+        self._used = 0
+        self._reset = time.time() + window
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port),
+                                           self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                fake._dispatch(self)
+
+            do_GET = do_POST = do_PUT = do_PATCH = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _rate_limit_headers(self):
+        return {'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(self.rate_limit - self._used),
+                'X-RateLimit-Reset': str(int(self._reset + 0.999))}
+
+    def _admit(self, write):
+        # Status, message and headers for a refused request, or None if it
+        # can go ahead.
+        with self._lock:
+            now = time.time()
+            if now >= self._reset:
+                self._used = 0
+                self._reset = now + self.window
+            if self._used >= self.rate_limit:
+                self.refused += 1
+                return (403, 'API rate limit exceeded',
+                        self._rate_limit_headers())
+            if (self.max_concurrent is not None and
+                    self._in_flight >= self.max_concurrent):
+                self.refused += 1
+                headers = self._rate_limit_headers()
+                if self.retry_after:
+                    headers['Retry-After'] = '1'
+                return (403, 'You have exceeded a secondary rate limit.',
+                        headers)
+            self._used += 1
+            self._in_flight += 1
+            self._writes_in_flight += write
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+            self.max_writes_in_flight = max(self.max_writes_in_flight,
+                                            self._writes_in_flight)
+            return None
+
+    def _dispatch(self, handler):
+        write = handler.command != 'GET'
+        refusal = self._admit(write)
+        if refusal is not None:
+            status, message, headers = refusal
+            self._respond(handler, status, dict(message=message), headers)
+            return
+
+        try:
+            time.sleep(self.latency)
+            parsed = urlparse(handler.path)
+            length = int(handler.headers.get('Content-Length') or 0)
+            data = json.loads(handler.rfile.read(length)) if length else {}
+            for method, pattern, name in ROUTES:
+                match = re.fullmatch(pattern, parsed.path)
+                if method == handler.command and match:
+                    with self._lock:
+                        self.requests.append((method, parsed.path))
+                        status, body = getattr(self, name)(
+                            data, parse_qs(parsed.query),
+                            **{k: unquote(v)
+                               for k, v in match.groupdict().items()})
+                    break
+            else:
+                status, body = 404, dict(message='Not Found')
+            with self._lock:
+                headers = self._rate_limit_headers()
+            self._respond(handler, status, body, headers)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._writes_in_flight -= write
+
+    def _respond(self, handler, status, body, headers):
+        content = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def _create_ref(self, data, query):
+        branch = data['ref'].removeprefix('refs/heads/')
+        if branch in self.refs:
+            return 422, dict(message='Reference already exists')
+        self.refs[branch] = data['sha']
+        return 201, dict(ref=data['ref'], object=dict(sha=data['sha']))
+
+    def _create_file(self, data, query, path):
+        key = (data.get('branch'), path)
+        if key in self.files and 'sha' not in data:
+            return 422, dict(message='"sha" wasn\'t supplied.')
+        self.files[key] = data['content']
+        return 201, dict(content=dict(path=path))
+
+    def _create_pull(self, data, query):
+        if any(pull['head']['ref'] == data['head'] and
+               pull['state'] == 'open' for pull in self.pulls.values()):
+            return 422, dict(message='A pull request already exists')
+        number = len(self.pulls) + 1
+        pull = dict(number=number, title=data['title'], state='open',
+                    head=dict(ref=data['head']),
+                    base=dict(ref=data['base']),
+                    html_url=f'{self.url}/pull/{number}', labels=[])
+        self.pulls[number] = pull
+        return 201, pull
+
+    def _list_pulls(self, data, query):
+        pulls = list(self.pulls.values())
+        if 'head' in query:
+            branch = query['head'][0].split(':', 1)[-1]
+            pulls = [p for p in pulls if p['head']['ref'] == branch]
+        if 'state' in query and query['state'][0] != 'all':
+            pulls = [p for p in pulls if p['state'] == query['state'][0]]
+        return 200, pulls
+
+    def _create_label(self, data, query):
+        if data['name'] in self.labels:
+            return 422, dict(message='Validation Failed')
+        self.labels[data['name']] = data
+        return 201, data
+
+    def _update_label(self, data, query, name):
+        if name not in self.labels:
+            return 404, dict(message='Not Found')
+        self.labels[name].update(data)
+        return 200, self.labels[name]
+
+    def _add_labels(self, data, query, number):
+        pull = self.pulls.get(int(number))
+        if pull is None:
+            return 404, dict(message='Not Found')
+        for label in data['labels']:
+            if label not in pull['labels']:
+                pull['labels'].append(label)
+        return 200, [dict(name=label) for label in pull['labels']]
@@ -0,0 +1,558 @@
+"""
+Fetch the data files used in the guide from Zenodo.
+
+Files are downloaded in parallel, each to a partial file that is resumed
+with an HTTP range request if the connection drops. Every file is checked
+against the MD5 checksum Zenodo lists for it and then kept in a cache
+directory under its checksum, so setting up a fresh copy of the notebooks
+(or the CI cache being cleared) does not mean downloading everything again.
+Files that are already in place with the right checksum are skipped.
+Tarballs are extracted as they download, and the bzip2-compressed FITS
+files can be rewritten once as plain or tile-compressed FITS (`transcode`)
+so that the notebooks don't decompress them on every read.
+
+``base_url`` can point at a mirror with the same layout as Zenodo, either a
+local web server or a ``file://`` URL; `build_mirror` makes one from files
+on disk, which is handy for testing.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import md5
+from http.client import HTTPException, IncompleteRead
+import json
+import os
+from pathlib import Path
+import shutil
+import tarfile
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, url2pathname, urlopen
+
+from astropy.io import fits
+
+ZENODO = 'https://zenodo.org'
+
+# (record, file name, whether it is a tarball to extract) for each file the
+# notebooks need.
+DATA_FILES = [
+    (3320113, 'combined_bias_100_images.fit.bz2', False),
+    (3312535, 'dark-test-0002d1000.fit.bz2', False),
+    (5931364, 'single_bias_thermoelectric.fit.bz2', False),
+    (3332818, 'combined_dark_300.000.fits.bz2', False),
+    (4302262, 'combined_dark_exposure_1000.0.fit.bz2', False),
+    (3254683, 'example-cryo-LFC.tar.bz2', True),
+    (3245296, 'example-thermo-electric.tar.bz2', True),
+]
+
+# Downloads are read and hashed in chunks of this many bytes.
+CHUNK_SIZE = 2**20
+
+
+def default_cache_dir():
+    """
+    Cache directory: ``$CCD_GUIDE_DATA_CACHE`` if set, otherwise
+    ``~/.cache/ccd-guide-data``.
+    """
+    return Path(os.getenv('CCD_GUIDE_DATA_CACHE',
+                          Path.home() / '.cache' / 'ccd-guide-data'))
+
+
+def file_url(record, file_name, base_url=ZENODO):
+    url = f'{base_url}/record/{record}/files/{file_name}'
+    if urlparse(base_url).scheme in ('http', 'https'):
+        url += '?download=1'
+    return url
+
+
+def metadata_url(record, base_url=ZENODO):
+    return f'{base_url}/api/records/{record}'
+
+
+def md5_of(path):
+    """
+    MD5 hex digest of the content of a file.
+    """
+    digest = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _open(url, offset=0, timeout=60):
+    """
+    Open a URL, starting ``offset`` bytes in if possible.
+
+    Returns the response and whether it actually starts at ``offset``.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        f = open(url2pathname(parsed.path), 'rb')
+        f.seek(offset)
+        return f, True
+
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    response = urlopen(Request(url, headers=headers), timeout=timeout)
+    # A server that ignores the range sends the whole file with status 200.
+    return response, offset == 0 or response.status == 206
+
+
+def record_checksums(record, base_url=ZENODO):
+    """
+    MD5 checksum and size of each file in a Zenodo record.
+
+    Returns
+    -------
+
+    dict
+        ``{file name: (md5, size)}``; empty if the record metadata cannot be
+        fetched, in which case downloads are not verified.
+    """
+    try:
+        response, _ = _open(metadata_url(record, base_url=base_url))
+        with response:
+            metadata = json.load(response)
+    except (OSError, ValueError):
+        return {}
+
+    files = metadata.get('files', [])
+    # Newer versions of the API put the list under "entries".
+    if isinstance(files, dict):
+        files = files.get('entries', {}).values()
+    checksums = {}
+    for entry in files:
+        algorithm, _, value = entry.get('checksum', '').partition(':')
+        if algorithm == 'md5':
+            checksums[entry['key']] = (value, entry.get('size'))
+    return checksums
+
+
+def download(url, destination, retries=3):
+    """
+    Download a URL to a file, resuming an earlier partial download.
+
+    The data goes to ``destination`` with ``.part`` added to its name until
+    it is complete.
+
+    Parameters
+    ----------
+
+    url : str
+        The URL; ``file://`` URLs work too.
+
+    destination : str or ``pathlib.Path``
+        Where to put the file.
+
+    retries : int, optional
+        Number of times to retry, resuming where it stopped, after a failed
+        connection.
+
+    Returns
+    -------
+
+    ``pathlib.Path``
+        The downloaded file.
+    """
+    destination = Path(destination)
+    partial = destination.with_name(destination.name + '.part')
+    for attempt in range(retries + 1):
+        offset = partial.stat().st_size if partial.exists() else 0
+        try:
+            response, resumed = _open(url, offset=offset)
+            with response, open(partial, 'ab' if resumed else 'wb') as f:
+                shutil.copyfileobj(response, f, CHUNK_SIZE)
+                # Reading in chunks doesn't complain if the connection
+                # closes early, but the response knows how much is missing.
+                missing = getattr(response, 'length', None)
+                if missing:
+                    raise IncompleteRead(b'', missing)
+            break
+        except HTTPError as err:
+            # 416 means the partial file is already complete.
+            if err.code == 416:
+                break
+            if attempt == retries:
+                raise
+        except (URLError, OSError, HTTPException):
+            # HTTPException covers a connection dropped part way through
+            # (IncompleteRead), which is not an OSError.
+            if attempt == retries:
+                raise
+        time.sleep(2 ** attempt)
+
+    partial.replace(destination)
+    return destination
+
+
+def _place(source, destination):
+    """
+    Hard link a cached file into place, or copy it if that is not possible.
+    """
+    destination = Path(destination)
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def fetch(record, file_name, destination_dir='.', base_url=ZENODO,
+          cache_dir=None, checksums=None, place=True):
+    """
+    Get one file from a Zenodo record into the cache and a directory.
+
+    Parameters
+    ----------
+
+    record : int or str
+        Zenodo record number.
+
+    file_name : str
+        Name of the file in the record.
+
+    destination_dir : str, optional
+        Directory in which to put the file.
+
+    base_url : str, optional
+        Zenodo, or a mirror of it.
+
+    cache_dir : str, optional
+        Directory in which downloaded files are kept; see
+        `default_cache_dir`.
+
+    checksums : dict, optional
+        Result of `record_checksums` for the record, if already known.
+
+    place : bool, optional
+        If ``False``, the file is only put in the cache, not in
+        ``destination_dir``.
+
+    Returns
+    -------
+
+    ``pathlib.Path``
+        The file in the cache.
+    """
+    cache_dir = Path(cache_dir or default_cache_dir())
+    destination = Path(destination_dir) / file_name
+    if checksums is None:
+        checksums = record_checksums(record, base_url=base_url)
+    expected, _ = checksums.get(file_name, (None, None))
+
+    if expected is None:
+        if place and destination.exists():
+            print(f'{file_name} is already present (not verified).')
+            return destination
+    else:
+        cached = cache_dir / expected[:2] / expected
+        if cached.exists():
+            if not place:
+                return cached
+            if (destination.exists() and
+                    destination.stat().st_size == cached.stat().st_size and
+                    md5_of(destination) == expected):
+                print(f'{file_name} is already present.')
+            else:
+                print(f'{file_name} found in the cache.')
+                _place(cached, destination)
+            return cached
+
+    # Download into the cache directory so the final move is a rename.
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    incoming = cache_dir / f'{record}-{file_name}'
+    print(f'Downloading {file_name}')
+    download(file_url(record, file_name, base_url=base_url), incoming)
+
+    actual = md5_of(incoming)
+    if expected is not None and actual != expected:
+        incoming.unlink()
+        raise RuntimeError(f'Checksum of {file_name} is {actual}, expected '
+                           f'{expected}; the download has been deleted.')
+
+    cached = cache_dir / actual[:2] / actual
+    cached.parent.mkdir(exist_ok=True)
+    incoming.replace(cached)
+    if place:
+        _place(cached, destination)
+    print(f'File {file_name} successfully downloaded.')
+    return cached
+
+
+def _extract_all(archive, destination_dir):
+    # The data filter (Python 3.12, and backported) refuses to write outside
+    # of the destination.
+    if hasattr(tarfile, 'data_filter'):
+        archive.extractall(destination_dir, filter='data')
+    else:
+        archive.extractall(destination_dir)
+
+
+def _extraction_marker(file_name, destination_dir):
+    # The marker holds the checksum of the tarball extracted.
+    return Path(destination_dir) / file_name.split('.')[0] / '.extracted-from'
+
+
+def extract(tarball, file_name, destination_dir='.'):
+    """
+    Extract a tarball unless it has already been extracted.
+
+    A marker file with the checksum of the tarball is left in the directory
+    it extracts to.
+    """
+    marker = _extraction_marker(file_name, destination_dir)
+    checksum = Path(tarball).name
+    if marker.exists() and marker.read_text() == checksum:
+        print(f'{file_name} is already extracted.')
+        return marker.parent
+
+    print(f'Unzipping {file_name}')
+    with tarfile.open(tarball) as archive:
+        _extract_all(archive, destination_dir)
+
+    if not marker.parent.exists():
+        raise RuntimeError(f'File {marker.parent} not unzipped.')
+    marker.write_text(checksum)
+    print(f'File {marker.parent} successfully unzipped.')
+    return marker.parent
+
+
+class _CopyingReader:
+    """
+    Read a stream, copying everything read to a file and hashing it.
+    """
+    def __init__(self, stream, copy_to):
+        self.stream = stream
+        self.copy_to = copy_to
+        self.digest = md5()
+
+    def read(self, size=-1):
+        data = self.stream.read(size) if size >= 0 else self.stream.read()
+        self.copy_to.write(data)
+        self.digest.update(data)
+        return data
+
+    def drain(self):
+        # Read whatever the tar reader left, like the padding at the end.
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def fetch_and_extract(record, file_name, destination_dir='.',
+                      base_url=ZENODO, cache_dir=None, checksums=None):
+    """
+    Get a tarball and extract it as it downloads.
+
+    The tarball is still saved in the cache and checked against its MD5
+    checksum; the extracted directory is only marked as complete if the
+    checksum is right. If a partial download is left from an earlier try it
+    is resumed instead, and extracted afterwards.
+
+    Parameters are the same as for `fetch`.
+
+    Returns
+    -------
+
+    ``pathlib.Path``
+        The directory extracted.
+    """
+    cache_dir = Path(cache_dir or default_cache_dir())
+    if checksums is None:
+        checksums = record_checksums(record, base_url=base_url)
+    expected, _ = checksums.get(file_name, (None, None))
+
+    marker = _extraction_marker(file_name, destination_dir)
+    if expected is None:
+        # Without a checksum to compare with, any complete extraction will
+        # do, as in fetch.
+        if marker.exists():
+            print(f'{file_name} is already extracted (not verified).')
+            return marker.parent
+    else:
+        if marker.exists() and marker.read_text() == expected:
+            print(f'{file_name} is already extracted.')
+            return marker.parent
+        cached = cache_dir / expected[:2] / expected
+        if cached.exists():
+            return extract(cached, file_name, destination_dir=destination_dir)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partial = cache_dir / f'{record}-{file_name}.part'
+    if partial.exists():
+        cached = fetch(record, file_name, destination_dir=destination_dir,
+                       base_url=base_url, cache_dir=cache_dir,
+                       checksums=checksums, place=False)
+        return extract(cached, file_name, destination_dir=destination_dir)
+
+    print(f'Downloading and unzipping {file_name}')
+    response, _ = _open(file_url(record, file_name, base_url=base_url))
+    with response, open(partial, 'wb') as f:
+        reader = _CopyingReader(response, f)
+        with tarfile.open(fileobj=reader, mode='r|*') as archive:
+            _extract_all(archive, destination_dir)
+        reader.drain()
+
+    actual = reader.digest.hexdigest()
+    if expected is not None and actual != expected:
+        partial.unlink()
+        raise RuntimeError(f'Checksum of {file_name} is {actual}, expected '
+                           f'{expected}; the download has been deleted and '
+                           f'{marker.parent} is not complete.')
+
+    cached = cache_dir / actual[:2] / actual
+    cached.parent.mkdir(exist_ok=True)
+    partial.replace(cached)
+    marker.write_text(actual)
+    print(f'File {marker.parent} successfully unzipped.')
+    return marker.parent
+
+
+def transcode(file_name, compression=None, quantize_level=16,
+              overwrite=False):
+    """
+    Write a bzip2-compressed FITS file without the bzip2 compression.
+
+    Astropy has to decompress a ``.bz2`` file completely every time it is
+    read, and cannot memory map it. The new file, next to the old one with
+    ``.bz2`` removed from its name, is either plain FITS or tile-compressed
+    FITS, from which astropy decompresses only the tiles that are used.
+
+    Parameters
+    ----------
+
+    file_name : str
+        A ``.bz2`` FITS file.
+
+    compression : str, optional
+        Tile compression to use, e.g. ``'RICE_1'`` or ``'GZIP_2'``. By
+        default the file is not compressed. A compressed image cannot be the
+        primary HDU, so it goes in the first extension; read it with
+        ``CCDData.read(..., hdu=1)``.
+
+    quantize_level : float, optional
+        Passed to ``astropy.io.fits.CompImageHDU`` for floating point
+        images. Quantization loses information; use ``'GZIP_2'`` with
+        ``quantize_level=0`` to keep every bit.
+
+    overwrite : bool, optional
+        If ``True``, write the file even if there is a newer one.
+
+    Returns
+    -------
+
+    ``pathlib.Path``
+        The new file.
+    """
+    source = Path(file_name)
+    output = source.with_suffix('')
+    if (not overwrite and output.exists() and
+            output.stat().st_mtime >= source.stat().st_mtime):
+        return output
+
+    with fits.open(source) as hdul:
+        if compression is None:
+            new = fits.HDUList([hdu.copy() for hdu in hdul])
+        else:
+            new = fits.HDUList([fits.PrimaryHDU()])
+            for hdu in hdul:
+                if (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and
+                        hdu.data is not None):
+                    new.append(fits.CompImageHDU(
+                        hdu.data, hdu.header, name=hdu.name or None,
+                        compression_type=compression,
+                        quantize_level=quantize_level))
+                elif not isinstance(hdu, fits.PrimaryHDU):
+                    new.append(hdu.copy())
+        new.writeto(output, overwrite=True)
+    return output
+
+
+def transcode_all(files, max_workers=None, **transcode_kwargs):
+    """
+    Transcode several files in parallel; see `transcode`.
+
+    Returns
+    -------
+
+    list of ``pathlib.Path``
+        The new files.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(transcode, name, **transcode_kwargs)
+                   for name in files]
+        return [future.result() for future in futures]
+
+
+def _fetch_entry(record, file_name, unzip, destination_dir, base_url,
+                 cache_dir):
+    if unzip:
+        fetch_and_extract(record, file_name, destination_dir=destination_dir,
+                          base_url=base_url, cache_dir=cache_dir)
+    else:
+        fetch(record, file_name, destination_dir=destination_dir,
+              base_url=base_url, cache_dir=cache_dir)
+    return file_name
+
+
+def fetch_all(entries=DATA_FILES, destination_dir='.', base_url=ZENODO,
+              cache_dir=None, max_workers=4):
+    """
+    Fetch (and extract) several files at the same time.
+
+    Parameters
+    ----------
+
+    entries : list of tuple, optional
+        ``(record, file name, unzip)`` for each file; by default all of the
+        files the notebooks use.
+
+    destination_dir, base_url, cache_dir
+        See `fetch`.
+
+    max_workers : int, optional
+        Number of files downloaded at once.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_fetch_entry, record, file_name, unzip,
+                                   destination_dir, base_url, cache_dir)
+                   for record, file_name, unzip in entries]
+        for future in futures:
+            future.result()
+
+
+def build_mirror(mirror_dir, entries=DATA_FILES, source_dir='.'):
+    """
+    Make a Zenodo-like mirror of files that are on disk.
+
+    The mirror can be used directly with ``base_url=Path(mirror_dir)
+    .resolve().as_uri()``, or served with ``python -m http.server``.
+
+    Parameters
+    ----------
+
+    mirror_dir : str
+        Directory for the mirror.
+
+    entries : list of tuple, optional
+        ``(record, file name, unzip)`` for each file.
+
+    source_dir : str, optional
+        Directory with the files.
+    """
+    mirror_dir = Path(mirror_dir)
+    records = {}
+    for record, file_name, _ in entries:
+        records.setdefault(record, []).append(file_name)
+
+    for record, names in records.items():
+        files_dir = mirror_dir / 'record' / str(record) / 'files'
+        files_dir.mkdir(parents=True, exist_ok=True)
+        listing = []
+        for name in names:
+            source = Path(source_dir) / name
+            shutil.copyfile(source, files_dir / name)
+            listing.append(dict(key=name, size=source.stat().st_size,
+                                checksum=f'md5:{md5_of(source)}'))
+        api_dir = mirror_dir / 'api' / 'records'
+        api_dir.mkdir(parents=True, exist_ok=True)
+        (api_dir / str(record)).write_text(json.dumps(dict(files=listing)))
@@ -0,0 +1,210 @@
+"""
+Overlap reading and writing frames with processing them.
+
+The calibration loops in the notebooks look like this::
+
+    for ccd, file_name in ifc.ccds(imagetyp='bias', return_fname=True):
+        ccd = ccdp.subtract_overscan(ccd, ...)
+        ccd.write(reduced_path / file_name)
+
+Each frame is read, processed and written in turn, so nothing is computed
+while a file is being read or written. `prefetch_ccds` is a drop-in
+replacement for ``ifc.ccds`` that reads the next few frames in background
+threads while the current one is processed, and `AsyncWriter` writes frames
+in a background thread; it stops taking new frames when too many are
+waiting, so memory use stays bounded when writing is slower than
+processing::
+
+    with AsyncWriter() as writer:
+        for ccd, file_name in prefetch_ccds(ifc, imagetyp='bias',
+                                            return_fname=True):
+            ccd = ccdp.subtract_overscan(ccd, ...)
+            writer.write(ccd, reduced_path / file_name)
+
+Reading and writing FITS files, and tile (de)compression, mostly happen
+outside of the Python interpreter lock, so threads are enough here.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from compressed_fits import read_reduced, write_reduced
+
+
+def prefetch_files(files, prefetch=2, reader=read_reduced, **read_kwargs):
+    """
+    Read files in order, keeping the next few reads running in the
+    background.
+
+    Parameters
+    ----------
+
+    files : iterable of str or ``pathlib.Path``
+        Files to read.
+
+    prefetch : int, optional
+        Number of files read ahead of the one being used. With 0 each file
+        is read when it is needed, as in a plain loop.
+
+    reader : callable, optional
+        Function that reads one file, called as
+        ``reader(file_name, **read_kwargs)``.
+
+    read_kwargs
+        Passed to ``reader``.
+
+    Yields
+    ------
+
+    file_name, result
+        Each file name and what ``reader`` returned for it.
+    """
+    files = iter(files)
+    if prefetch < 1:
+        for file_name in files:
+            yield file_name, reader(file_name, **read_kwargs)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+
+    def submit_next():
+        for file_name in files:
+            pending.append((file_name, executor.submit(reader, file_name,
+                                                       **read_kwargs)))
+            return
+
+    try:
+        for _ in range(prefetch):
+            submit_next()
+        while pending:
+            file_name, future = pending.popleft()
+            result = future.result()
+            # Start the next read before handing this frame over.
+            submit_next()
+            yield file_name, result
+    finally:
+        # If the loop stopped early, don't finish reads nobody wants.
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def prefetch_ccds(ifc, prefetch=2, return_fname=False, ccd_kwargs=None,
+                  **kwd):
+    """
+    Like ``ifc.ccds``, but read the next frames in the background.
+
+    Parameters
+    ----------
+
+    ifc : ``ccdp.ImageFileCollection`` or `header_index.HeaderIndex`
+        Collection of images.
+
+    prefetch : int, optional
+        Number of frames read ahead; see `prefetch_files`.
+
+    return_fname : bool, optional
+        If ``True``, yield the file name (without the directory) along with
+        each image, as ``ifc.ccds`` does.
+
+    ccd_kwargs : dict, optional
+        Passed to `compressed_fits.read_reduced`; the unit defaults to
+        ``adu``, as in ``ifc.ccds``, for files that don't give one.
+
+    kwd
+        Keyword values used to select the files, as in
+        ``ifc.files_filtered``.
+
+    Yields
+    ------
+
+    ``CCDData``, or ``CCDData`` and file name
+    """
+    ccd_kwargs = dict(dict(unit='adu'), **(ccd_kwargs or {}))
+    paths = ifc.files_filtered(include_path=True, **kwd)
+    for path, ccd in prefetch_files(paths, prefetch=prefetch, **ccd_kwargs):
+        yield (ccd, os.path.basename(path)) if return_fname else ccd
+
+
+class AsyncWriter:
+    """
+    Write frames in the background.
+
+    Use it as a context manager, which waits for all of the writes to
+    finish on exit. The frame passed to `write` must not be changed
+    afterwards, since it may not have been written yet.
+
+    Parameters
+    ----------
+
+    max_pending : int, optional
+        Most frames waiting to be written; `write` blocks until there is
+        room for another.
+
+    max_workers : int, optional
+        Number of threads writing frames.
+
+    writer : callable, optional
+        Function that writes one frame, called as
+        ``writer(ccd, file_name, **write_kwargs)``.
+
+    write_kwargs
+        Passed to ``writer``, e.g. ``overwrite=True``.
+    """
+    def __init__(self, max_pending=4, max_workers=1, writer=write_reduced,
+                 **write_kwargs):
+        self.writer = writer
+        self.write_kwargs = write_kwargs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._room = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._errors = []
+        self.written = []
+
+    def _write(self, ccd, file_name, write_kwargs):
+        try:
+            self.writer(ccd, file_name, **write_kwargs)
+            with self._lock:
+                self.written.append(file_name)
+        except Exception as error:
+            with self._lock:
+                self._errors.append(error)
+        finally:
+            self._room.release()
+
+    def _raise_error(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors.pop(0)
+
+    def write(self, ccd, file_name, **write_kwargs):
+        """
+        Queue a frame to be written, waiting if the queue is full.
+
+        Any error from an earlier write is raised here.
+        """
+        self._raise_error()
+        self._room.acquire()
+        kwargs = dict(self.write_kwargs, **write_kwargs)
+        self._executor.submit(self._write, ccd, file_name, kwargs)
+
+    def close(self):
+        """
+        Wait for the queued frames to be written, then raise the first
+        error, if any.
+        """
+        self._executor.shutdown(wait=True)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't hide the error that stopped the loop behind one from
+            # writing.
+            self._executor.shutdown(wait=True)
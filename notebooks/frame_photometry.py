@@ -0,0 +1,374 @@
+"""
+Detection, background estimation and aperture photometry for many frames.
+
+Each frame is measured in its own process: the background is estimated and
+subtracted, stars are found (or measured at positions given in advance) and
+their fluxes measured in one or more circular apertures with
+`multi_aperture.multi_aperture_photometry`. The result for each frame is a
+catalog written to disk as a FITS table (or any other column-based format
+astropy can write, like Parquet if ``pyarrow`` is installed), with the time
+and exposure of the frame in its metadata. A catalog is only
+remeasured if the image or the settings change.
+
+The catalogs for a night of time-series frames are then turned into a light
+curve by `light_curve`, which follows the target and comparison stars from
+frame to frame even if the pointing drifts.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from astropy import units as u
+from astropy.nddata import CCDData
+from astropy.table import Table
+from astropy.time import Time
+from photutils.detection import DAOStarFinder
+from photutils.utils import calc_total_error
+
+from multi_aperture import multi_aperture_photometry
+from reduction_cache import params_digest
+from tiled_background import background_mesh
+
+# File extension used for each catalog format.
+CATALOG_EXTENSIONS = {
+    'fits': '.fits',
+    'parquet': '.parquet',
+    'ascii.ecsv': '.ecsv',
+}
+
+
+def estimate_background(data, box_size=64, filter_size=3, mask=None):
+    """
+    Smooth 2D background and background RMS of an image.
+
+    The box layout is kept (see `tiled_background.background_mesh`), so
+    frames of the same shape and mask measured by one process share it.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        The image.
+
+    box_size : int, optional
+        Size of the boxes in which the background is estimated.
+
+    filter_size : int, optional
+        Size of the median filter applied to the grid of box values.
+
+    mask : numpy array of bool, optional
+        Pixels to leave out of the estimate.
+
+    Returns
+    -------
+
+    background, rms : numpy arrays
+        The background and its RMS, the same shape as the image.
+    """
+    mesh = background_mesh(np.shape(data), box_size=box_size, mask=mask,
+                           filter_size=filter_size)
+    bkg = mesh.estimate(data)
+    return bkg.background(), bkg.rms()
+
+
+def find_stars(data, rms, fwhm=4, threshold=5):
+    """
+    Find stars in a background-subtracted image.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        Background-subtracted image.
+
+    rms : numpy array or float
+        Background RMS.
+
+    fwhm : float, optional
+        Approximate FWHM of the stars, in pixels.
+
+    threshold : float, optional
+        Detection threshold, in units of the background RMS.
+
+    Returns
+    -------
+
+    numpy array
+        Positions of the stars, shape ``(n, 2)``, in (x, y) order.
+    """
+    finder = DAOStarFinder(fwhm=fwhm, threshold=threshold * np.median(rms))
+    sources = finder(data)
+    if sources is None:
+        return np.empty((0, 2))
+    return np.array([sources['xcentroid'], sources['ycentroid']]).T
+
+
+def measure_frame(file_name, catalog_dir, radii=(6,), fwhm=4, threshold=5,
+                  box_size=64, gain=1.0, positions=None,
+                  catalog_format='fits', overwrite=False):
+    """
+    Measure the stars in one frame and write their catalog.
+
+    Parameters
+    ----------
+
+    file_name : str
+        Calibrated image.
+
+    catalog_dir : str
+        Directory in which to write the catalog.
+
+    radii : list of float, optional
+        Radii, in pixels, of the apertures.
+
+    fwhm, threshold
+        Detection settings; see `find_stars`.
+
+    box_size : int, optional
+        Box size for the background; see `estimate_background`.
+
+    gain : float, optional
+        Gain of the camera, in electrons/ADU, used for the flux errors.
+
+    positions : numpy array, optional
+        If given, these (x, y) positions are measured instead of finding
+        the stars in the frame.
+
+    catalog_format : str, optional
+        Format the catalog is written in; one of the keys of
+        ``CATALOG_EXTENSIONS``.
+
+    overwrite : bool, optional
+        If ``True``, measure the frame even if there is an up to date
+        catalog for it.
+
+    Returns
+    -------
+
+    str
+        Name of the catalog.
+    """
+    file_name = Path(file_name)
+    extension = CATALOG_EXTENSIONS[catalog_format]
+    catalog_file = Path(catalog_dir) / f'{file_name.stem}-phot{extension}'
+
+    params = dict(radii=list(radii), fwhm=fwhm, threshold=threshold,
+                  box_size=box_size, gain=gain,
+                  positions=None if positions is None else
+                  np.asarray(positions).tolist())
+    digest = params_digest(params)
+
+    if (not overwrite and catalog_file.exists() and
+            catalog_file.stat().st_mtime >= file_name.stat().st_mtime):
+        old = Table.read(catalog_file, format=catalog_format)
+        if old.meta.get('PARAMS') == digest:
+            return str(catalog_file)
+
+    ccd = CCDData.read(file_name)
+    data = np.asarray(ccd.data, dtype=np.float64)
+    background, rms = estimate_background(data, box_size=box_size,
+                                          mask=ccd.mask)
+    data = data - background
+
+    if positions is None:
+        positions = find_stars(data, rms, fwhm=fwhm, threshold=threshold)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+
+    catalog = Table()
+    catalog['id'] = np.arange(1, len(positions) + 1)
+    catalog['x'] = positions[:, 0]
+    catalog['y'] = positions[:, 1]
+    error = calc_total_error(data, rms, gain)
+    flux, flux_err = multi_aperture_photometry(data, positions, radii,
+                                               error=error, mask=ccd.mask)
+    for idx in range(len(radii)):
+        catalog[f'flux_{idx}'] = flux[:, idx]
+        catalog[f'flux_err_{idx}'] = flux_err[:, idx]
+
+    # FITS headers cannot hold lists, so there is one keyword per radius.
+    catalog.meta['FILE'] = file_name.name
+    catalog.meta['DATE-OBS'] = ccd.header.get('date-obs', '')
+    catalog.meta['EXPTIME'] = ccd.header.get('exptime', 0)
+    catalog.meta['FILTER'] = ccd.header.get('filter', '')
+    catalog.meta['SKY'] = float(np.median(background))
+    catalog.meta['NAPER'] = len(radii)
+    for idx, r in enumerate(radii):
+        catalog.meta[f'APRAD{idx}'] = r
+    catalog.meta['PARAMS'] = digest
+
+    catalog.write(catalog_file, format=catalog_format, overwrite=True)
+    return str(catalog_file)
+
+
+def measure_files(files, catalog_dir, max_workers=None, **measure_kwargs):
+    """
+    Measure many frames in parallel.
+
+    Parameters
+    ----------
+
+    files : list of str
+        Calibrated images.
+
+    catalog_dir : str
+        Directory in which to write the catalogs; it is created if needed.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    measure_kwargs
+        Passed to `measure_frame`.
+
+    Returns
+    -------
+
+    list of str
+        Names of the catalogs, in the same order as ``files``.
+    """
+    Path(catalog_dir).mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(measure_frame, str(name), catalog_dir,
+                                   **measure_kwargs)
+                   for name in files]
+        return [future.result() for future in futures]
+
+
+def measure_collection(ifc, catalog_dir, max_workers=None, imagetyp='light',
+                       **measure_kwargs):
+    """
+    Measure the frames of one type in a collection, in parallel.
+
+    Parameters
+    ----------
+
+    ifc : ``ccdp.ImageFileCollection``
+        Collection of calibrated images.
+
+    catalog_dir, max_workers, measure_kwargs
+        See `measure_files`.
+
+    imagetyp : str, optional
+        Only images of this type are measured.
+
+    Returns
+    -------
+
+    list of str
+        Names of the catalogs.
+    """
+    files = ifc.files_filtered(imagetyp=imagetyp, include_path=True)
+    return measure_files(files, catalog_dir, max_workers=max_workers,
+                         **measure_kwargs)
+
+
+def _mid_exposure(meta):
+    """
+    Time of the middle of the exposure, or ``None`` if it isn't known.
+    """
+    if not meta.get('DATE-OBS'):
+        return None
+    return Time(meta['DATE-OBS']) + meta.get('EXPTIME', 0) / 2 * u.second
+
+
+def light_curve(catalogs, target, comparisons=(), aperture=0,
+                match_radius=3, max_shift=20, catalog_format='fits'):
+    """
+    Light curve of a star from a series of catalogs.
+
+    Parameters
+    ----------
+
+    catalogs : list of str
+        Catalogs written by `measure_frame`, in time order. The first one is
+        the reference whose pixel positions ``target`` and ``comparisons``
+        are given in.
+
+    target : tuple of float
+        (x, y) position of the target in the first frame.
+
+    comparisons : list of tuple, optional
+        (x, y) positions of comparison stars in the first frame. If given,
+        the flux of the target relative to their total is also calculated.
+
+    aperture : int, optional
+        Index of the aperture to use.
+
+    match_radius : float, optional
+        Distance, in pixels, within which a star must be found to count as
+        the same star.
+
+    max_shift : float, optional
+        Largest drift in pointing, in pixels, from the first frame.
+
+    catalog_format : str, optional
+        Format of the catalogs.
+
+    Returns
+    -------
+
+    ``astropy.table.Table``
+        One row per frame, with the time, the flux of the target and, if there
+        are comparison stars, the relative flux. Fluxes are NaN in frames in
+        which the target (or any comparison star) was not found.
+    """
+    stars = np.array([target] + list(comparisons), dtype=np.float64)
+    flux_col = f'flux_{aperture}'
+    error_col = f'flux_err_{aperture}'
+
+    ref_xy = None
+    rows = []
+    for name in catalogs:
+        catalog = Table.read(name, format=catalog_format)
+        xy = np.array([catalog['x'], catalog['y']], dtype=np.float64).T
+        if ref_xy is None:
+            ref_xy = xy
+
+        # The drift is the median offset of the reference stars to their
+        # nearest neighbors in this frame.
+        shift = np.zeros(2)
+        found = np.full(len(stars), -1)
+        if len(xy):
+            tree = cKDTree(xy)
+            distance, nearest = tree.query(ref_xy,
+                                           distance_upper_bound=max_shift)
+            close = np.isfinite(distance)
+            if close.any():
+                shift = np.median(xy[nearest[close]] - ref_xy[close], axis=0)
+            distance, nearest = tree.query(stars + shift,
+                                           distance_upper_bound=match_radius)
+            found = np.where(np.isfinite(distance), nearest, -1)
+
+        flux = np.full(len(stars), np.nan)
+        error = np.full(len(stars), np.nan)
+        good = found >= 0
+        flux[good] = catalog[flux_col][found[good]]
+        error[good] = catalog[error_col][found[good]]
+        time = _mid_exposure(catalog.meta)
+        rows.append((catalog.meta.get('FILE', Path(name).name),
+                     np.nan if time is None else time.jd,
+                     flux, error, shift))
+
+    result = Table()
+    result['file'] = [row[0] for row in rows]
+    result['time'] = Time([row[1] for row in rows], format='jd')
+    flux = np.array([row[2] for row in rows])
+    error = np.array([row[3] for row in rows])
+    shifts = np.array([row[4] for row in rows])
+    result['x_shift'] = shifts[:, 0]
+    result['y_shift'] = shifts[:, 1]
+    result['flux'] = flux[:, 0]
+    result['flux_err'] = error[:, 0]
+
+    if len(comparisons):
+        comp_flux = flux[:, 1:].sum(axis=1)
+        comp_error = np.sqrt((error[:, 1:] ** 2).sum(axis=1))
+        relative = flux[:, 0] / comp_flux
+        result['comparison_flux'] = comp_flux
+        result['relative_flux'] = relative
+        result['relative_flux_err'] = np.abs(relative) * np.sqrt(
+            (error[:, 0] / flux[:, 0]) ** 2 + (comp_error / comp_flux) ** 2)
+
+    return result
@@ -0,0 +1,194 @@
+"""
+Per-frame statistics computed in one pass and kept in a sidecar table.
+
+Combining flats with ``scale=inv_median`` reads every flat once just to get
+its median, and the diagnostic plots of median and mean counts read every
+flat again. The functions here read each frame once, calculate all of the
+statistics that are needed, and save them in a table next to the images so
+that both the scaled combination and the plots can use them.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.table import MaskedColumn, Table
+
+from nan_combine import MAD_TO_STD
+
+# Name of the table, in the directory with the images, in which the
+# statistics are stored.
+DEFAULT_STATS_TABLE = 'frame_stats.ecsv'
+
+# Header keywords copied into the table to make it easy to select rows.
+HEADER_COLUMNS = ['imagetyp', 'filter', 'exptime']
+
+
+def frame_statistics(data, clip_sigma=3):
+    """
+    Calculate the statistics of a single image.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        The image data. NaN values are ignored.
+
+    clip_sigma : float, optional
+        Clipping threshold, in units of the MAD-based standard deviation,
+        used for the clipped mean.
+
+    Returns
+    -------
+
+    dict
+        The median, mean, MAD-based standard deviation and sigma-clipped
+        mean of ``data``.
+    """
+    values = np.asarray(data, dtype=np.float64).ravel()
+    values = values[~np.isnan(values)]
+
+    median = np.median(values)
+    deviation = np.abs(values - median)
+    mad_std = MAD_TO_STD * np.median(deviation)
+
+    # Clip using the median and MAD we already have instead of having
+    # sigma_clip calculate them again.
+    keep = deviation <= clip_sigma * mad_std
+    clipped_mean = values[keep].mean() if keep.any() else np.nan
+
+    return dict(median=median, mean=values.mean(), mad_std=mad_std,
+                clipped_mean=clipped_mean)
+
+
+def _file_signature(path):
+    stat = Path(path).stat()
+    return stat.st_mtime, stat.st_size
+
+
+def compute_frame_stats(ifc, stats_table=DEFAULT_STATS_TABLE,
+                        clip_sigma=3, **filters):
+    """
+    Get statistics for the frames in an ``ImageFileCollection``, reading
+    each frame at most once.
+
+    Statistics already stored in the sidecar table are reused unless the file
+    has changed (as judged by modification time and size) since they were
+    calculated. New or changed frames are read and the table is updated.
+
+    Parameters
+    ----------
+
+    ifc : ``ccdp.ImageFileCollection``
+        Collection containing the frames.
+
+    stats_table : str, optional
+        Name of the table of statistics, relative to the location of the
+        collection. If ``None``, nothing is read from or written to disk.
+
+    clip_sigma : float, optional
+        Clipping threshold used for the clipped mean.
+
+    filters
+        Keyword filters, like ``imagetyp='flat'``, used to select frames in
+        the same way as ``ifc.files_filtered``.
+
+    Returns
+    -------
+
+    ``astropy.table.Table``
+        One row per selected frame with the file name, header keywords in
+        ``HEADER_COLUMNS``, and the columns ``median``, ``mean``, ``mad_std``
+        and ``clipped_mean``.
+    """
+    location = Path(ifc.location)
+    files = ifc.files_filtered(**filters)
+
+    cached = {}
+    table_path = None
+    if stats_table is not None:
+        table_path = location / stats_table
+        if table_path.exists():
+            old = Table.read(table_path)
+            cached = {row['file']: row for row in old}
+
+    rows = []
+    updated = False
+    for name in files:
+        mtime, size = _file_signature(location / name)
+        row = cached.get(name)
+        if (row is not None and row['mtime'] == mtime and
+                row['size'] == size and row['clip_sigma'] == clip_sigma):
+            rows.append(dict(row))
+            continue
+
+        with fits.open(location / name, memmap=True) as hdul:
+            header = hdul[0].header
+            new_row = dict(file=name, mtime=mtime, size=size,
+                           clip_sigma=clip_sigma)
+            # Keywords a frame doesn't have are left out, so they end up
+            # masked rather than turning a numeric column into strings.
+            for key in HEADER_COLUMNS:
+                if key in header:
+                    new_row[key] = header[key]
+            new_row.update(frame_statistics(hdul[0].data,
+                                            clip_sigma=clip_sigma))
+        rows.append(new_row)
+        cached[name] = new_row
+        updated = True
+
+    if table_path is not None and updated:
+        # Keep rows for frames that were not selected this time so the
+        # table covers everything that has been measured.
+        everything = _rows_to_table(list(cached.values()))
+        everything.write(table_path, overwrite=True)
+
+    if not rows:
+        return Table(names=['file', 'median', 'mean', 'mad_std',
+                            'clipped_mean'])
+
+    return _rows_to_table(rows)
+
+
+def _rows_to_table(rows):
+    # Rows missing a key get a masked value in that column; a keyword that
+    # no frame has still gets a (fully masked) column.
+    table = Table(rows=rows)
+    for key in HEADER_COLUMNS:
+        if key not in table.colnames:
+            table[key] = MaskedColumn(np.zeros(len(table)),
+                                      mask=np.ones(len(table), dtype=bool))
+    return table
+
+
+def scale_factors(stats, files, column='median'):
+    """
+    Inverse of a statistic for each of the files, in the order given.
+
+    The result can be passed as the ``scale`` argument of ``ccdp.combine``
+    in place of a function like ``inv_median``, which saves reading every
+    image an extra time.
+
+    Parameters
+    ----------
+
+    stats : ``astropy.table.Table``
+        Table returned by `compute_frame_stats`.
+
+    files : list of str
+        Files to be combined; they may include the path.
+
+    column : str, optional
+        The statistic whose inverse is the scale factor.
+
+    Returns
+    -------
+
+    numpy array
+        One scale factor per file.
+    """
+    lookup = {name: value for name, value in zip(stats['file'], stats[column])}
+    try:
+        return np.array([1 / lookup[Path(f).name] for f in files])
+    except KeyError as e:
+        raise ValueError(f'No statistics for file {e.args[0]}') from e
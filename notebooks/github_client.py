@@ -0,0 +1,212 @@
+"""
+A small client for the GitHub REST API that can be shared by threads.
+
+`GitHubClient` limits how many requests are in flight at once, and by
+default sends requests that change things (anything but ``GET``) one at a
+time, as GitHub asks. It follows GitHub's rate limits: when
+``X-RateLimit-Remaining`` runs out, or GitHub asks it to slow down with a
+403 or 429 response, every thread waits until the time GitHub gave
+(``X-RateLimit-Reset`` or ``Retry-After``, or ``secondary_wait`` if it gave
+none) before sending anything else. Requests that were turned away are
+retried.
+
+The API URL can point anywhere, e.g. at `fake_github.FakeGitHub` for trying
+things out without touching GitHub.
+"""
+from contextlib import nullcontext
+import json
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+API_URL = 'https://api.github.com'
+
+
+class GitHubError(Exception):
+    """
+    A request that GitHub refused.
+
+    Attributes
+    ----------
+
+    status : int
+        HTTP status code.
+
+    body : dict or None
+        The JSON body of the response, if there was one.
+    """
+    def __init__(self, status, message, body=None):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+        self.body = body
+
+
+class GitHubClient:
+    """
+    Thread-safe, rate-limit-aware GitHub API client.
+
+    Parameters
+    ----------
+
+    token : str, optional
+        Personal access token.
+
+    api_url : str, optional
+        Base URL of the API.
+
+    max_concurrent : int, optional
+        Most requests in flight at once.
+
+    max_concurrent_writes : int, optional
+        Most requests other than ``GET`` in flight at once. GitHub asks that
+        requests that create content not be made concurrently, and may hit
+        clients that do with its secondary rate limits.
+
+    max_retries : int, optional
+        Number of times a request that hit a rate limit or a server error
+        is retried.
+
+    secondary_wait : float, optional
+        Seconds to wait after a rate limit response that doesn't say how
+        long to wait. GitHub asks for at least a minute.
+
+    timeout : float, optional
+        Timeout, in seconds, of each request.
+    """
+    def __init__(self, token=None, api_url=API_URL, max_concurrent=4,
+                 max_concurrent_writes=1, max_retries=5, secondary_wait=60,
+                 timeout=30):
+        self.token = token
+        self.api_url = api_url.rstrip('/')
+        self.max_retries = max_retries
+        self.secondary_wait = secondary_wait
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._write_slots = threading.BoundedSemaphore(max_concurrent_writes)
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+        # Latest X-RateLimit-Remaining and X-RateLimit-Reset seen.
+        self.rate_limit = {}
+
+    def _wait_until_allowed(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def _pause_until(self, when):
+        with self._lock:
+            self._resume_at = max(self._resume_at, when)
+
+    def _note_rate_limit(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self.rate_limit = dict(remaining=int(remaining),
+                                   reset=int(reset))
+        if int(remaining) == 0:
+            # Nothing more can be sent until the limit resets.
+            self._pause_until(int(reset))
+
+    def _retry_at(self, error, message, attempt):
+        # When to retry a refused request, or None if it shouldn't be.
+        if attempt >= self.max_retries:
+            return None
+        headers = error.headers
+        if error.code in (403, 429):
+            if headers.get('Retry-After') is not None:
+                return time.time() + float(headers['Retry-After'])
+            if headers.get('X-RateLimit-Remaining') == '0':
+                return float(headers.get('X-RateLimit-Reset', 0))
+            # Secondary rate limits often come without Retry-After; the
+            # message is the only way to tell them from a permission
+            # problem.
+            if error.code == 429 or 'rate limit' in message.lower():
+                return time.time() + self.secondary_wait
+            # Some other 403, like a permission problem.
+            return None
+        if error.code >= 500:
+            return time.time() + 2**attempt
+        return None
+
+    def _request_object(self, method, path, data, params):
+        url = self.api_url + path
+        if params:
+            url += '?' + urlencode(params)
+        headers = {'Accept': 'application/vnd.github+json',
+                   'X-GitHub-Api-Version': '2022-11-28'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        return Request(url, data=body, headers=headers, method=method)
+
+    def request(self, method, path, data=None, params=None):
+        """
+        Make an API request, waiting for rate limits as needed.
+
+        Parameters
+        ----------
+
+        method : str
+            HTTP method, e.g. ``'POST'``.
+
+        path : str
+            Path of the endpoint, e.g. ``'/repos/astropy/astropy/pulls'``,
+            with any parts that need it already quoted.
+
+        data : dict, optional
+            Sent as the JSON body.
+
+        params : dict, optional
+            Query parameters.
+
+        Returns
+        -------
+
+        dict, list or None
+            The decoded JSON response.
+
+        Raises
+        ------
+
+        GitHubError
+            If GitHub refuses the request and retrying won't help.
+        """
+        request = self._request_object(method, path, data, params)
+        writes = (self._write_slots if request.get_method() != 'GET'
+                  else nullcontext())
+        attempt = 0
+        while True:
+            self._wait_until_allowed()
+            with writes, self._slots:
+                try:
+                    with urlopen(request, timeout=self.timeout) as response:
+                        self._note_rate_limit(response.headers)
+                        body = response.read()
+                    return json.loads(body) if body else None
+                except HTTPError as error:
+                    self._note_rate_limit(error.headers)
+                    try:
+                        body = json.loads(error.read())
+                    except ValueError:
+                        body = None
+                    if not isinstance(body, dict):
+                        body = None
+                    message = (body or {}).get('message') or error.reason
+                    retry_at = self._retry_at(error, message, attempt)
+                    if retry_at is None:
+                        raise GitHubError(error.code, message,
+                                          body) from None
+            # Wait outside of the semaphore so other threads aren't held
+            # up by this one, although they'll wait too if GitHub said to.
+            self._pause_until(retry_at)
+            attempt += 1
@@ -0,0 +1,244 @@
+"""
+A persistent index of the FITS headers in a directory.
+
+``ccdp.ImageFileCollection`` opens every file in a directory each time it is
+created or refreshed. `HeaderIndex` keeps the headers in an SQLite database
+in the directory instead, together with the modification time and size of
+each file, so that only files that are new or have changed are opened when
+it is refreshed; those are read in a pool of threads. Queries like
+``files_filtered(imagetyp='bias', exptime=0)`` are answered from the
+database.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+from pathlib import Path
+import sqlite3
+
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.table import Table
+
+DEFAULT_DATABASE = 'header_index.sqlite'
+
+# File names matching these patterns are indexed.
+DEFAULT_PATTERNS = ('*.fit', '*.fits', '*.fts', '*.fit.gz', '*.fits.gz',
+                    '*.fit.bz2', '*.fits.bz2')
+
+# Keywords that are not worth keeping in the index.
+SKIPPED_KEYWORDS = {'', 'comment', 'history'}
+
+
+def header_to_dict(header):
+    """
+    Header as a dictionary with lowercase keywords, ready to store as JSON.
+    """
+    values = {}
+    for keyword, value in header.items():
+        keyword = keyword.lower()
+        if keyword in SKIPPED_KEYWORDS:
+            continue
+        # JSON has no undefined values, and SQLite rejects NaN.
+        if (isinstance(value, fits.card.Undefined) or
+                (isinstance(value, float) and not math.isfinite(value))):
+            value = None
+        values[keyword] = value
+    return values
+
+
+def _read_header(path, ext):
+    try:
+        return header_to_dict(fits.getheader(path, ext=ext))
+    except (OSError, IndexError, KeyError):
+        # Not a FITS file, or no such extension; index it with no header so
+        # it is not opened again until it changes.
+        return None
+
+
+class HeaderIndex:
+    """
+    Index of the headers of the FITS files in a directory.
+
+    Parameters
+    ----------
+
+    location : str
+        Directory of FITS files.
+
+    database : str, optional
+        Name of the SQLite database, relative to ``location``.
+
+    patterns : tuple of str, optional
+        Glob patterns of the files to index.
+
+    ext : int or str, optional
+        Extension whose header is indexed.
+
+    max_workers : int, optional
+        Number of threads used to read headers.
+
+    refresh : bool, optional
+        If ``True``, bring the index up to date now.
+    """
+    def __init__(self, location, database=DEFAULT_DATABASE,
+                 patterns=DEFAULT_PATTERNS, ext=0, max_workers=8,
+                 refresh=True):
+        self.location = Path(location)
+        self.patterns = patterns
+        self.ext = ext
+        self.max_workers = max_workers
+        self._db = sqlite3.connect(self.location / database)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                         '(name TEXT PRIMARY KEY, mtime REAL, '
+                         'size INTEGER, header TEXT)')
+        if refresh:
+            self.refresh()
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _files_on_disk(self):
+        # Stat results for the matching files, keyed by name.
+        names = set()
+        for pattern in self.patterns:
+            names.update(p.name for p in self.location.glob(pattern))
+        found = {}
+        for name in names:
+            stat = os.stat(self.location / name)
+            found[name] = (stat.st_mtime, stat.st_size)
+        return found
+
+    def refresh(self):
+        """
+        Bring the index up to date with the files in the directory.
+
+        Returns
+        -------
+
+        dict
+            Numbers of files ``added``, ``updated`` and ``removed``.
+        """
+        on_disk = self._files_on_disk()
+        indexed = {name: (mtime, size) for name, mtime, size in
+                   self._db.execute('SELECT name, mtime, size FROM files')}
+
+        removed = [name for name in indexed if name not in on_disk]
+        to_read = [name for name, signature in on_disk.items()
+                   if indexed.get(name) != signature]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            headers = executor.map(
+                lambda name: _read_header(self.location / name, self.ext),
+                to_read)
+            rows = [(name, *on_disk[name], json.dumps(header, default=str))
+                    for name, header in zip(to_read, headers)]
+
+        with self._db:
+            self._db.executemany('DELETE FROM files WHERE name = ?',
+                                 [(name,) for name in removed])
+            self._db.executemany('INSERT OR REPLACE INTO files '
+                                 'VALUES (?, ?, ?, ?)', rows)
+
+        n_updated = sum(name in indexed for name in to_read)
+        return dict(added=len(to_read) - n_updated, updated=n_updated,
+                    removed=len(removed))
+
+    def _query(self, columns, criteria):
+        clauses = []
+        params = []
+        for keyword, value in criteria.items():
+            # Quote the keyword so names like date-obs work in the JSON path.
+            path = '$."{}"'.format(keyword.lower())
+            if value == '*':
+                clauses.append('json_type(header, ?) IS NOT NULL')
+                params.append(path)
+            elif isinstance(value, str):
+                # Strings match without regard to case, as in ccdproc.
+                clauses.append('lower(json_extract(header, ?)) = lower(?)')
+                params.extend([path, value])
+            else:
+                clauses.append('json_extract(header, ?) = ?')
+                params.extend([path, value])
+
+        sql = f'SELECT {columns} FROM files WHERE header != ?'
+        if clauses:
+            sql += ' AND ' + ' AND '.join(clauses)
+        sql += ' ORDER BY name'
+        return self._db.execute(sql, ['null'] + params)
+
+    def files_filtered(self, include_path=False, **kwd):
+        """
+        Names of the files whose headers match, like
+        ``ImageFileCollection.files_filtered``.
+
+        Parameters
+        ----------
+
+        include_path : bool, optional
+            If ``True``, include the directory in the names.
+
+        kwd
+            Keyword values to match. Strings match regardless of case and
+            ``'*'`` matches any file that has the keyword.
+
+        Returns
+        -------
+
+        list of str
+        """
+        names = [name for name, in self._query('name', kwd)]
+        if include_path:
+            names = [str(self.location / name) for name in names]
+        return names
+
+    def headers(self, **kwd):
+        """
+        Headers, as dictionaries, of the files matching ``kwd``.
+
+        Yields
+        ------
+
+        name, header
+        """
+        for name, header in self._query('name, header', kwd):
+            yield name, json.loads(header)
+
+    def ccds(self, ccd_kwargs=None, **kwd):
+        """
+        Read the files matching ``kwd`` as ``CCDData``.
+
+        ``ccd_kwargs`` are passed to ``CCDData.read``; the unit defaults to
+        ``adu`` as in ``ImageFileCollection.ccds``.
+        """
+        ccd_kwargs = dict(dict(unit='adu'), **(ccd_kwargs or {}))
+        for name in self.files_filtered(include_path=True, **kwd):
+            yield CCDData.read(name, **ccd_kwargs)
+
+    def summary(self, keywords=('imagetyp', 'exptime', 'filter'), **kwd):
+        """
+        Table of some header values for the files matching ``kwd``.
+
+        Parameters
+        ----------
+
+        keywords : list of str, optional
+            Keywords to include; missing values are ``None``.
+
+        Returns
+        -------
+
+        ``astropy.table.Table``
+        """
+        rows = [[name] + [header.get(k.lower()) for k in keywords]
+                for name, header in self.headers(**kwd)]
+        names = ['file'] + [k.lower() for k in keywords]
+        if not rows:
+            return Table(names=names)
+        return Table(rows=rows, names=names)
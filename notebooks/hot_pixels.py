@@ -0,0 +1,223 @@
+"""
+Find hot, warm and non-linear pixels from a set of darks.
+
+In the hot pixel notebook two darks, scaled to dark current, are compared by
+eye. The functions here take any number of darks with different exposure
+times and fit a straight line, counts against exposure time, to every pixel.
+The slope is the dark current, and the intercept and scatter about the line
+show which pixels do not behave linearly. The fit is done with closed-form
+least squares on strips of rows, so the memory used is limited no matter how
+large or how many the darks are.
+"""
+import numpy as np
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+# Flag values in the classification image; a pixel can have more than one.
+WARM = 1
+HOT = 2
+NON_LINEAR = 4
+
+
+def _dark_data(dark):
+    """
+    Array (memory-mapped, for files) with the data for a dark.
+    """
+    if isinstance(dark, CCDData):
+        return dark.data
+    # getdata closes the file; the memory map stays open only as long as
+    # the array is in use.
+    return fits.getdata(dark, memmap=True)
+
+
+def fit_dark_current(darks, exposure_times, gain=1.0, mem_limit=1e9):
+    """
+    Fit counts versus exposure time for each pixel in a stack of darks.
+
+    Parameters
+    ----------
+
+    darks : list of ``CCDData`` or list of str
+        Bias-subtracted darks, or names of files containing them, all the
+        same shape and in ADU.
+
+    exposure_times : list of float
+        Exposure time of each dark, in seconds.
+
+    gain : float, optional
+        Gain of the camera, in electrons/ADU.
+
+    mem_limit : float, optional
+        Approximate limit, in bytes, on the memory used, including the
+        results. At least one row of the stack of darks is always used.
+
+    Returns
+    -------
+
+    slope, intercept, residual : numpy arrays
+        Dark current (electrons/second), counts at zero exposure time
+        (electrons) and the RMS residual about the fit (electrons), for each
+        pixel.
+    """
+    if len(darks) != len(exposure_times):
+        raise ValueError('There must be one exposure time for each dark.')
+    if len(set(exposure_times)) < 2:
+        raise ValueError('At least two different exposure times are needed.')
+
+    data = [_dark_data(dark) for dark in darks]
+    shape = data[0].shape
+
+    times = np.asarray(exposure_times, dtype=np.float64)
+    t_offset = times - times.mean()
+    t_variance = (t_offset ** 2).sum()
+
+    # The memory used is the three results, plus for each strip the stack
+    # of darks and a few arrays the size of one dark in the strip, all
+    # float64. Everything below is done in place or one dark at a time so
+    # that nothing else the size of the stack is made.
+    output_bytes = 3 * 8 * shape[0] * shape[1]
+    bytes_per_row = 8 * shape[1] * (len(data) + 5)
+    rows_per_strip = int(max(1, min(shape[0], (mem_limit - output_bytes) //
+                                    bytes_per_row)))
+
+    slope = np.empty(shape)
+    intercept = np.empty(shape)
+    residual = np.empty(shape)
+    # One buffer for the stack, reused for every strip.
+    buffer = np.empty((len(data), rows_per_strip, shape[1]))
+
+    for start in range(0, shape[0], rows_per_strip):
+        stop = min(start + rows_per_strip, shape[0])
+        stack = buffer[:, :stop - start]
+        for i, dark in enumerate(data):
+            stack[i] = dark[start:stop]
+        stack *= gain
+
+        mean_counts = stack.mean(axis=0)
+        strip_slope = np.zeros_like(mean_counts)
+        for i in range(len(data)):
+            strip_slope += t_offset[i] * (stack[i] - mean_counts)
+        strip_slope /= t_variance
+        strip_intercept = mean_counts - strip_slope * times.mean()
+
+        # What is left in the stack after this is the residual of the fit.
+        for i in range(len(data)):
+            stack[i] -= strip_intercept + strip_slope * times[i]
+        np.square(stack, out=stack)
+
+        slope[start:stop] = strip_slope
+        intercept[start:stop] = strip_intercept
+        residual[start:stop] = np.sqrt(stack.mean(axis=0))
+        # Let these go before the next strip makes its own.
+        del mean_counts, strip_slope, strip_intercept
+
+    return slope, intercept, residual
+
+
+def classify_pixels(slope, residual, exposure_times, hot_threshold=4,
+                    warm_threshold=1, non_linear_fraction=0.1):
+    """
+    Classify pixels from the fit done by `fit_dark_current`.
+
+    Parameters
+    ----------
+
+    slope, residual : numpy arrays
+        Dark current and RMS residual from `fit_dark_current`.
+
+    exposure_times : list of float
+        Exposure times of the darks used in the fit.
+
+    hot_threshold : float, optional
+        Pixels with a dark current above this, in electrons/second, are hot.
+
+    warm_threshold : float, optional
+        Pixels with a dark current above this, in electrons/second, but not
+        hot, are warm.
+
+    non_linear_fraction : float, optional
+        A warm or hot pixel is non-linear if its RMS residual is larger than
+        this fraction of its dark counts in the longest exposure. Needs at
+        least three darks.
+
+    Returns
+    -------
+
+    numpy array of uint8
+        Sum of the flags ``WARM``, ``HOT`` and ``NON_LINEAR`` for each pixel.
+    """
+    flags = np.zeros(slope.shape, dtype=np.uint8)
+    hot = slope > hot_threshold
+    flags[hot] |= HOT
+    flags[(slope > warm_threshold) & ~hot] |= WARM
+
+    # Two darks always fit a line perfectly.
+    if len(exposure_times) > 2:
+        dark_counts = slope * max(exposure_times)
+        non_linear = (residual > non_linear_fraction * np.abs(dark_counts))
+        flags[non_linear & (slope > warm_threshold)] |= NON_LINEAR
+
+    return flags
+
+
+def hot_pixel_mask(darks, exposure_times, gain=1.0, mem_limit=1e9,
+                   mask_flags=HOT | NON_LINEAR, output_mask=None,
+                   output_dark_current=None, overwrite=False,
+                   **classify_kwargs):
+    """
+    Fit the darks, classify the pixels and make a mask.
+
+    Parameters
+    ----------
+
+    darks, exposure_times, gain, mem_limit
+        See `fit_dark_current`.
+
+    mask_flags : int, optional
+        Pixels with any of these flags are masked.
+
+    output_mask : str, optional
+        If given, the mask is written to this file in the same form as the
+        mask made in the hot pixel notebook.
+
+    output_dark_current : str, optional
+        If given, the dark current map is written to this file, with the
+        classification flags in an extension named ``FLAGS``.
+
+    overwrite : bool, optional
+        If ``True``, overwrite existing output files.
+
+    classify_kwargs
+        Passed to `classify_pixels`.
+
+    Returns
+    -------
+
+    mask, dark_current, flags
+        The boolean mask, dark current map as a ``CCDData`` in
+        electrons/second, and the classification flags.
+    """
+    slope, _, residual = fit_dark_current(darks, exposure_times, gain=gain,
+                                          mem_limit=mem_limit)
+    flags = classify_pixels(slope, residual, exposure_times,
+                            **classify_kwargs)
+    mask = (flags & mask_flags) > 0
+
+    dark_current = CCDData(slope, unit=u.electron / u.second)
+    dark_current.header['imagetyp'] = 'dark current'
+    dark_current.header['ndarks'] = len(darks)
+
+    if output_mask is not None:
+        mask_as_ccd = CCDData(data=mask.astype('uint8'),
+                              unit=u.dimensionless_unscaled)
+        mask_as_ccd.header['imagetyp'] = 'dark mask'
+        mask_as_ccd.write(output_mask, overwrite=overwrite)
+
+    if output_dark_current is not None:
+        hdul = dark_current.to_hdu()
+        hdul.append(fits.ImageHDU(flags, name='FLAGS'))
+        hdul.writeto(output_dark_current, overwrite=overwrite)
+
+    return mask, dark_current, flags
@@ -1,3 +1,6 @@
+from functools import lru_cache
+import re
+
 import nbformat as nbf
 from astropy.table import Table
 
@@ -16,14 +19,35 @@ def markdown_cells(nb):
             yield cell
 
 
+@lru_cache(maxsize=8)
+def _compile_renames(renames):
+    # The name each old name ends up with when the renames are applied one
+    # after another, as link_fix used to, so chains like a -> b, b -> c
+    # still turn a into c.
+    final = {}
+    for start, _ in renames:
+        name = start
+        for old, new in renames:
+            if name == old:
+                name = new
+        final[start] = name
+    if not final:
+        return None, final
+    # One alternation of all of the old names, longest first, so each link
+    # is looked up once as the text is scanned.
+    names = sorted(final, key=len, reverse=True)
+    pattern = re.compile(r'\]\((' + '|'.join(map(re.escape, names)) + r')\)')
+    return pattern, final
+
+
 def link_fix(text, name_dict):
     """
     Replace old file names with new in markdown links.
     """
-    new_text = text
-    for old, new in name_dict.items():
-        new_text = new_text.replace(f']({old})', f']({new})')
-    return new_text
+    pattern, final = _compile_renames(tuple(name_dict.items()))
+    if pattern is None:
+        return text
+    return pattern.sub(lambda m: f']({final[m.group(1)]})', text)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,504 @@
+"""
+Execute the notebooks for the book, several at a time.
+
+The calibration notebooks read what earlier notebooks wrote (the reduced
+images in ``example1-reduced`` and ``example2-reduced``, the masks made in
+the masking notebooks and so on), so they can't simply all be run at once.
+`notebook_dependencies` works out which notebooks have to wait for which by
+looking at the files and directories each one reads and writes, and
+`execute_notebooks` runs each notebook, in its own kernel, as soon as the
+ones it depends on have finished.
+
+What a notebook reads and writes is inferred from the path-like strings in
+its code: a string (or a variable set from one) that is the argument of a
+``write``, ``writeto``, ``mkdir`` or ``savefig`` call is written, anything
+else is read. Format templates like ``'combined_dark_{:6.3f}.fit'`` match
+any name they could produce. If a notebook fools this, list what it reads
+and writes in a JSON manifest::
+
+    {"08-03-Cosmic-ray-removal.ipynb": {"reads": ["example2-reduced"],
+                                        "writes": ["example2-reduced"]}}
+
+A notebook that reads something a notebook earlier in the book writes runs
+after it, as does a notebook that writes something an earlier one reads or
+writes, so the results are the same as running them one after another in
+order.
+
+Executed notebooks are cached in ``.notebook_cache``, keyed by a hash of the
+code in the notebook, of the local modules it imports, of the keys of the
+notebooks it depends on and of the size and modification time of the data
+it reads that no notebook writes. A notebook is only run again if one of
+those changes or what it writes is no longer on disk.
+
+Run this as a script in the notebooks directory; the executed notebooks are
+written as ``*.nbconvert.ipynb``, which is what ``process_for_book.py``
+expects.
+"""
+import argparse
+import ast
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+from hashlib import sha256
+import json
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import sys
+
+import nbformat as nbf
+
+DEFAULT_PATTERN = '0[0-8]-??-*.ipynb'
+
+DEFAULT_CACHE_DIR = '.notebook_cache'
+
+# Command that executes one notebook; {notebook} and {output} are filled in.
+NBCONVERT = ('jupyter nbconvert --to notebook --execute '
+             '--ExecutePreprocessor.timeout=-1 --output {output} {notebook}')
+
+# Calls whose arguments are written rather than read. For mkdir the path is
+# the object the method is called on.
+WRITE_METHODS = {'write', 'writeto', 'savefig', 'to_csv'}
+MAKE_DIRECTORY_METHODS = {'mkdir', 'makedirs'}
+
+# Strings passed to these are paths even if nothing is there yet.
+PATH_CALLS = {'Path', 'ImageFileCollection', 'HeaderIndex'}
+
+# Strings with these endings are taken to be data files.
+DATA_EXTENSIONS = ('.fit', '.fits', '.fts', '.fz', '.bz2', '.gz', '.csv',
+                   '.ecsv', '.npy', '.png', '.json')
+
+# Path-like strings: no spaces or other punctuation found in plain text.
+_PATH_LIKE = re.compile(r'^[\w.\-/{}:]+$')
+_FORMAT_FIELD = re.compile(r'\{[^{}]*\}')
+
+
+def _as_pattern(text):
+    # Turn a format template into a glob pattern.
+    return _FORMAT_FIELD.sub('*', text)
+
+
+def _is_resource(text, directory, is_path=False):
+    if not _PATH_LIKE.match(text) or text in ('.', '/'):
+        return False
+    if is_path or text.lower().endswith(DATA_EXTENSIONS):
+        return True
+    return (Path(directory) / text).is_dir()
+
+
+def _join(parts):
+    # Every path made by joining one resource from each non-empty part.
+    joined = {''}
+    for part in parts:
+        if part:
+            joined = {f'{a}/{b}' if a else b for a in joined for b in part}
+    return joined - {''}
+
+
+def _code(notebook):
+    # The code cells, without IPython magics and shell escapes.
+    lines = []
+    for cell in notebook['cells']:
+        if cell['cell_type'] != 'code':
+            continue
+        for line in cell['source'].splitlines():
+            lines.append('' if line.lstrip().startswith(('%', '!'))
+                         else line)
+    return '\n'.join(lines)
+
+
+class _PathVisitor(ast.NodeVisitor):
+    """
+    Collect the resources read and written by a piece of code.
+    """
+    def __init__(self, directory, tree):
+        self.directory = directory
+        self.aliases = {}
+        self.reads = set()
+        self.writes = set()
+        self.modules = set()
+        # Strings given to Path(...) and the like.
+        self._paths = {id(arg) for node in ast.walk(tree)
+                       if isinstance(node, ast.Call) and
+                       getattr(node.func, 'attr',
+                               getattr(node.func, 'id', None)) in PATH_CALLS
+                       for arg in node.args}
+
+    def _resources_in(self, node):
+        # Resources a piece of code names, joining paths built with / or
+        # Path(a, b) so that e.g. reduced_path / 'combined_bias.fit' is
+        # example1-reduced/combined_bias.fit.
+        if isinstance(node, ast.Constant):
+            if (isinstance(node.value, str) and
+                    _is_resource(node.value, self.directory,
+                                 id(node) in self._paths)):
+                return {_as_pattern(node.value)}
+            return set()
+        if isinstance(node, ast.JoinedStr):
+            text = ''.join(part.value if isinstance(part, ast.Constant)
+                           else '*' for part in node.values)
+            if _is_resource(text.replace('*', 'x'), self.directory,
+                            id(node) in self._paths):
+                return {text}
+            return set()
+        if isinstance(node, ast.Name):
+            return set(self.aliases.get(node.id, ()))
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+            return _join([self._resources_in(node.left),
+                          self._resources_in(node.right)])
+        if (isinstance(node, ast.Call) and
+                getattr(node.func, 'id', None) == 'Path'):
+            return _join([self._resources_in(arg) for arg in node.args])
+        found = set()
+        for child in ast.iter_child_nodes(node):
+            found |= self._resources_in(child)
+        return found
+
+    def visit_Assign(self, node):
+        resources = self._resources_in(node.value)
+        for target in node.targets:
+            if isinstance(target, ast.Name) and resources:
+                self.aliases[target.id] = resources
+        self.generic_visit(node)
+
+    def visit_BinOp(self, node):
+        # Record a path built with / as a whole, not its pieces.
+        found = self._resources_in(node) if isinstance(node.op,
+                                                       ast.Div) else None
+        if found:
+            self.reads |= found
+        else:
+            self.generic_visit(node)
+
+    def visit_Call(self, node):
+        method = getattr(node.func, 'attr', getattr(node.func, 'id', None))
+        if method in WRITE_METHODS:
+            # The first argument is where the output goes.
+            for arg in node.args[:1]:
+                self.writes |= self._resources_in(arg)
+            self.visit(node.func)
+            for arg in node.args[1:] + node.keywords:
+                self.visit(arg)
+        elif method in MAKE_DIRECTORY_METHODS:
+            target = getattr(node.func, 'value', None)
+            if isinstance(node.func, ast.Attribute):
+                # path.mkdir()
+                self.writes |= self._resources_in(target)
+            else:
+                # os.makedirs(path)
+                for arg in node.args[:1]:
+                    self.writes |= self._resources_in(arg)
+        elif method == 'Path' and self._resources_in(node):
+            self.reads |= self._resources_in(node)
+        else:
+            self.generic_visit(node)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, str):
+            self.reads |= self._resources_in(node)
+
+    def visit_JoinedStr(self, node):
+        self.reads |= self._resources_in(node)
+
+    def visit_Name(self, node):
+        self.reads.update(self.aliases.get(node.id, ()))
+
+    def visit_Import(self, node):
+        self.modules.update(alias.name.split('.')[0] for alias in node.names)
+
+    def visit_ImportFrom(self, node):
+        if node.module and not node.level:
+            self.modules.add(node.module.split('.')[0])
+
+
+def notebook_io(notebook_file):
+    """
+    Infer what a notebook reads and writes.
+
+    Parameters
+    ----------
+
+    notebook_file : str or ``pathlib.Path``
+        The notebook.
+
+    Returns
+    -------
+
+    dict
+        Sets of resource names under ``reads`` and ``writes``, and the local
+        modules the notebook imports under ``modules``.
+    """
+    notebook_file = Path(notebook_file)
+    directory = notebook_file.parent
+    notebook = nbf.read(str(notebook_file), as_version=4)
+    try:
+        tree = ast.parse(_code(notebook))
+    except SyntaxError:
+        # Fall back to a cell at a time, skipping cells that don't parse.
+        tree = ast.Module(body=[], type_ignores=[])
+        for cell in notebook['cells']:
+            if cell['cell_type'] != 'code':
+                continue
+            try:
+                tree.body.extend(ast.parse(_code(dict(cells=[cell]))).body)
+            except SyntaxError:
+                pass
+    visitor = _PathVisitor(directory, tree)
+    visitor.visit(tree)
+    modules = {name for name in visitor.modules
+               if (directory / f'{name}.py').exists()}
+    return dict(reads=visitor.reads, writes=visitor.writes, modules=modules)
+
+
+def _same_resource(a, b):
+    if a == b or fnmatch(a, b) or fnmatch(b, a):
+        return True
+    # A directory and something in it.
+    if fnmatch(a, b + '/*') or fnmatch(b, a + '/*'):
+        return True
+    # A bare file name and a path; the directory isn't known.
+    if '/' not in a or '/' not in b:
+        base_a, base_b = a.split('/')[-1], b.split('/')[-1]
+        return fnmatch(base_a, base_b) or fnmatch(base_b, base_a)
+    return False
+
+
+def _overlap(these, those):
+    return any(_same_resource(a, b) for a in these for b in those)
+
+
+def notebook_dependencies(notebook_files, manifest=None):
+    """
+    Work out which notebooks have to run before which.
+
+    Parameters
+    ----------
+
+    notebook_files : list of str or ``pathlib.Path``
+        Notebooks, in the order they appear in the book.
+
+    manifest : dict, optional
+        What some notebooks read and write, keyed by notebook file name,
+        used instead of what is inferred from the code. Each value is a
+        dictionary with lists under ``reads`` and ``writes``.
+
+    Returns
+    -------
+
+    io : dict
+        What each notebook reads and writes, as returned by `notebook_io`,
+        keyed by notebook.
+
+    depends_on : dict
+        The set of notebooks each notebook has to wait for.
+    """
+    manifest = manifest or {}
+    notebook_files = [Path(name) for name in notebook_files]
+    io = {}
+    for name in notebook_files:
+        io[name] = notebook_io(name)
+        declared = manifest.get(name.name)
+        if declared is not None:
+            io[name]['reads'] = set(declared.get('reads', ()))
+            io[name]['writes'] = set(declared.get('writes', ()))
+
+    depends_on = {name: set() for name in notebook_files}
+    for later_idx, later in enumerate(notebook_files):
+        for earlier in notebook_files[:later_idx]:
+            before, after = io[earlier], io[later]
+            if (_overlap(before['writes'], after['reads'] | after['writes'])
+                    or _overlap(before['reads'], after['writes'])):
+                depends_on[later].add(earlier)
+    return io, depends_on
+
+
+def _digest_of_file(path):
+    return sha256(Path(path).read_bytes()).hexdigest()
+
+
+def _stat_signature(path):
+    # Size and modification time of a file, or of every file in a directory.
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(p for p in path.rglob('*') if p.is_file())
+    else:
+        files = [path] if path.exists() else []
+    return [(str(p), p.stat().st_size, p.stat().st_mtime_ns) for p in files]
+
+
+def _existing(resources, directory):
+    # Resources that are plain names, as paths; patterns are left out.
+    return [Path(directory) / name for name in resources if '*' not in name]
+
+
+def cache_keys(notebook_files, io, depends_on):
+    """
+    Cache key of each notebook; see the module docstring.
+
+    Returns
+    -------
+
+    dict
+        Hex digest for each notebook.
+    """
+    written_anywhere = set().union(*(entry['writes']
+                                     for entry in io.values()))
+    keys = {}
+    # The notebooks are in book order, so the ones a notebook depends on
+    # already have keys.
+    for name in notebook_files:
+        name = Path(name)
+        notebook = nbf.read(str(name), as_version=4)
+        external = [r for r in io[name]['reads']
+                    if not _overlap([r], written_anywhere)]
+        content = dict(
+            code=[cell['source'] for cell in notebook['cells']
+                  if cell['cell_type'] == 'code'],
+            modules={module: _digest_of_file(name.parent / f'{module}.py')
+                     for module in sorted(io[name]['modules'])},
+            depends_on=sorted(keys[other] for other in depends_on[name]),
+            inputs=[_stat_signature(path) for path in
+                    sorted(_existing(external, name.parent))],
+        )
+        as_text = json.dumps(content, sort_keys=True)
+        keys[name] = sha256(as_text.encode()).hexdigest()
+    return keys
+
+
+def _output_name(notebook_file):
+    return notebook_file.with_name(notebook_file.stem + '.nbconvert.ipynb')
+
+
+def _run(notebook_file, key, writes, cache_dir, command):
+    cached = Path(cache_dir) / f'{key}.ipynb'
+    output = _output_name(notebook_file)
+    outputs_exist = all(path.exists() for path in
+                        _existing(writes, notebook_file.parent))
+    if cached.exists() and outputs_exist:
+        shutil.copyfile(cached, output)
+        return 'cached'
+
+    cmd = command.format(notebook=notebook_file.name, output=output.name)
+    subprocess.run(cmd, shell=True, check=True, cwd=notebook_file.parent,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(output, cached)
+    return 'executed'
+
+
+def execute_notebooks(notebook_files, max_workers=4, manifest=None,
+                      cache_dir=DEFAULT_CACHE_DIR, command=NBCONVERT,
+                      verbose=True):
+    """
+    Execute notebooks, running those that don't depend on each other at the
+    same time.
+
+    Parameters
+    ----------
+
+    notebook_files : list of str or ``pathlib.Path``
+        Notebooks, in the order they appear in the book.
+
+    max_workers : int, optional
+        Most notebooks run at once.
+
+    manifest : dict, optional
+        Declared reads and writes; see `notebook_dependencies`.
+
+    cache_dir : str, optional
+        Directory of executed notebooks, relative to the notebooks.
+
+    command : str, optional
+        Shell command that executes a notebook, with ``{notebook}`` and
+        ``{output}`` in it.
+
+    verbose : bool, optional
+        If ``True``, print each notebook as it finishes.
+
+    Returns
+    -------
+
+    dict
+        For each notebook, ``'executed'``, ``'cached'``, ``'failed'`` or
+        ``'skipped'`` (because a notebook it depends on failed).
+    """
+    notebook_files = [Path(name) for name in notebook_files]
+    io, depends_on = notebook_dependencies(notebook_files, manifest=manifest)
+    keys = cache_keys(notebook_files, io, depends_on)
+    waiting_on = {name: set(deps) for name, deps in depends_on.items()}
+    status = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+
+        def start_ready():
+            for name in notebook_files:
+                if (name not in status and name not in running.values() and
+                        not waiting_on[name]):
+                    cache = name.parent / cache_dir
+                    future = executor.submit(_run, name, keys[name],
+                                             io[name]['writes'], cache,
+                                             command)
+                    running[future] = name
+
+        def skip_dependents(failed):
+            for name in notebook_files:
+                if failed in depends_on[name] and name not in status:
+                    status[name] = 'skipped'
+                    skip_dependents(name)
+
+        start_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    status[name] = future.result()
+                except subprocess.CalledProcessError as error:
+                    status[name] = 'failed'
+                    if verbose:
+                        print(error.stderr.decode(errors='replace'),
+                              file=sys.stderr)
+                    skip_dependents(name)
+                if verbose:
+                    print(f'{status[name]:>8}  {name}')
+                for other in notebook_files:
+                    waiting_on[other].discard(name)
+            start_ready()
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('notebooks', nargs='*',
+                        help='Notebooks to run; by default the chapters '
+                             'of the book')
+    parser.add_argument('--max-workers', type=int, default=4,
+                        help='Most notebooks to run at once')
+    parser.add_argument('--manifest', default=None,
+                        help='JSON file of what notebooks read and write')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='Directory in which executed notebooks are '
+                             'cached')
+    parser.add_argument('--show-dependencies', action='store_true',
+                        help='Print what each notebook waits for and exit')
+    args = parser.parse_args()
+
+    notebooks = args.notebooks or sorted(
+        str(p) for p in Path('.').glob(DEFAULT_PATTERN)
+        if not p.name.endswith('.nbconvert.ipynb'))
+    manifest = None
+    if args.manifest:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+
+    if args.show_dependencies:
+        _, depends_on = notebook_dependencies(notebooks, manifest=manifest)
+        for name, deps in depends_on.items():
+            print(name, '<-', ', '.join(sorted(str(d) for d in deps)))
+    else:
+        status = execute_notebooks(notebooks, max_workers=args.max_workers,
+                                   manifest=manifest,
+                                   cache_dir=args.cache_dir)
+        if any(s in ('failed', 'skipped') for s in status.values()):
+            sys.exit(1)
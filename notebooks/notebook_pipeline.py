@@ -0,0 +1,255 @@
+"""
+Post-process the notebooks for the book in one pass.
+
+``wrap_script.py``, ``link_fix.py``, ``add_matplotlib_style.py``,
+``process_for_book.replace_links_in_notebook`` and
+``add_github_links.github_magic`` each read and write every notebook. Here
+the same changes are registered as transformers, functions that change a
+notebook in place, and `process_notebooks` reads each notebook once, runs
+the chosen transformers on it in order and writes it once, and only if it
+changed. Notebooks are processed in a pool of processes.
+
+A record of the content of each notebook after it was processed, and of
+the steps used, is kept in ``.notebook_pipeline.json`` next to the
+notebooks; a notebook that hasn't changed since it was last processed with
+the same steps is skipped.
+
+Steps are given as names or as ``(name, options)`` pairs, e.g.::
+
+    process_notebooks(Path('.').glob('??-??-*.ipynb'),
+                      ['wrap', ('rename_links', dict(names=names)),
+                       'style_cell'])
+
+New transformers can be added with the `transformer` decorator::
+
+    @transformer('strip_outputs')
+    def strip_outputs(notebook, path):
+        for cell in notebook['cells']:
+            cell.pop('outputs', None)
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+import json
+from pathlib import Path
+
+import nbformat as nbf
+from astropy.table import Table
+
+from add_matplotlib_style import add_style_cell
+from link_fix import link_fix, markdown_cells
+from process_for_book import existing_files, replace_link_urls
+from reduction_cache import params_digest
+from wrap_notebook_lines import wrap_markdown
+
+DEFAULT_STATE = '.notebook_pipeline.json'
+
+# Transformers by name; each is called as
+# function(notebook, path, **options) and changes notebook in place.
+TRANSFORMERS = {}
+
+
+def transformer(name):
+    """
+    Decorator that registers a function as the transformer ``name``.
+    """
+    def register(function):
+        TRANSFORMERS[name] = function
+        return function
+    return register
+
+
+@transformer('wrap')
+def wrap(notebook, path, wrap_at=80):
+    """
+    Wrap markdown lines; see `wrap_notebook_lines.wrap_markdown`.
+    """
+    for cell in markdown_cells(notebook):
+        cell['source'] = wrap_markdown(cell['source'], wrap_at=wrap_at)
+
+
+@transformer('html_links')
+def html_links(notebook, path, old_ext='.ipynb', new_ext='.html'):
+    """
+    Point links between notebooks at the rendered pages; see
+    `process_for_book.replace_link_urls`.
+    """
+    directory = Path(path).parent
+    existing = existing_files(directory)
+    for cell in markdown_cells(notebook):
+        cell['source'] = replace_link_urls(cell['source'], old_ext=old_ext,
+                                           new_ext=new_ext, path=directory,
+                                           verbose=False, existing=existing)
+
+
+@transformer('rename_links')
+def rename_links(notebook, path, names=None,
+                 names_file='old-and-new-names.csv'):
+    """
+    Replace old notebook names with new in links; see `link_fix.link_fix`.
+    """
+    if names is None:
+        names = {k: v for k, v in Table.read(names_file)}
+    for cell in markdown_cells(notebook):
+        cell['source'] = link_fix(cell['source'], names)
+
+
+@transformer('style_cell')
+def style_cell(notebook, path):
+    """
+    Add the matplotlib style cell; see `add_matplotlib_style`.
+    """
+    add_style_cell(notebook)
+
+
+@transformer('comment_links')
+def comment_links(notebook, path, base_urls, original_dir):
+    """
+    Add links for commenting on GitHub after each heading; see
+    `add_github_links.github_magic`.
+
+    ``base_urls`` is the commenting URL for each notebook, by file name, as
+    returned by ``add_github_links.create_pr_for_commenting``; notebooks
+    that aren't in it are left alone.
+    """
+    # Imported here so that github3 is only needed for this step.
+    from add_github_links import add_comment_links, find_headers
+
+    name = Path(path).name
+    if name not in base_urls:
+        return
+    headings = find_headers(str(Path(original_dir) / name),
+                            highest_level=2, lowest_level=3)
+    add_comment_links(notebook, headings, base_urls[name])
+
+
+def _normalize(steps):
+    return [(step, {}) if isinstance(step, str) else (step[0], step[1])
+            for step in steps]
+
+
+def process_notebook(path, steps):
+    """
+    Run the transformers in ``steps`` on one notebook.
+
+    Returns
+    -------
+
+    changed : bool
+        ``True`` if the notebook was changed and written.
+
+    digest : str
+        SHA-256 hex digest of the notebook file after processing.
+    """
+    path = Path(path)
+    original = path.read_text()
+    notebook = nbf.reads(original, as_version=4)
+    for name, options in _normalize(steps):
+        TRANSFORMERS[name](notebook, path, **options)
+
+    new = nbf.writes(notebook)
+    if not new.endswith('\n'):
+        # nbf.write adds a final newline that nbf.writes leaves off.
+        new += '\n'
+    changed = new != original
+    if changed:
+        path.write_text(new)
+    return changed, sha256(new.encode()).hexdigest()
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def process_notebooks(notebooks, steps, max_workers=None,
+                      state_file=None, force=False, verbose=True):
+    """
+    Run the transformers in ``steps`` on each notebook.
+
+    Parameters
+    ----------
+
+    notebooks : iterable of str or ``pathlib.Path``
+        Notebooks to process, all in one directory.
+
+    steps : list
+        Transformer names, or ``(name, options)`` pairs, in the order they
+        are run.
+
+    max_workers : int, optional
+        Number of processes; the default is one per CPU.
+
+    state_file : str, optional
+        Where to keep track of what has been processed; the default is
+        ``.notebook_pipeline.json`` in the directory of the notebooks.
+
+    force : bool, optional
+        If ``True``, process notebooks even if they haven't changed.
+
+    verbose : bool, optional
+        If ``True``, print each notebook that changes.
+
+    Returns
+    -------
+
+    dict
+        ``'changed'``, ``'unchanged'`` or ``'skipped'`` for each notebook.
+    """
+    notebooks = sorted(Path(name) for name in notebooks)
+    if not notebooks:
+        return {}
+    unknown = [name for name, _ in _normalize(steps)
+               if name not in TRANSFORMERS]
+    if unknown:
+        raise ValueError(f'No transformer named {", ".join(unknown)}')
+
+    if state_file is None:
+        state_file = notebooks[0].parent / DEFAULT_STATE
+    state = _load_state(state_file)
+    steps_digest = params_digest(_normalize(steps))
+
+    status = {}
+    to_process = []
+    for path in notebooks:
+        recorded = state.get(path.name, {})
+        current = sha256(path.read_bytes()).hexdigest()
+        if (not force and recorded.get('steps') == steps_digest and
+                recorded.get('digest') == current):
+            status[path] = 'skipped'
+        else:
+            to_process.append(path)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(process_notebook, to_process,
+                               [steps] * len(to_process))
+        for path, (changed, digest) in zip(to_process, results):
+            status[path] = 'changed' if changed else 'unchanged'
+            state[path.name] = dict(steps=steps_digest, digest=digest)
+            if verbose and changed:
+                print(f'Changed {path}')
+
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    # comment_links needs options that can't be given here.
+    parser.add_argument('steps', nargs='+',
+                        choices=sorted(set(TRANSFORMERS) - {'comment_links'}),
+                        help='Transformers to run, in order')
+    parser.add_argument('--pattern', default='??-??-*.ipynb',
+                        help='Notebooks to process')
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='Number of processes')
+    parser.add_argument('--force', action='store_true',
+                        help='Process notebooks even if unchanged')
+    args = parser.parse_args()
+
+    process_notebooks(Path('.').glob(args.pattern), args.steps,
+                      max_workers=args.max_workers, force=args.force)
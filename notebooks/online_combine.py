@@ -0,0 +1,275 @@
+"""
+Build a master calibration frame a frame at a time, as the frames arrive.
+
+``ccdp.combine`` needs all of the frames up front, so a master bias or dark
+has to be rebuilt from scratch every time a new calibration frame is taken.
+The `OnlineCombiner` here keeps a running average (with Welford's method for
+the variance) and a small, fixed-size reservoir of whole frames that is used
+to reject outliers like cosmic rays before they get into the average. Adding
+a frame costs a fixed amount of work per pixel and a master ``CCDData`` can be
+produced at any time.
+
+The reservoir holds whole frames, not a sample for each block of pixels,
+because the center used for clipping has to be per pixel: hot pixels in a
+dark, or bias structure, would otherwise be clipped away. That makes it the
+largest part of the memory used, ``reservoir_size`` float32 copies of a frame
+(1 GB for the default of 16 frames of 4k x 4k), so use a smaller reservoir
+for large sensors.
+"""
+import numpy as np
+
+from astropy.nddata import CCDData, StdDevUncertainty
+
+from compressed_fits import write_reduced
+from nan_combine import MAD_TO_STD, nanmedian
+
+
+class OnlineCombiner:
+    """
+    Running, sigma-clipped average of a sequence of images.
+
+    Clipping is approximate: the center for each pixel is the median of that
+    pixel in a random sample (the reservoir) of the frames added so far, and
+    the deviation is a MAD-based standard deviation pooled over square blocks
+    of pixels, which keeps it stable even when the reservoir is small. No
+    clipping is done until the reservoir holds ``min_frames_to_clip`` frames.
+
+    The center and deviation are recalculated, at a cost proportional to
+    ``reservoir_size`` times the size of a frame, only when a frame goes into
+    the reservoir. That is every frame until it is full, but after that frame
+    ``n`` goes in with probability ``reservoir_size / n``, so over ``N``
+    frames it happens about ``reservoir_size * (1 + ln(N / reservoir_size))``
+    times.
+
+    Parameters
+    ----------
+
+    reservoir_size : int, optional
+        Number of frames kept for estimating the center and deviation. Each
+        takes 4 bytes per pixel.
+
+    block_size : int, optional
+        Size, in pixels, of the square blocks over which the deviation is
+        pooled.
+
+    sigma_clip_low_thresh, sigma_clip_high_thresh : float or None, optional
+        Reject pixels more than this many deviations below/above the center.
+        ``None`` turns off clipping on that side.
+
+    min_frames_to_clip : int, optional
+        Number of frames needed before any clipping is done. Frames added
+        before then are held back and clipped once there are enough of them.
+        Must not be larger than ``reservoir_size``.
+
+    seed : int, optional
+        Seed for the random choice of which frames go in the reservoir.
+    """
+    def __init__(self, reservoir_size=16, block_size=32,
+                 sigma_clip_low_thresh=5, sigma_clip_high_thresh=5,
+                 min_frames_to_clip=5, seed=None):
+        if min_frames_to_clip > reservoir_size:
+            raise ValueError('min_frames_to_clip cannot be larger than '
+                             'reservoir_size.')
+        self.reservoir_size = reservoir_size
+        self.block_size = block_size
+        self.low_thresh = sigma_clip_low_thresh
+        self.high_thresh = sigma_clip_high_thresh
+        self.min_frames_to_clip = min_frames_to_clip
+        self._rng = np.random.default_rng(seed)
+
+        self.n_frames = 0
+        self.header = None
+        self.unit = None
+        self._count = None
+        self._mean = None
+        self._m2 = None
+        self._reservoir = None
+        self._n_reservoir = 0
+        self._center = None
+        self._deviation = None
+        self._pending = []
+
+    def _setup(self, ccd):
+        shape = ccd.shape
+        self.header = ccd.header.copy()
+        self.unit = ccd.unit
+        self._count = np.zeros(shape, dtype=np.int32)
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+        self._reservoir = np.empty((self.reservoir_size,) + shape,
+                                   dtype=np.float32)
+
+    def _block_deviation(self, center):
+        """
+        MAD-based deviation pooled over blocks, expanded back to full size.
+        """
+        sample = self._reservoir[:self._n_reservoir]
+        n, ny, nx = sample.shape
+        b = self.block_size
+        pad_y = -ny % b
+        pad_x = -nx % b
+
+        deviation = np.abs(sample - center)
+        deviation = np.pad(deviation, ((0, 0), (0, pad_y), (0, pad_x)),
+                           constant_values=np.nan)
+        n_by, n_bx = deviation.shape[1] // b, deviation.shape[2] // b
+
+        # Gather all of the values in each block along the first axis.
+        blocks = deviation.reshape(n, n_by, b, n_bx, b)
+        blocks = blocks.transpose(0, 2, 4, 1, 3).reshape(n * b * b, n_by, n_bx)
+        block_mad = MAD_TO_STD * nanmedian(blocks, overwrite_input=True)
+
+        # A new frame is compared to a median of only n frames, which is
+        # itself noisy (its variance is about pi / (2 n) times that of a
+        # single frame). Widen the deviation to match, otherwise a small
+        # reservoir rejects far too many good pixels.
+        block_mad *= np.sqrt(1 + np.pi / (2 * n))
+
+        full = np.repeat(np.repeat(block_mad, b, axis=0), b, axis=1)
+        return full[:ny, :nx]
+
+    def _update_reservoir(self, data):
+        """
+        Reservoir sampling: every frame seen so far has the same chance of
+        being in the reservoir.
+        """
+        if self._n_reservoir < self.reservoir_size:
+            slot = self._n_reservoir
+            self._n_reservoir += 1
+        else:
+            slot = self._rng.integers(0, self.n_frames)
+            if slot >= self.reservoir_size:
+                return
+
+        self._reservoir[slot] = data
+        # The clipping limits only change when the reservoir does.
+        self._center = None
+
+    def _clipping_limits(self):
+        if self._center is None:
+            sample = self._reservoir[:self._n_reservoir]
+            self._center = nanmedian(sample)
+            self._deviation = self._block_deviation(self._center)
+        return self._center, self._deviation
+
+    def add(self, ccd):
+        """
+        Add a frame to the combination.
+
+        Parameters
+        ----------
+
+        ccd : ``CCDData``
+            The frame to add. Pixels in its mask, if it has one, are ignored.
+
+        Returns
+        -------
+
+        int
+            Number of pixels in this frame rejected by clipping.
+        """
+        if self._mean is None:
+            self._setup(ccd)
+        elif ccd.shape != self._mean.shape:
+            raise ValueError('All frames must have the same shape.')
+        elif ccd.unit != self.unit:
+            raise ValueError("Frames don't have the same unit.")
+
+        data = np.asarray(ccd.data, dtype=np.float64)
+        use = ~np.isnan(data)
+        if ccd.mask is not None:
+            use &= ~ccd.mask
+
+        self.n_frames += 1
+        # Masked pixels go in the reservoir as NaN so they are left out of
+        # the clipping limits.
+        self._update_reservoir(np.where(use, data, np.nan))
+
+        if self._n_reservoir < self.min_frames_to_clip:
+            self._pending.append((data, use))
+            return 0
+
+        n_rejected = 0
+        # Frames added before clipping was possible get clipped now.
+        for pending_data, pending_use in self._pending:
+            n_rejected += self._clip_and_accumulate(pending_data, pending_use,
+                                                    self._count, self._mean,
+                                                    self._m2)
+        self._pending = []
+
+        n_rejected += self._clip_and_accumulate(data, use, self._count,
+                                                self._mean, self._m2)
+        return n_rejected
+
+    def _clip_and_accumulate(self, data, use, count, mean, m2, clip=True):
+        """
+        Clip ``data`` and add the pixels that survive to the running
+        count, mean and sum of squared differences, in place.
+        """
+        n_rejected = 0
+        if clip:
+            center, deviation = self._clipping_limits()
+            reject = np.zeros(data.shape, dtype=bool)
+            if self.low_thresh is not None:
+                reject |= data < center - abs(self.low_thresh) * deviation
+            if self.high_thresh is not None:
+                reject |= data > center + self.high_thresh * deviation
+            n_rejected = int((reject & use).sum())
+            use = use & ~reject
+
+        # Welford's update of the mean and sum of squared differences, done
+        # only for the pixels that are used.
+        count += use
+        delta = np.where(use, data - mean, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean += np.where(use, delta / count, 0)
+        m2 += np.where(use, delta * (data - mean), 0)
+
+        return n_rejected
+
+    def to_ccddata(self):
+        """
+        The combined image so far.
+
+        Returns
+        -------
+
+        ``CCDData``
+            The average of the frames added so far. The uncertainty is the
+            standard deviation divided by the square root of the number of
+            frames used at each pixel, as in ``ccdp.combine``, and pixels
+            rejected in every frame are masked.
+        """
+        if self._mean is None:
+            raise RuntimeError('No frames have been added yet.')
+
+        count, mean, m2 = self._count, self._mean, self._m2
+        if self._pending:
+            # Too few frames to clip yet, so just average what there is
+            # without committing any of it to the running totals.
+            count, mean, m2 = count.copy(), mean.copy(), m2.copy()
+            for data, use in self._pending:
+                self._clip_and_accumulate(data, use, count, mean, m2,
+                                          clip=False)
+
+        mask = count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(m2 / count)
+            uncertainty = std / np.sqrt(count)
+        data = np.where(mask, np.nan, mean)
+
+        combined = CCDData(data, unit=self.unit, mask=mask,
+                           uncertainty=StdDevUncertainty(uncertainty),
+                           meta=self.header.copy())
+        combined.meta['ncombine'] = self.n_frames
+        return combined
+
+    def write(self, file_name, overwrite=True, **write_kwargs):
+        """
+        Write the combined image so far to ``file_name``.
+
+        ``write_kwargs`` are passed to `compressed_fits.write_reduced`, e.g.
+        ``compression='RICE_1'``.
+        """
+        write_reduced(self.to_ccddata(), file_name, overwrite=overwrite,
+                      **write_kwargs)
@@ -0,0 +1,200 @@
+"""
+Store masks with one bit per pixel and combine them without unpacking.
+
+The masking notebooks write masks as uint8 images, read them back, convert
+them to boolean and OR them together for every frame. Here masks are packed
+eight pixels to a byte with ``np.packbits``, stored that way in a FITS
+extension, and combined in packed form. They are unpacked to a boolean array
+only when (and where) one is actually needed.
+"""
+import numpy as np
+
+from astropy.io import fits
+
+# Name of the FITS extension that holds the packed mask.
+PACKED_EXTENSION = 'PACKMASK'
+
+# Number of set bits in each possible byte value, for numpy versions without
+# np.bitwise_count.
+_BITS_IN_BYTE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis],
+                              axis=1).sum(axis=1)
+
+
+class PackedMask:
+    """
+    A 2D boolean mask stored with each row packed into bytes.
+
+    Parameters
+    ----------
+
+    packed : numpy array of uint8
+        Packed rows, as returned by ``np.packbits(mask, axis=1)``.
+
+    shape : tuple of int
+        Shape of the unpacked mask.
+    """
+    def __init__(self, packed, shape):
+        self.packed = np.asarray(packed, dtype=np.uint8)
+        self.shape = tuple(shape)
+        if self.packed.shape != (shape[0], (shape[1] + 7) // 8):
+            raise ValueError('Packed array does not match the mask shape.')
+
+    @classmethod
+    def from_bool(cls, mask):
+        """
+        Pack a boolean (or zero/non-zero) array.
+        """
+        mask = np.asarray(mask)
+        return cls(np.packbits(mask.astype(bool), axis=1), mask.shape)
+
+    def _check_shape(self, other):
+        if not isinstance(other, PackedMask):
+            other = PackedMask.from_bool(other)
+        if other.shape != self.shape:
+            raise ValueError('Masks have different shapes.')
+        return other
+
+    def __or__(self, other):
+        other = self._check_shape(other)
+        return PackedMask(self.packed | other.packed, self.shape)
+
+    def __and__(self, other):
+        other = self._check_shape(other)
+        return PackedMask(self.packed & other.packed, self.shape)
+
+    def __ior__(self, other):
+        other = self._check_shape(other)
+        self.packed |= other.packed
+        return self
+
+    def __invert__(self):
+        inverted = ~self.packed
+        # Clear the padding bits at the end of each row so they don't count
+        # as masked pixels.
+        n_extra = -self.shape[1] % 8
+        if n_extra:
+            inverted[:, -1] &= np.uint8((0xFF << n_extra) & 0xFF)
+        return PackedMask(inverted, self.shape)
+
+    def __eq__(self, other):
+        try:
+            other = self._check_shape(other)
+        except ValueError:
+            return False
+        return np.array_equal(self.packed, other.packed)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def sum(self):
+        """
+        Number of masked pixels.
+        """
+        # Padding bits are always zero, so they don't affect the count.
+        try:
+            return int(np.bitwise_count(self.packed).sum())
+        except AttributeError:
+            return int(_BITS_IN_BYTE[self.packed].sum())
+
+    def unpack(self, rows=slice(None), cols=slice(None)):
+        """
+        Unpack all of the mask, or only part of it, to a boolean array.
+
+        Parameters
+        ----------
+
+        rows, cols : slice, optional
+            The region of the mask to unpack. Only the bytes needed for that
+            region are unpacked.
+
+        Returns
+        -------
+
+        numpy array of bool
+        """
+        row_start, row_stop, _ = rows.indices(self.shape[0])
+        col_start, col_stop, _ = cols.indices(self.shape[1])
+        byte_start = col_start // 8
+        byte_stop = (col_stop + 7) // 8
+        unpacked = np.unpackbits(self.packed[row_start:row_stop,
+                                             byte_start:byte_stop], axis=1)
+        offset = byte_start * 8
+        return unpacked[:, col_start - offset:col_stop - offset].astype(bool)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.unpack()
+        return mask if dtype is None else mask.astype(dtype)
+
+
+def write_packed_mask(mask, file_name, header=None, overwrite=False):
+    """
+    Write a mask to a FITS file with the packed mask in an extension.
+
+    Parameters
+    ----------
+
+    mask : numpy array or `PackedMask`
+        The mask to write.
+
+    file_name : str or ``pathlib.Path``
+        Name of the file.
+
+    header : ``astropy.io.fits.Header`` or dict, optional
+        Keywords, like ``imagetyp``, for the primary header.
+
+    overwrite : bool, optional
+        If ``True``, overwrite an existing file.
+    """
+    if not isinstance(mask, PackedMask):
+        mask = PackedMask.from_bool(mask)
+
+    primary = fits.PrimaryHDU(header=fits.Header(header or {}))
+    packed = fits.ImageHDU(mask.packed, name=PACKED_EXTENSION)
+    packed.header['masknx'] = (mask.shape[1], 'Width of the unpacked mask')
+    packed.header['maskny'] = (mask.shape[0], 'Height of the unpacked mask')
+    fits.HDUList([primary, packed]).writeto(file_name, overwrite=overwrite)
+
+
+def read_mask(file_name):
+    """
+    Read a mask written by `write_packed_mask` or stored as an image (like
+    the uint8 masks written in the masking notebooks).
+
+    Parameters
+    ----------
+
+    file_name : str or ``pathlib.Path``
+        Name of the file.
+
+    Returns
+    -------
+
+    `PackedMask`
+    """
+    with fits.open(file_name) as hdul:
+        try:
+            hdu = hdul[PACKED_EXTENSION]
+        except KeyError:
+            return PackedMask.from_bool(hdul[0].data)
+        shape = (hdu.header['maskny'], hdu.header['masknx'])
+        return PackedMask(hdu.data, shape)
+
+
+def combine_mask_files(*file_names):
+    """
+    OR together the masks in several files.
+
+    Returns
+    -------
+
+    `PackedMask`
+    """
+    combined = None
+    for file_name in file_names:
+        mask = read_mask(file_name)
+        if combined is None:
+            combined = mask
+        else:
+            combined |= mask
+    return combined
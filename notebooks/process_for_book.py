@@ -1,16 +1,17 @@
+from functools import lru_cache
+import os
 from pathlib import Path
 import shutil
 import re
 
 import nbformat as nbf
 
-from wrap_notebook_lines import find_links
+from wrap_notebook_lines import MARKDOWN_LINK
 from link_fix import markdown_cells
 
 input_nb_pattern = r'0[0123].*.ipynb'
 
 p = Path('.')
-(p / 'converted').mkdir(exist_ok=True)
 input_notebooks = p.glob(input_nb_pattern)
 
 
@@ -48,12 +49,8 @@ def clean():
 
 # CONVERT TO NOTEBOOK AND EXECUTE
 
-#later...
-# set to_conv (find . -depth 1 -name 0[01234568]-\?\?-\*.ipynb | sort -)
-
-# for conv in $to_conv
-#   jupyter nbconvert --to notebook --execute --ExecutePreprocessor.timeout=-1 $conv
-# end
+# Run notebook_executor.py first; it executes the notebooks, several at a
+# time where they don't depend on each other, and writes *.nbconvert.ipynb.
 
 # Fix names
 
@@ -76,8 +73,25 @@ def transform_names(old_names):
     return new_names
 
 
+@lru_cache(maxsize=None)
+def _extension_pattern(old_ext):
+    # This regex will be used to search the *url* part of a markdown link
+    # only. It matches either a url that ends with old_ext or a url that has
+    # old_ext# in it. That way links that include anchors will be
+    # transformed.
+    return re.compile(r'.+' + old_ext + '$|.+' + old_ext + '#.*')
+
+
+def existing_files(path='.'):
+    """
+    Names of everything in the directory ``path``, to pass to
+    `replace_link_urls` when it is called for many cells.
+    """
+    return frozenset(os.listdir(path))
+
+
 def replace_link_urls(text, old_ext='.ipynb', new_ext='.html', path='.',
-                      verbose=True):
+                      verbose=True, existing=None):
     """
     Replace markdown links whose name exactly matches a local file with
     extension ``old_ext`` with a new link that ends ``new_ext``.
@@ -103,57 +117,64 @@ def replace_link_urls(text, old_ext='.ipynb', new_ext='.html', path='.',
 
     verbose: bool, optional
         If ``True``, print a message whenever a link is replaced.
+
+    existing : set of str, optional
+        Names of the files in ``path``, as returned by `existing_files`. If
+        not given the directory is listed on each call.
     """
     p = Path(path)
+    if existing is None:
+        existing = existing_files(p)
 
-    # Identify the markdown links first. This vastly simplifies the regex
-    # needed later for identifying links we may need to transform.
-    links = find_links(text)
+    match_ext = _extension_pattern(old_ext)
 
-    new_text = text
+    def exists(uri):
+        # Only links into other directories need to look at the disk.
+        if '/' in uri or os.sep in uri:
+            return (p / uri).exists()
+        return uri in existing
 
-    # This regex will be used to search the *url* part of a markdown link only.
-    # It matches either a url that ends with old_ext or a url that has old_ext#
-    # in it. That way links that include anchors will be transformed.
-    match_ext = re.compile(r'.+' + old_ext + '$|.+' + old_ext + '#.*')
-
-    # Work from the end towards the beginning of the string so
-    # that indexes don't get messed up as we work.
-    for link in links[::-1]:
+    def new_link(link):
         url = Path(link['link_url'])
         if str(url).count('#') > 1:
             raise ValueError(f'Do not know how to handle '
-                             'link {url} with so many #')
+                             f'link {url} with so many #')
         try:
             uri, anchor = str(url).split('#')
         except ValueError:
             uri = str(url)
             anchor = ''
 
-        if match_ext.findall(str(url)) and (p / uri).exists():
-            # Do not do a straight-up replace of old_ext with new_ext in case
-            # someone tries something "clever" like foo.ipynb.ipynb.
-            if anchor:
-                new_url = '#'.join([str(url.with_suffix(new_ext)), anchor])
-            else:
-                new_url = str(url.with_suffix(new_ext))
-            if verbose:
-                print(f'Replacing {url}  ------>  {new_url}')
-            new_text = (new_text[:link.start('link_url')] + str(new_url) +
-                        new_text[link.end('link_url'):])
+        if not (match_ext.findall(str(url)) and exists(uri)):
+            return link.group(0)
+
+        # Do not do a straight-up replace of old_ext with new_ext in case
+        # someone tries something "clever" like foo.ipynb.ipynb.
+        if anchor:
+            new_url = '#'.join([str(url.with_suffix(new_ext)), anchor])
+        else:
+            new_url = str(url.with_suffix(new_ext))
+        if verbose:
+            print(f'Replacing {url}  ------>  {new_url}')
+        start, end = (index - link.start() for index in link.span('link_url'))
+        return link.group(0)[:start] + new_url + link.group(0)[end:]
 
-    return new_text
+    # Each link is rewritten as the text is scanned, so the text is only
+    # rebuilt once.
+    return MARKDOWN_LINK.sub(new_link, text)
 
 
 def replace_links_in_notebook(nb_file):
     notebook = nbf.read(nb_file, as_version=4)
+    existing = existing_files(Path(nb_file).parent)
     for cell in markdown_cells(notebook):
-        cell['source'] = replace_link_urls(cell['source'])
+        cell['source'] = replace_link_urls(cell['source'], existing=existing)
     with open(nb_file, 'w') as f:
         nbf.write(notebook, f)
 
 
 if __name__ == "__main__":
+    (p / 'converted').mkdir(exist_ok=True)
     converted_nb_pattern = '*.nbconvert.ipynb'
 
     old_names = [n for n in p.glob(converted_nb_pattern)]
@@ -0,0 +1,462 @@
+"""
+Fit a PSF model to many stars at once.
+
+Stars close enough that their light overlaps are put in a group and fit
+together; stars in different groups are fit independently. Rather than
+fitting one group at a time, groups with the same number of stars are
+stacked into arrays and fit together with a Levenberg-Marquardt loop in which
+every step is a batch of small linear solves. The model and its derivatives
+come from the same ``CircularGaussianPSF`` that `image_sim.stars` uses to
+make simulated stars, so fits to simulated images can be checked against
+the input positions and fluxes (see `benchmark`).
+
+Chunks of groups can be fit in separate processes, and so can whole frames
+(`fit_files`). The time spent fitting is stored with the results, per star,
+to help estimate how long a larger job will take; `benchmark_files` times a
+whole set of frames.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import math
+import time
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from astropy.nddata import CCDData
+from astropy.table import Table
+from photutils.psf import CircularGaussianPSF
+
+from multi_aperture import extract_stamps
+
+# Number of parameters fit for each star: flux, x_0 and y_0.
+N_PARAMS = 3
+
+
+def group_stars(positions, group_distance):
+    """
+    Put stars that are close to each other in the same group.
+
+    Two stars closer than ``group_distance`` are in the same group, and so
+    are stars linked through a chain of such pairs.
+
+    Parameters
+    ----------
+
+    positions : numpy array
+        (x, y) positions, shape ``(n, 2)``.
+
+    group_distance : float
+        Separation, in pixels, below which stars are grouped.
+
+    Returns
+    -------
+
+    numpy array of int
+        Group number of each star.
+    """
+    n = len(positions)
+    pairs = cKDTree(positions).query_pairs(group_distance,
+                                           output_type='ndarray')
+    links = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n, n))
+    _, groups = connected_components(links, directed=False)
+    return groups
+
+
+def _psf_and_jacobian(x, y, params, fwhm):
+    """
+    Model of each group and its derivatives with respect to the parameters.
+
+    ``x`` and ``y`` are ``(groups, pixels)`` and ``params`` is ``(groups,
+    stars, 3)``. Returns the model, ``(groups, pixels)``, and the Jacobian,
+    ``(groups, pixels, stars * 3)``.
+    """
+    flux, x_0, y_0 = (params[..., i, np.newaxis] for i in range(N_PARAMS))
+    x = x[:, np.newaxis, :]
+    y = y[:, np.newaxis, :]
+    psf = CircularGaussianPSF(fwhm=fwhm)
+    model = psf.evaluate(x, y, flux, x_0, y_0, fwhm).sum(axis=1)
+    # The last derivative is for the FWHM, which is not fit.
+    derivs = CircularGaussianPSF.fit_deriv(x, y, flux, x_0, y_0, fwhm)
+    jacobian = np.stack(derivs[:N_PARAMS], axis=-1)
+    n_groups, n_stars, n_pixels, _ = jacobian.shape
+    jacobian = jacobian.transpose(0, 2, 1, 3).reshape(n_groups, n_pixels,
+                                                      n_stars * N_PARAMS)
+    return model, jacobian
+
+
+def _batched_solve(matrix, vector):
+    try:
+        return np.linalg.solve(matrix, vector[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        # Some group's matrix is singular, e.g. a star with no good pixels.
+        return (np.linalg.pinv(matrix) @ vector[..., np.newaxis])[..., 0]
+
+
+def fit_groups(x, y, data, weight, params, fwhm, maxiters=30, rtol=1e-6):
+    """
+    Fit groups that all have the same number of stars.
+
+    Parameters
+    ----------
+
+    x, y : numpy arrays
+        Pixel coordinates of the pixels fit for each group, shape
+        ``(groups, pixels)``.
+
+    data : numpy array
+        Background-subtracted values of those pixels.
+
+    weight : numpy array
+        Weight of each pixel in the fit; zero for pixels that should not be
+        used.
+
+    params : numpy array
+        Initial flux, x and y of each star, shape ``(groups, stars, 3)``.
+
+    fwhm : float
+        FWHM of the PSF.
+
+    maxiters : int, optional
+        Maximum number of iterations.
+
+    rtol : float, optional
+        A group has converged when no step changes its chi-squared by more
+        than this fraction.
+
+    Returns
+    -------
+
+    params, errors, converged
+        Fitted parameters and their uncertainties, both ``(groups, stars,
+        3)``, and whether each group converged.
+    """
+    n_groups, n_stars, _ = params.shape
+    params = params.astype(np.float64).copy()
+    damping = np.full(n_groups, 1e-3)
+    converged = np.zeros(n_groups, dtype=bool)
+
+    model, jacobian = _psf_and_jacobian(x, y, params, fwhm)
+    chi2 = (weight * (data - model) ** 2).sum(axis=1)
+
+    for _ in range(maxiters):
+        active = ~converged
+        if not active.any():
+            break
+        jac = jacobian[active]
+        weighted_jac = weight[active, :, np.newaxis] * jac
+        normal = weighted_jac.transpose(0, 2, 1) @ jac
+        gradient = (weighted_jac *
+                    (data[active] - model[active])[..., np.newaxis]).sum(1)
+
+        diagonal = np.einsum('gii->gi', normal)
+        damped = normal + ((damping[active, np.newaxis] * diagonal)
+                           [..., np.newaxis] * np.eye(normal.shape[-1]))
+        step = _batched_solve(damped, gradient)
+
+        trial = params[active] + step.reshape(-1, n_stars, N_PARAMS)
+        trial_model, trial_jacobian = _psf_and_jacobian(
+            x[active], y[active], trial, fwhm)
+        trial_chi2 = (weight[active] *
+                      (data[active] - trial_model) ** 2).sum(axis=1)
+
+        # Accept the steps that improved the fit and damp the others more.
+        better = trial_chi2 <= chi2[active]
+        change = np.abs(chi2[active] - trial_chi2) / np.maximum(
+            chi2[active], np.finfo(float).tiny)
+        idx = np.flatnonzero(active)
+        accepted = idx[better]
+        params[accepted] = trial[better]
+        model[accepted] = trial_model[better]
+        jacobian[accepted] = trial_jacobian[better]
+        chi2[accepted] = trial_chi2[better]
+        damping[idx] = np.where(better, damping[idx] / 10, damping[idx] * 10)
+        converged[idx] = (better & (change < rtol)) | (damping[idx] > 1e10)
+
+    # Covariance from the undamped normal matrix, scaled by the reduced
+    # chi-squared since the weights are only relative.
+    weighted_jac = weight[..., np.newaxis] * jacobian
+    normal = weighted_jac.transpose(0, 2, 1) @ jacobian
+    covariance = np.linalg.pinv(normal)
+    n_pixels = (weight > 0).sum(axis=1)
+    dof = np.maximum(n_pixels - n_stars * N_PARAMS, 1)
+    scale = chi2 / dof
+    errors = np.sqrt(np.abs(np.einsum('gii->gi', covariance)) *
+                     scale[:, np.newaxis])
+
+    return params, errors.reshape(n_groups, n_stars, N_PARAMS), converged
+
+
+def _group_arrays(data, error, mask, positions, members, half_size):
+    """
+    Pixels, values and weights for a set of groups with the same size.
+    """
+    n_groups, n_stars = members.shape
+    centers = np.round(positions[members.ravel()]).astype(int)
+    offsets = np.arange(-half_size, half_size + 1)
+    x = (centers[:, 0, np.newaxis, np.newaxis] +
+         offsets[np.newaxis, :]).repeat(len(offsets), axis=1)
+    y = (centers[:, 1, np.newaxis, np.newaxis] +
+         offsets[:, np.newaxis]).repeat(len(offsets), axis=2)
+    x = x.reshape(n_groups, -1)
+    y = y.reshape(n_groups, -1)
+
+    good = np.ones(data.shape, dtype=bool) if mask is None else ~mask
+    values = extract_stamps(data, centers, half_size).reshape(n_groups, -1)
+    weight = extract_stamps(good, centers, half_size).reshape(n_groups, -1)
+    weight = weight.astype(np.float64)
+    if error is not None:
+        variance = extract_stamps(error ** 2, centers, half_size)
+        variance = variance.reshape(n_groups, -1)
+        with np.errstate(divide='ignore'):
+            weight = np.where(variance > 0, weight / variance, 0)
+
+    # The stamps of stars in a group can overlap; count each pixel once.
+    ny, nx = data.shape
+    pixel_id = np.where((x >= 0) & (x < nx) & (y >= 0) & (y < ny),
+                        y * nx + x, -1)
+    for row in range(n_groups):
+        _, inverse, counts = np.unique(pixel_id[row], return_inverse=True,
+                                       return_counts=True)
+        weight[row] /= counts[inverse]
+
+    return x.astype(np.float64), y.astype(np.float64), values, weight
+
+
+def fit_stars(data, positions, fwhm, error=None, mask=None, fit_size=None,
+              group_distance=None, max_workers=1, chunk_size=2000,
+              maxiters=30):
+    """
+    Fit the PSF to stars in an image.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        Background-subtracted image.
+
+    positions : numpy array
+        Initial (x, y) positions of the stars, shape ``(n, 2)``.
+
+    fwhm : float
+        FWHM of the PSF, in pixels; it is not fit.
+
+    error : numpy array, optional
+        Uncertainty of each pixel, used to weight the fit.
+
+    mask : numpy array of bool, optional
+        Pixels to leave out of the fit.
+
+    fit_size : int, optional
+        Size of the square of pixels fit around each star; the default is
+        ``2 * ceil(fwhm) + 1``.
+
+    group_distance : float, optional
+        Stars closer than this are fit together; the default is
+        ``fit_size``, so stars whose fit regions overlap are grouped.
+
+    max_workers : int or None, optional
+        Number of processes among which chunks of groups are shared. The
+        default, 1, fits everything in this process; ``None`` uses all of
+        the CPUs.
+
+    chunk_size : int, optional
+        Number of groups sent to a process at once.
+
+    maxiters : int, optional
+        Maximum number of iterations; see `fit_groups`.
+
+    Returns
+    -------
+
+    ``astropy.table.Table``
+        One row per star with its group, the fitted flux and position and
+        their uncertainties, and whether the fit converged. ``meta`` has the
+        total fitting time (``FITTIME``) and the time per star
+        (``TPERSTAR``), in seconds.
+    """
+    start_time = time.perf_counter()
+    data = np.asarray(data, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    if fit_size is None:
+        fit_size = 2 * math.ceil(fwhm) + 1
+    half_size = fit_size // 2
+    if group_distance is None:
+        group_distance = fit_size
+
+    groups = group_stars(positions, group_distance)
+    group_sizes = np.bincount(groups)
+
+    # Initial fluxes are the sums over each star's stamp.
+    centers = np.round(positions).astype(int)
+    flux_init = extract_stamps(data, centers, half_size).sum(axis=1)
+    initial = np.column_stack([flux_init, positions])
+
+    # Work is done in chunks of groups that all have the same size.
+    order = np.argsort(groups, kind='stable')
+    chunks = []
+    for size in np.unique(group_sizes):
+        group_ids = np.flatnonzero(group_sizes == size)
+        members = order[np.isin(groups[order], group_ids)].reshape(-1, size)
+        for chunk_start in range(0, len(members), chunk_size):
+            chunk = members[chunk_start:chunk_start + chunk_size]
+            arrays = _group_arrays(data, error, mask, positions, chunk,
+                                   half_size)
+            chunks.append((chunk, arrays + (initial[chunk],)))
+
+    if max_workers == 1:
+        results = [fit_groups(*arrays, fwhm, maxiters=maxiters)
+                   for _, arrays in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fit_groups, *arrays, fwhm,
+                                       maxiters=maxiters)
+                       for _, arrays in chunks]
+            results = [future.result() for future in futures]
+
+    fitted = np.empty((len(positions), N_PARAMS))
+    errors = np.empty((len(positions), N_PARAMS))
+    converged = np.empty(len(positions), dtype=bool)
+    for (chunk, _), (params, param_errors, chunk_converged) in zip(chunks,
+                                                                   results):
+        fitted[chunk.ravel()] = params.reshape(-1, N_PARAMS)
+        errors[chunk.ravel()] = param_errors.reshape(-1, N_PARAMS)
+        converged[chunk.ravel()] = np.repeat(chunk_converged, chunk.shape[1])
+
+    result = Table()
+    result['id'] = np.arange(1, len(positions) + 1)
+    result['group_id'] = groups + 1
+    result['group_size'] = group_sizes[groups]
+    result['x_init'] = positions[:, 0]
+    result['y_init'] = positions[:, 1]
+    result['flux_init'] = flux_init
+    result['x_fit'] = fitted[:, 1]
+    result['y_fit'] = fitted[:, 2]
+    result['flux_fit'] = fitted[:, 0]
+    result['x_err'] = errors[:, 1]
+    result['y_err'] = errors[:, 2]
+    result['flux_err'] = errors[:, 0]
+    result['converged'] = converged
+
+    elapsed = time.perf_counter() - start_time
+    result.meta['FITTIME'] = elapsed
+    result.meta['TPERSTAR'] = elapsed / max(len(positions), 1)
+    return result
+
+
+def _fit_file(file_name, positions, fwhm, fit_kwargs):
+    ccd = CCDData.read(file_name)
+    result = fit_stars(ccd.data, positions, fwhm, mask=ccd.mask,
+                       max_workers=1, **fit_kwargs)
+    result.meta['FILE'] = str(file_name)
+    return result
+
+
+def fit_files(files, positions, fwhm, max_workers=None, **fit_kwargs):
+    """
+    Fit the PSF to the same stars in many frames, one process per frame.
+
+    Parameters
+    ----------
+
+    files : list of str
+        Background-subtracted images.
+
+    positions : numpy array or list of numpy arrays
+        Initial (x, y) positions of the stars, either the same for every
+        frame or one array per frame.
+
+    fwhm : float
+        FWHM of the PSF.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    fit_kwargs
+        Passed to `fit_stars`.
+
+    Returns
+    -------
+
+    list of ``astropy.table.Table``
+        The results for each frame.
+    """
+    files = [str(f) for f in files]
+    if isinstance(positions, np.ndarray) and positions.ndim == 2:
+        positions = [positions] * len(files)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_fit_file, name, xy, fwhm, fit_kwargs)
+                   for name, xy in zip(files, positions)]
+        return [future.result() for future in futures]
+
+
+def benchmark_files(files, positions, fwhm, max_workers=None, **fit_kwargs):
+    """
+    Time `fit_files` on a set of frames.
+
+    The parameters are the same as for `fit_files`.
+
+    Returns
+    -------
+
+    dict
+        Number of frames and stars fit, the total time in seconds and the
+        time per star, which includes starting the processes and reading
+        the files.
+    """
+    start_time = time.perf_counter()
+    results = fit_files(files, positions, fwhm, max_workers=max_workers,
+                        **fit_kwargs)
+    elapsed = time.perf_counter() - start_time
+
+    n_stars = sum(len(result) for result in results)
+    return dict(
+        n_frames=len(results),
+        n_stars=n_stars,
+        time=elapsed,
+        time_per_star=elapsed / max(n_stars, 1),
+    )
+
+
+def benchmark(shape=(2048, 2048), n_stars=2000, fwhm=4, noise=5,
+              min_separation=4, seed=0):
+    """
+    Fit a simulated image and compare the results to the input stars.
+
+    The stars are made the same way as in `image_sim.stars`, but closer
+    together so that many of them have to be fit in groups.
+
+    Returns
+    -------
+
+    dict
+        Time per star, and the median absolute errors in position (pixels)
+        and flux (fraction).
+    """
+    from photutils.datasets import make_model_image, make_model_params
+
+    truth = make_model_params(shape, n_sources=n_stars, flux=(5e3, 5e4),
+                              min_separation=min_separation, border_size=20,
+                              seed=seed)
+    psf = CircularGaussianPSF(fwhm=fwhm)
+    image = make_model_image(shape, psf, truth)
+    rng = np.random.default_rng(seed)
+    image = image + rng.normal(scale=noise, size=shape)
+
+    # Start from positions that are a little off, as from a detection step.
+    true_xy = np.array([truth['x_0'], truth['y_0']]).T
+    start_xy = true_xy + rng.normal(scale=0.3, size=true_xy.shape)
+    result = fit_stars(image, start_xy, fwhm)
+
+    return dict(
+        time_per_star=result.meta['TPERSTAR'],
+        n_groups=len(np.unique(result['group_id'])),
+        position_error=float(np.median(np.hypot(
+            result['x_fit'] - truth['x_0'], result['y_fit'] - truth['y_0']))),
+        flux_error=float(np.median(np.abs(
+            result['flux_fit'] / truth['flux'] - 1))),
+    )
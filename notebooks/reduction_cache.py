@@ -0,0 +1,176 @@
+"""
+Skip reduction steps whose inputs have not changed.
+
+Re-running the calibration notebooks rewrites every file in the reduced
+directories even when nothing changed. The `ReductionManifest` here records,
+for each output file, a hash of the content of its inputs (raw frame, master
+frames) and of the parameters used to make it. An output is rebuilt only if
+it is missing or that hash has changed, so changing one master flat only
+rebuilds the images calibrated with that flat.
+
+A typical loop looks like this::
+
+    manifest = ReductionManifest(reduced_path)
+    for ccd, name in ifc.ccds(imagetyp='light', return_fname=True):
+        inputs = [raw_path / name, master_bias, master_flat]
+        if manifest.is_up_to_date(name, inputs, params):
+            continue
+        ...calibrate and write...
+        manifest.record(name, inputs, params)
+    manifest.save()
+
+It is a little more efficient to check before reading the image, e.g. by
+looping over ``ifc.files_filtered`` instead of ``ifc.ccds``.
+"""
+from hashlib import sha256
+import json
+from pathlib import Path
+
+# Name of the manifest file in the output directory.
+DEFAULT_MANIFEST = 'reduction_manifest.json'
+
+# Files are hashed in chunks of this many bytes.
+CHUNK_SIZE = 2**22
+
+
+def file_digest(path):
+    """
+    SHA-256 hex digest of the content of a file.
+    """
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_digest(params):
+    """
+    SHA-256 hex digest of a dictionary of parameters.
+
+    Values that JSON cannot handle (like quantities) are converted to strings.
+    """
+    as_text = json.dumps(params, sort_keys=True, default=str)
+    return sha256(as_text.encode()).hexdigest()
+
+
+class ReductionManifest:
+    """
+    Record of which inputs and parameters produced each output file.
+
+    Parameters
+    ----------
+
+    directory : str or ``pathlib.Path``
+        Directory containing the output files; the manifest is stored here too.
+
+    manifest_name : str, optional
+        Name of the manifest file.
+    """
+    def __init__(self, directory, manifest_name=DEFAULT_MANIFEST):
+        self.directory = Path(directory)
+        self.path = self.directory / manifest_name
+        if self.path.exists():
+            with open(self.path) as f:
+                stored = json.load(f)
+        else:
+            stored = {}
+        self.outputs = stored.get('outputs', {})
+        # Digests of files keyed by path, along with the modification time
+        # and size they had when hashed, so that unchanged files are not
+        # hashed again.
+        self._digests = stored.get('digests', {})
+
+    def digest(self, path):
+        """
+        Digest of the file at ``path``, re-hashing only if it has changed.
+        """
+        path = Path(path)
+        stat = path.stat()
+        key = str(path.resolve())
+        cached = self._digests.get(key)
+        if (cached is not None and cached['mtime_ns'] == stat.st_mtime_ns and
+                cached['size'] == stat.st_size):
+            return cached['digest']
+
+        digest = file_digest(path)
+        self._digests[key] = dict(mtime_ns=stat.st_mtime_ns,
+                                  size=stat.st_size, digest=digest)
+        return digest
+
+    def _key(self, inputs, params):
+        combined = sha256()
+        for path in inputs:
+            combined.update(self.digest(path).encode())
+        combined.update(params_digest(params or {}).encode())
+        return combined.hexdigest()
+
+    def is_up_to_date(self, output, inputs, params=None):
+        """
+        Check whether ``output`` exists and was made from these inputs and
+        parameters.
+
+        Parameters
+        ----------
+
+        output : str
+            Name of the output file, relative to the manifest directory.
+
+        inputs : list of str or ``pathlib.Path``
+            Every file the output depends on. The order matters.
+
+        params : dict, optional
+            Parameters that affect the output.
+
+        Returns
+        -------
+
+        bool
+            ``True`` if the output does not need to be rebuilt.
+        """
+        output_path = self.directory / output
+        entry = self.outputs.get(str(output))
+        if entry is None or not output_path.exists():
+            return False
+
+        # The output itself may have been replaced by hand or by a
+        # different step.
+        if self.digest(output_path) != entry['output_digest']:
+            return False
+
+        try:
+            return self._key(inputs, params) == entry['key']
+        except FileNotFoundError:
+            return False
+
+    def record(self, output, inputs, params=None):
+        """
+        Record that ``output`` was just made from ``inputs`` and ``params``.
+
+        Parameters are the same as for `is_up_to_date`.
+        """
+        self.outputs[str(output)] = dict(
+            key=self._key(inputs, params),
+            # Stored resolved, like the digests, so that stale_outputs does
+            # not depend on the directory it is called from.
+            inputs=[str(Path(p).resolve()) for p in inputs],
+            output_digest=self.digest(self.directory / output),
+        )
+
+    def stale_outputs(self, changed_file):
+        """
+        Outputs that list ``changed_file`` among their inputs, for example to
+        see what a new master flat will cause to be rebuilt.
+        """
+        changed = str(Path(changed_file).resolve())
+        return [output for output, entry in self.outputs.items()
+                if changed in entry['inputs']]
+
+    def save(self):
+        """
+        Write the manifest to disk.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(dict(outputs=self.outputs, digests=self._digests), f,
+                      indent=1)
@@ -0,0 +1,209 @@
+"""
+Build a sky flat without writing intermediate, source-masked images.
+
+The sky flat notebook calibrates each science frame, masks the stars by
+setting them to NaN, writes the result to a working directory, reads all of
+the working images back and combines them. Here each frame is calibrated and
+source-masked in a worker process that writes it straight into one slice of
+a memory-mapped float32 cube. The cube is then sigma clipped and combined a
+strip of rows at a time with the NaN-based combination in `nan_combine`.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import tempfile
+
+import numpy as np
+
+from astropy import units as u
+from astropy.nddata import CCDData, StdDevUncertainty
+from photutils.segmentation import detect_threshold, detect_sources
+
+import ccdproc as ccdp
+
+from nan_combine import combine_cube, nan_sigma_clip
+
+
+@lru_cache(maxsize=4)
+def _read_master(file_name):
+    # Each worker process reads each master only once.
+    return CCDData.read(file_name)
+
+
+def subtract_bias_and_dark(ccd, bias_file, dark_file, trim=None,
+                           exposure_time='exposure', exposure_unit=u.second):
+    """
+    Calibrate a raw frame the way the sky flat notebook does.
+
+    Use it with ``functools.partial`` to set the master files, e.g.
+    ``partial(subtract_bias_and_dark, bias_file=..., dark_file=...)``, so that
+    it can be passed as ``calibrate`` to `build_sky_flat`.
+
+    Parameters
+    ----------
+
+    ccd : ``CCDData``
+        Raw image.
+
+    bias_file, dark_file : str
+        Names of the files with the combined bias and dark.
+
+    trim : tuple of slice, optional
+        Region of the raw image to keep, e.g.
+        ``(slice(None), slice(None, 4096))`` to drop the overscan.
+
+    exposure_time, exposure_unit
+        Passed to ``ccdp.subtract_dark``.
+    """
+    if trim is not None:
+        ccd = ccdp.trim_image(ccd[trim])
+    ccd = ccdp.subtract_bias(ccd, _read_master(str(bias_file)))
+    return ccdp.subtract_dark(ccd, _read_master(str(dark_file)),
+                              exposure_time=exposure_time,
+                              exposure_unit=exposure_unit)
+
+
+def mask_sources(ccd, nsigma=2, npixels=30):
+    """
+    Set pixels that are part of a source to NaN.
+
+    Parameters
+    ----------
+
+    ccd : ``CCDData``
+        Calibrated image.
+
+    nsigma : float, optional
+        Detection threshold, in standard deviations above the background.
+
+    npixels : int, optional
+        Minimum number of connected pixels above the threshold for a source.
+
+    Returns
+    -------
+
+    numpy array of float32
+        The data with sources set to NaN.
+    """
+    data = ccd.data.astype('float32')
+    threshold = detect_threshold(ccd.data, nsigma)
+    segments = detect_sources(ccd.data, threshold, npixels)
+    if segments is not None:
+        data[segments.data > 0] = np.nan
+    return data
+
+
+def _mask_into_cube(index, file_name, cube_file, calibrate, nsigma, npixels):
+    """
+    Calibrate and source-mask one frame, store it in the cube and return
+    its median for use as a scale factor.
+    """
+    ccd = CCDData.read(file_name)
+    if calibrate is not None:
+        ccd = calibrate(ccd)
+    data = mask_sources(ccd, nsigma=nsigma, npixels=npixels)
+
+    cube = np.load(cube_file, mmap_mode='r+')
+    cube[index] = data
+    cube.flush()
+    del cube
+
+    return np.nanmedian(data), ccd.header
+
+
+def build_sky_flat(files, calibrate=None, nsigma=2, npixels=30,
+                   sigma_clip_low_thresh=3, sigma_clip_high_thresh=3,
+                   work_dir=None, max_workers=None, mem_limit=2e9):
+    """
+    Make a sky flat from a set of science images.
+
+    Parameters
+    ----------
+
+    files : list of str
+        Raw (or calibrated) science images.
+
+    calibrate : callable, optional
+        Function that takes a ``CCDData`` read from one of the ``files`` and
+        returns the calibrated image, e.g. `subtract_bias_and_dark` with the
+        master files set by ``functools.partial``. It must be picklable, so a
+        module-level function or a ``partial`` of one. If ``None`` the images
+        are used as they are.
+
+    nsigma, npixels
+        Source detection settings; see `mask_sources`.
+
+    sigma_clip_low_thresh, sigma_clip_high_thresh : float, optional
+        Clipping thresholds for the combination.
+
+    work_dir : str, optional
+        Directory for the temporary memory-mapped cube. The default is the
+        system temporary directory.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    mem_limit : float, optional
+        Approximate memory limit, in bytes, for the combination.
+
+    Returns
+    -------
+
+    ``CCDData``
+        The sky flat, normalized to a median of one. Pixels that were part
+        of a source in every image are masked.
+    """
+    files = [str(f) for f in files]
+    n_images = len(files)
+
+    # Calibrate the first image here to learn the shape of the cube.
+    first = CCDData.read(files[0])
+    if calibrate is not None:
+        first = calibrate(first)
+    shape = first.shape
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        cube_file = Path(tmp) / 'sky_flat_cube.npy'
+        cube = np.lib.format.open_memmap(cube_file, mode='w+',
+                                         dtype='float32',
+                                         shape=(n_images,) + shape)
+        del cube
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_mask_into_cube, idx, name, cube_file,
+                                       calibrate, nsigma, npixels)
+                       for idx, name in enumerate(files)]
+            results = [future.result() for future in futures]
+
+        medians = np.array([median for median, _ in results])
+        header = results[0][1]
+
+        cube = np.load(cube_file, mmap_mode='r')
+        combined = np.empty(shape)
+        uncertainty = np.empty(shape)
+        mask = np.empty(shape, dtype=bool)
+
+        # Strip size allows for the strip, a copy made while clipping and
+        # float64 deviations.
+        bytes_per_row = (4 + 4 + 8 + 1) * n_images * shape[1]
+        rows = int(max(1, min(shape[0], mem_limit // bytes_per_row)))
+        for start in range(0, shape[0], rows):
+            stop = min(start + rows, shape[0])
+            strip = np.array(cube[:, start:stop])
+            nan_sigma_clip(strip, low_thresh=sigma_clip_low_thresh,
+                           high_thresh=sigma_clip_high_thresh)
+            (combined[start:stop],
+             uncertainty[start:stop],
+             mask[start:stop]) = combine_cube(strip, scale=1 / medians)
+        del cube
+
+    # Normalize, like a combined flat scaled by inv_median.
+    norm = np.nanmedian(combined)
+    sky_flat = CCDData(combined / norm, unit=u.dimensionless_unscaled,
+                       mask=mask,
+                       uncertainty=StdDevUncertainty(uncertainty / norm),
+                       meta=header)
+    sky_flat.meta['ncombine'] = n_images
+    sky_flat.meta['imagetyp'] = 'sky flat'
+    return sky_flat
@@ -0,0 +1,376 @@
+"""
+Align images using the stars in them, then stack them.
+
+Stars are detected once per image and the catalogs are cached on disk. Each
+image is matched to a reference image by comparing triangles made from the
+brightest stars: the ratios of a triangle's sides do not change when the
+image is shifted, rotated or scaled, so similar triangles are found quickly
+with a KD-tree. The matched stars give a first transform, which is refined
+using every star that lands close to a reference star. Detection and
+resampling run in a process pool.
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import combinations
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from astropy.nddata import CCDData
+from astropy.stats import sigma_clipped_stats
+from astropy.table import Table
+from photutils.detection import DAOStarFinder
+
+from reduction_cache import params_digest
+
+
+def detect_stars(file_name, fwhm=4, threshold=5, max_stars=None,
+                 cache_dir=None):
+    """
+    Find stars in an image, using a cached catalog if there is one.
+
+    Parameters
+    ----------
+
+    file_name : str
+        Calibrated image.
+
+    fwhm : float, optional
+        Approximate FWHM of the stars, in pixels.
+
+    threshold : float, optional
+        Detection threshold, in standard deviations of the background.
+
+    max_stars : int, optional
+        Keep only this many of the brightest stars.
+
+    cache_dir : str, optional
+        Directory in which catalogs are cached. A cached catalog is used only
+        if it is newer than the image and was made from the same file with
+        the same ``fwhm`` and ``threshold``.
+
+    Returns
+    -------
+
+    ``astropy.table.Table``
+        Columns ``x``, ``y`` and ``flux``, brightest first.
+    """
+    file_name = Path(file_name)
+    cache_file = None
+    if cache_dir is not None:
+        # The full path and the detection settings are part of the name so
+        # that images with the same name in different directories, or
+        # detections with different settings, get their own catalogs.
+        digest = params_digest(dict(path=str(file_name.resolve()),
+                                    fwhm=fwhm, threshold=threshold))
+        cache_file = (Path(cache_dir) /
+                      f'{file_name.stem}-{digest[:16]}-stars.ecsv')
+        if (cache_file.exists() and
+                cache_file.stat().st_mtime >= file_name.stat().st_mtime):
+            stars = Table.read(cache_file)
+            return stars[:max_stars] if max_stars else stars
+
+    data = CCDData.read(file_name).data
+    _, median, std = sigma_clipped_stats(data, sigma=3)
+    finder = DAOStarFinder(fwhm=fwhm, threshold=threshold * std)
+    sources = finder(data - median)
+
+    if sources is None:
+        stars = Table(names=['x', 'y', 'flux'])
+    else:
+        stars = Table([sources['xcentroid'], sources['ycentroid'],
+                       sources['flux']], names=['x', 'y', 'flux'])
+        stars.sort('flux', reverse=True)
+
+    if cache_file is not None:
+        stars.write(cache_file, overwrite=True)
+    return stars[:max_stars] if max_stars else stars
+
+
+def triangle_invariants(xy):
+    """
+    Triangles formed by every set of three points and their shape.
+
+    Parameters
+    ----------
+
+    xy : numpy array
+        Positions, shape ``(n, 2)``.
+
+    Returns
+    -------
+
+    triangles, invariants
+        Indexes of the three vertices of each triangle, ordered so that
+        matching triangles have matching vertices, and the ratios of the
+        middle and shortest sides to the longest side.
+    """
+    triangles = np.array(list(combinations(range(len(xy)), 3)))
+    if not len(triangles):
+        # Fewer than three points; keep the indexes integers so they can
+        # still be used for indexing.
+        return np.empty((0, 3), dtype=int), np.empty((0, 2))
+
+    pts = xy[triangles]
+    # Side i is opposite vertex i.
+    sides = np.stack([np.hypot(*(pts[:, 1] - pts[:, 2]).T),
+                      np.hypot(*(pts[:, 0] - pts[:, 2]).T),
+                      np.hypot(*(pts[:, 0] - pts[:, 1]).T)], axis=1)
+    order = np.argsort(sides, axis=1)[:, ::-1]
+    sides = np.take_along_axis(sides, order, axis=1)
+    # Order the vertices by the length of the side opposite them.
+    triangles = np.take_along_axis(triangles, order, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        invariants = sides[:, 1:] / sides[:, :1]
+    return triangles, invariants
+
+
+def fit_affine(source, destination):
+    """
+    Least squares affine transform from ``source`` to ``destination``.
+
+    Returns
+    -------
+
+    numpy array
+        2x3 matrix ``M`` so that ``destination ~ M[:, :2] @ source + M[:, 2]``.
+    """
+    design = np.hstack([source, np.ones((len(source), 1))])
+    solution, *_ = np.linalg.lstsq(design, destination, rcond=None)
+    return solution.T
+
+
+def apply_affine(matrix, xy):
+    return xy @ matrix[:, :2].T + matrix[:, 2]
+
+
+def match_stars(xy, ref_xy, ref_index=None, tolerance=0.01,
+                match_radius=2, n_iterations=3):
+    """
+    Find the transform that takes star positions in an image to the
+    reference.
+
+    Parameters
+    ----------
+
+    xy, ref_xy : numpy arrays
+        Positions, shape ``(n, 2)``, of the brightest stars in the image and
+        the reference. A few dozen stars is plenty.
+
+    ref_index : tuple, optional
+        ``(triangles, cKDTree of invariants)`` for the reference, from
+        `reference_index`, so it can be shared by many images.
+
+    tolerance : float, optional
+        How close the shapes of two triangles must be to match; only the
+        closest reference triangle within this distance counts.
+
+    match_radius : float, optional
+        Distance, in pixels, within which a transformed star must land on a
+        reference star to be counted as a match when refining.
+
+    n_iterations : int, optional
+        Number of refinement passes.
+
+    Returns
+    -------
+
+    matrix, n_matched
+        2x3 affine matrix (see `fit_affine`) and number of matched stars.
+    """
+    if len(xy) < 3 or len(ref_xy) < 3:
+        raise ValueError('At least three stars are needed in both the image '
+                         'and the reference.')
+    if ref_index is None:
+        ref_index = reference_index(ref_xy)
+    ref_triangles, ref_tree = ref_index
+
+    triangles, invariants = triangle_invariants(xy)
+    good = np.isfinite(invariants).all(axis=1)
+    triangles, invariants = triangles[good], invariants[good]
+
+    # Each pair of matching triangles votes for three star correspondences.
+    _, nearest = ref_tree.query(invariants, distance_upper_bound=tolerance)
+    found = nearest < len(ref_triangles)
+    votes = np.zeros((len(xy), len(ref_xy)), dtype=np.int32)
+    np.add.at(votes, (triangles[found], ref_triangles[nearest[found]]), 1)
+
+    # Keep correspondences where the image star and reference star are
+    # each other's best match.
+    best_ref = votes.argmax(axis=1)
+    best_img = votes.argmax(axis=0)
+    pairs = [(i, j) for i, j in enumerate(best_ref)
+             if votes[i, j] > 0 and best_img[j] == i]
+    if len(pairs) < 3:
+        raise ValueError('Could not match enough stars to the reference.')
+
+    pairs = np.array(pairs)
+    matrix = fit_affine(xy[pairs[:, 0]], ref_xy[pairs[:, 1]])
+
+    # Refine with every star that lands near a reference star.
+    point_tree = cKDTree(ref_xy)
+    n_matched = len(pairs)
+    for _ in range(n_iterations):
+        distance, nearest = point_tree.query(apply_affine(matrix, xy))
+        close = distance < match_radius
+        if close.sum() < 3:
+            break
+        matrix = fit_affine(xy[close], ref_xy[nearest[close]])
+        n_matched = int(close.sum())
+
+    return matrix, n_matched
+
+
+def reference_index(ref_xy):
+    """
+    Triangles and a KD-tree of their shapes for the reference stars.
+    """
+    triangles, invariants = triangle_invariants(ref_xy)
+    good = np.isfinite(invariants).all(axis=1)
+    return triangles[good], cKDTree(invariants[good])
+
+
+def resample_to_reference(data, matrix, output_shape, order=1):
+    """
+    Resample an image onto the reference pixel grid.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        The image.
+
+    matrix : numpy array
+        2x3 affine matrix taking image (x, y) to reference (x, y).
+
+    output_shape : tuple
+        Shape of the reference image.
+
+    order : int, optional
+        Order of the interpolation.
+
+    Returns
+    -------
+
+    numpy array
+        The resampled image, NaN outside of the original image.
+    """
+    # affine_transform wants the transform from output to input, in
+    # (row, column) order.
+    linear = matrix[:, :2]
+    inverse = np.linalg.inv(linear)
+    offset = -inverse @ matrix[:, 2]
+    swap = [1, 0]
+    return ndimage.affine_transform(np.asarray(data, dtype=np.float64),
+                                    inverse[np.ix_(swap, swap)],
+                                    offset=offset[swap],
+                                    output_shape=output_shape,
+                                    order=order, cval=np.nan)
+
+
+def _align_one(file_name, ref_xy, ref_index, n_stars, detect_kwargs,
+               output_shape, order):
+    stars = detect_stars(file_name, max_stars=n_stars, **detect_kwargs)
+    xy = np.array([stars['x'], stars['y']]).T
+    matrix, n_matched = match_stars(xy, ref_xy, ref_index=ref_index)
+    data = CCDData.read(file_name).data
+    return matrix, n_matched, resample_to_reference(data, matrix,
+                                                    output_shape, order=order)
+
+
+def align_and_stack(files, reference=0, n_stars=30, max_workers=None,
+                    order=1, **detect_kwargs):
+    """
+    Align images to a reference image using their stars and average them.
+
+    Parameters
+    ----------
+
+    files : list of str
+        Calibrated images.
+
+    reference : int, optional
+        Index in ``files`` of the reference image.
+
+    n_stars : int, optional
+        Number of the brightest stars used for matching.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    order : int, optional
+        Order of the interpolation.
+
+    detect_kwargs
+        Passed to `detect_stars`, e.g. ``fwhm`` or ``cache_dir``.
+
+    Returns
+    -------
+
+    stacked, transforms, n_matched, skipped
+        The average of the aligned images as a ``CCDData`` (masked where no
+        image covers the reference), and the transform found for each image
+        and the number of stars used to find it. Images that could not be
+        matched to the reference are left out of the average, their
+        transform and number of stars are ``None``, and ``skipped`` gives
+        the reason for each of them, keyed by file name.
+    """
+    files = [str(f) for f in files]
+    ref_ccd = CCDData.read(files[reference])
+    ref_stars = detect_stars(files[reference], max_stars=n_stars,
+                             **detect_kwargs)
+    ref_xy = np.array([ref_stars['x'], ref_stars['y']]).T
+    # Made once here rather than once per image in the workers.
+    ref_index = reference_index(ref_xy)
+
+    total = np.zeros(ref_ccd.shape)
+    count = np.zeros(ref_ccd.shape, dtype=np.int32)
+    transforms = [None] * len(files)
+    n_matched = [None] * len(files)
+    skipped = {}
+    n_combined = 0
+
+    # Only a few images are submitted ahead of the ones being added in, and
+    # each aligned image is let go once it has been, so memory use doesn't
+    # grow with the number of images.
+    window = 2 * (max_workers or os.cpu_count() or 1)
+    to_submit = iter(enumerate(files))
+    pending = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for index, name in to_submit:
+                future = executor.submit(_align_one, name, ref_xy, ref_index,
+                                         n_stars, detect_kwargs,
+                                         ref_ccd.shape, order)
+                pending[future] = index
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    matrix, n_stars_used, aligned = future.result()
+                except ValueError as e:
+                    skipped[files[index]] = str(e)
+                    continue
+                transforms[index] = matrix
+                n_matched[index] = n_stars_used
+                good = np.isfinite(aligned)
+                total[good] += aligned[good]
+                count += good
+                n_combined += 1
+                del aligned, good
+            del done, future
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        average = total / count
+    stacked = CCDData(average, unit=ref_ccd.unit, mask=count == 0,
+                      meta=ref_ccd.header.copy())
+    stacked.meta['ncombine'] = n_combined
+    return stacked, transforms, n_matched, skipped
@@ -0,0 +1,123 @@
+"""
+Run the GitHub commenting code against `fake_github.FakeGitHub`.
+"""
+import json
+
+import nbformat as nbf
+import pytest
+
+from add_github_links import COMMENT_RECORD, commentify_all_notebooks
+from fake_github import FakeGitHub
+from github_client import GitHubClient
+
+NOTEBOOKS = ['01-00-first.ipynb', '01-01-second.ipynb', '02-00-third.ipynb']
+
+LINK_TEXT = 'Click here to comment'
+
+
+@pytest.fixture
+def notebooks(tmp_path):
+    book = tmp_path / 'book'
+    originals = tmp_path / 'originals'
+    book.mkdir()
+    originals.mkdir()
+    for name in NOTEBOOKS:
+        notebook = nbf.v4.new_notebook()
+        notebook.cells = [
+            nbf.v4.new_markdown_cell(f'# {name}\n\nIntroduction.'),
+            nbf.v4.new_code_cell('x = 1'),
+            nbf.v4.new_markdown_cell(f'## Section of {name}\n\nText.'),
+            nbf.v4.new_markdown_cell(f'### Part of {name}\n\nMore text.'),
+        ]
+        nbf.write(notebook, originals / name)
+        nbf.write(notebook, book / name)
+    return book, originals
+
+
+def book_contents(book):
+    return {name: (book / name).read_text() for name in NOTEBOOKS}
+
+
+def test_commentify_is_idempotent(notebooks):
+    book, originals = notebooks
+    with FakeGitHub() as github:
+        client = GitHubClient(api_url=github.url)
+        commentify_all_notebooks(book, originals, comment_group='group',
+                                 client=client)
+
+        assert len(github.pulls) == len(NOTEBOOKS)
+        assert all(pull['labels'] == ['group']
+                   for pull in github.pulls.values())
+        assert github.labels['group']['color']
+        first = book_contents(book)
+        # A link after each of the level 2 and 3 headings.
+        assert all(text.count(LINK_TEXT) == 2 for text in first.values())
+        record = json.loads((originals / COMMENT_RECORD).read_text())
+        assert sorted(record['group']) == NOTEBOOKS
+
+        n_requests = len(github.requests)
+        commentify_all_notebooks(book, originals, comment_group='group',
+                                 client=client)
+
+        # Only the label is checked again; nothing new is made and no links
+        # are added twice.
+        assert [method for method, _ in github.requests[n_requests:]] == \
+            ['POST', 'PATCH']
+        assert len(github.pulls) == len(NOTEBOOKS)
+        assert book_contents(book) == first
+
+
+def test_commentify_recovers_without_record(notebooks):
+    book, originals = notebooks
+    with FakeGitHub() as github:
+        client = GitHubClient(api_url=github.url)
+        commentify_all_notebooks(book, originals, client=client)
+        first = book_contents(book)
+
+        # As if the record had been lost after everything was made, so each
+        # step is refused as already done.
+        (originals / COMMENT_RECORD).unlink()
+        commentify_all_notebooks(book, originals, client=client)
+
+        assert len(github.pulls) == len(NOTEBOOKS)
+        assert book_contents(book) == first
+
+
+def test_writes_are_sent_one_at_a_time(notebooks):
+    book, originals = notebooks
+    with FakeGitHub(latency=0.05) as github:
+        client = GitHubClient(api_url=github.url)
+        commentify_all_notebooks(book, originals, client=client,
+                                 max_workers=len(NOTEBOOKS))
+
+        assert len(github.pulls) == len(NOTEBOOKS)
+        assert github.max_writes_in_flight == 1
+
+
+@pytest.mark.parametrize('retry_after', [True, False])
+def test_secondary_rate_limit_is_retried(notebooks, retry_after):
+    book, originals = notebooks
+    with FakeGitHub(max_concurrent=1, retry_after=retry_after,
+                    latency=0.05) as github:
+        # Let the client send more at once than the server allows.
+        client = GitHubClient(api_url=github.url, max_concurrent_writes=4,
+                              secondary_wait=0.1, max_retries=20)
+        commentify_all_notebooks(book, originals, client=client,
+                                 max_workers=len(NOTEBOOKS))
+
+        assert github.refused > 0
+        assert github.max_in_flight == 1
+        assert len(github.pulls) == len(NOTEBOOKS)
+        assert all(book_contents(book)[name].count(LINK_TEXT) == 2
+                   for name in NOTEBOOKS)
+
+
+def test_primary_rate_limit_waits_for_reset(notebooks):
+    book, originals = notebooks
+    with FakeGitHub(rate_limit=5, window=1) as github:
+        client = GitHubClient(api_url=github.url, max_retries=20)
+        commentify_all_notebooks(book, originals, client=client)
+
+        assert len(github.pulls) == len(NOTEBOOKS)
+        assert all(pull['labels'] == ['default-comment-group']
+                   for pull in github.pulls.values())
@@ -0,0 +1,126 @@
+"""
+Run the data fetching code against a ``file://`` mirror made with
+`fetch_data.build_mirror`.
+"""
+import json
+import tarfile
+
+import pytest
+
+from fetch_data import build_mirror, fetch, fetch_and_extract, md5_of
+
+RECORD = 1234
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'example-data').mkdir(parents=True)
+    (source / 'single.fit.bz2').write_bytes(bytes(range(256)) * 100)
+    (source / 'example-data' / 'image.fit').write_bytes(b'not really FITS')
+    with tarfile.open(source / 'example-data.tar.bz2', 'w:bz2') as archive:
+        archive.add(source / 'example-data', arcname='example-data')
+
+    mirror_dir = tmp_path / 'mirror'
+    build_mirror(mirror_dir,
+                 [(RECORD, 'single.fit.bz2', False),
+                  (RECORD, 'example-data.tar.bz2', True)],
+                 source_dir=source)
+    return mirror_dir, source
+
+
+def mirrored_file(mirror_dir, name):
+    return mirror_dir / 'record' / str(RECORD) / 'files' / name
+
+
+def metadata_file(mirror_dir):
+    return mirror_dir / 'api' / 'records' / str(RECORD)
+
+
+def test_fetch_places_and_caches(mirror, tmp_path):
+    mirror_dir, source = mirror
+    base_url = mirror_dir.resolve().as_uri()
+    cache_dir = tmp_path / 'cache'
+    destination = tmp_path / 'data'
+    destination.mkdir()
+
+    cached = fetch(RECORD, 'single.fit.bz2', destination_dir=destination,
+                   base_url=base_url, cache_dir=cache_dir)
+    expected = md5_of(source / 'single.fit.bz2')
+    assert cached == cache_dir / expected[:2] / expected
+    assert md5_of(destination / 'single.fit.bz2') == expected
+
+    # The second time it comes from the cache, so the mirror isn't needed.
+    (destination / 'single.fit.bz2').unlink()
+    mirrored_file(mirror_dir, 'single.fit.bz2').unlink()
+    fetch(RECORD, 'single.fit.bz2', destination_dir=destination,
+          base_url=base_url, cache_dir=cache_dir)
+    assert md5_of(destination / 'single.fit.bz2') == expected
+
+
+def test_fetch_rejects_bad_checksum(mirror, tmp_path):
+    mirror_dir, _ = mirror
+    mirrored_file(mirror_dir, 'single.fit.bz2').write_bytes(b'corrupted')
+
+    with pytest.raises(RuntimeError, match='Checksum'):
+        fetch(RECORD, 'single.fit.bz2', destination_dir=tmp_path,
+              base_url=mirror_dir.resolve().as_uri(),
+              cache_dir=tmp_path / 'cache')
+    assert not (tmp_path / 'single.fit.bz2').exists()
+
+
+def test_fetch_without_metadata(mirror, tmp_path):
+    mirror_dir, source = mirror
+    metadata_file(mirror_dir).unlink()
+
+    fetch(RECORD, 'single.fit.bz2', destination_dir=tmp_path,
+          base_url=mirror_dir.resolve().as_uri(),
+          cache_dir=tmp_path / 'cache')
+    assert (md5_of(tmp_path / 'single.fit.bz2') ==
+            md5_of(source / 'single.fit.bz2'))
+
+
+def test_fetch_and_extract(mirror, tmp_path):
+    mirror_dir, source = mirror
+    base_url = mirror_dir.resolve().as_uri()
+    cache_dir = tmp_path / 'cache'
+    destination = tmp_path / 'data'
+    destination.mkdir()
+
+    extracted = fetch_and_extract(RECORD, 'example-data.tar.bz2',
+                                  destination_dir=destination,
+                                  base_url=base_url, cache_dir=cache_dir)
+    assert extracted == destination / 'example-data'
+    assert (extracted / 'image.fit').read_bytes() == b'not really FITS'
+    expected = md5_of(source / 'example-data.tar.bz2')
+    assert (cache_dir / expected[:2] / expected).exists()
+    assert (extracted / '.extracted-from').read_text() == expected
+
+    # Neither the metadata nor the tarball is needed once it is extracted.
+    metadata_file(mirror_dir).unlink()
+    mirrored_file(mirror_dir, 'example-data.tar.bz2').unlink()
+    assert fetch_and_extract(RECORD, 'example-data.tar.bz2',
+                             destination_dir=destination,
+                             base_url=base_url,
+                             cache_dir=cache_dir) == extracted
+
+
+def test_fetch_and_extract_from_cache(mirror, tmp_path):
+    mirror_dir, _ = mirror
+    base_url = mirror_dir.resolve().as_uri()
+    cache_dir = tmp_path / 'cache'
+
+    fetch_and_extract(RECORD, 'example-data.tar.bz2',
+                      destination_dir=tmp_path / 'first',
+                      base_url=base_url, cache_dir=cache_dir)
+
+    # A fresh directory is filled from the cached tarball.
+    mirrored_file(mirror_dir, 'example-data.tar.bz2').unlink()
+    (tmp_path / 'second').mkdir()
+    extracted = fetch_and_extract(RECORD, 'example-data.tar.bz2',
+                                  destination_dir=tmp_path / 'second',
+                                  base_url=base_url, cache_dir=cache_dir)
+    assert (extracted / 'image.fit').read_bytes() == b'not really FITS'
+    listing = json.loads(metadata_file(mirror_dir).read_text())
+    assert (extracted / '.extracted-from').read_text() == \
+        listing['files'][1]['checksum'].split(':')[1]
@@ -0,0 +1,387 @@
+"""
+2D background estimation that is cheap to repeat on frames of the same size.
+
+Like ``photutils.background.Background2D``, the image is divided into boxes,
+a sigma-clipped median and standard deviation are found in each box, the
+grid of box values is median filtered and then interpolated back to the
+size of the image.
+
+The layout of the boxes, together with the mask of bad pixels and sources,
+is worked out once in a `BackgroundMesh` and kept, so for a run of frames
+from the same camera each frame costs one gather of its pixels into a cube
+of boxes plus the statistics. Statistics are calculated for strips of boxes
+in a pool of threads; numpy does the work, so no copies of the frame need to
+be sent to other processes, and each box is sorted only once however many
+clipping iterations there are (see `clipped_box_stats`). The interpolation is
+a spline through the box values that is evaluated only where it is asked
+for, one tile of rows at a time when a frame is background-subtracted.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+import math
+
+import numpy as np
+from scipy import ndimage
+from scipy.interpolate import RectBivariateSpline
+
+from photutils.segmentation import detect_sources, detect_threshold
+
+# Meshes already made in this process, keyed by geometry and mask. Only the
+# most recent few are kept, since each holds an index as big as an image.
+_mesh_cache = {}
+MESH_CACHE_SIZE = 4
+
+
+def source_mask(data, nsigma=2, npixels=10, dilate_size=11, mask=None):
+    """
+    Mask of the pixels in sources, to leave out of the background.
+
+    Parameters
+    ----------
+
+    data : numpy array
+        The image.
+
+    nsigma : float, optional
+        Detection threshold, in standard deviations above the background.
+
+    npixels : int, optional
+        Minimum number of connected pixels above the threshold for a source.
+
+    dilate_size : int, optional
+        Size of the box by which each source is grown, so that its faint
+        outer parts are masked too.
+
+    mask : numpy array of bool, optional
+        Bad pixels, ignored in the detection.
+
+    Returns
+    -------
+
+    numpy array of bool
+        ``True`` for pixels in sources.
+    """
+    threshold = detect_threshold(data, nsigma, mask=mask)
+    segments = detect_sources(data, threshold, npixels, mask=mask)
+    if segments is None:
+        return np.zeros(np.shape(data), dtype=bool)
+    return segments.make_source_mask(size=dilate_size)
+
+
+def clipped_box_stats(boxes, sigma=3, maxiters=5):
+    """
+    Sigma-clipped median and standard deviation of each box.
+
+    The clipping is the same as ``astropy.stats.SigmaClip`` with its
+    defaults (median center, standard deviation), which is what
+    ``Background2D`` uses. Each box is sorted once; after that the pixels
+    that survive clipping are always a contiguous run of the sorted values,
+    so each iteration only has to find the ends of the run, and the mean and
+    standard deviation of the run come from cumulative sums.
+
+    Parameters
+    ----------
+
+    boxes : numpy array
+        Pixel values, shape ``(..., pixels in box)``, with NaN for pixels
+        that should not be used.
+
+    sigma : float, optional
+        Clipping threshold, in standard deviations.
+
+    maxiters : int, optional
+        Maximum number of clipping iterations; the default is the same as
+        for ``astropy.stats.SigmaClip``.
+
+    Returns
+    -------
+
+    median, std : numpy arrays
+        NaN for boxes with no good pixels.
+    """
+    values = np.sort(boxes, axis=-1)
+    lo = np.zeros(values.shape[:-1], dtype=int)
+    hi = np.isfinite(values).sum(axis=-1)
+
+    def median_of_run(lo, hi):
+        n = np.maximum(hi - lo, 1)
+        lower = np.take_along_axis(values, (lo + (n - 1) // 2)[..., None], -1)
+        upper = np.take_along_axis(values, (lo + n // 2)[..., None], -1)
+        return 0.5 * (lower[..., 0].astype(np.float64) + upper[..., 0])
+
+    # Sums relative to a typical value so the variance doesn't lose
+    # precision when the background is large compared to the noise.
+    offset = median_of_run(lo, hi)[..., None]
+    shifted = np.nan_to_num(values - offset)
+    zero = np.zeros(values.shape[:-1] + (1,))
+    sums = np.concatenate([zero, np.cumsum(shifted, axis=-1)], axis=-1)
+    squares = np.concatenate([zero, np.cumsum(shifted ** 2, axis=-1)],
+                             axis=-1)
+
+    def std_of_run(lo, hi):
+        n = np.maximum(hi - lo, 1)
+        total = (np.take_along_axis(sums, hi[..., None], -1) -
+                 np.take_along_axis(sums, lo[..., None], -1))[..., 0]
+        total2 = (np.take_along_axis(squares, hi[..., None], -1) -
+                  np.take_along_axis(squares, lo[..., None], -1))[..., 0]
+        return np.sqrt(np.maximum(total2 / n - (total / n) ** 2, 0))
+
+    for _ in range(maxiters):
+        median = median_of_run(lo, hi)
+        std = std_of_run(lo, hi)
+        low = (median - sigma * std)[..., None]
+        high = (median + sigma * std)[..., None]
+        # NaN is never less than anything, so it is never counted.
+        new_lo = (values < low).sum(axis=-1)
+        new_hi = (values <= high).sum(axis=-1)
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+            break
+        lo, hi = new_lo, new_hi
+
+    empty = hi <= lo
+    median = np.where(empty, np.nan, median_of_run(lo, hi))
+    std = np.where(empty, np.nan, std_of_run(lo, hi))
+    return median, std
+
+
+def _fill_missing(mesh):
+    """
+    Replace NaN boxes by the average of their neighbors, working inwards.
+    """
+    mesh = mesh.copy()
+    missing = np.isnan(mesh)
+    if missing.all():
+        raise ValueError('No box had enough unmasked pixels to estimate '
+                         'the background.')
+    kernel = np.ones((3, 3))
+    while missing.any():
+        values = ndimage.convolve(np.where(missing, 0, mesh), kernel,
+                                  mode='constant')
+        counts = ndimage.convolve((~missing).astype(float), kernel,
+                                  mode='constant')
+        fill = missing & (counts > 0)
+        mesh[fill] = values[fill] / counts[fill]
+        missing &= ~fill
+    return mesh
+
+
+class Background:
+    """
+    A background estimate that is interpolated only when it is needed.
+
+    Made by `BackgroundMesh.estimate`; ``mesh`` and ``mesh_rms`` are the
+    (filtered) box values.
+    """
+    def __init__(self, shape, y_centers, x_centers, mesh, mesh_rms):
+        self.shape = shape
+        self.mesh = mesh
+        self.mesh_rms = mesh_rms
+        self._splines = [self._spline(y_centers, x_centers, values)
+                         for values in (mesh, mesh_rms)]
+
+    def _spline(self, y_centers, x_centers, values):
+        ny, nx = self.shape
+        # A spline needs at least two boxes in each direction.
+        if len(y_centers) == 1:
+            y_centers = np.array([-0.5, ny - 0.5])
+            values = np.repeat(values, 2, axis=0)
+        if len(x_centers) == 1:
+            x_centers = np.array([-0.5, nx - 0.5])
+            values = np.repeat(values, 2, axis=1)
+        # The bounding box covers the whole image so the edges are
+        # extrapolated; centers of padded boxes can be past the edge.
+        bbox = [min(-0.5, y_centers[0]), max(ny - 0.5, y_centers[-1]),
+                min(-0.5, x_centers[0]), max(nx - 0.5, x_centers[-1])]
+        return RectBivariateSpline(y_centers, x_centers, values,
+                                   kx=min(3, len(y_centers) - 1),
+                                   ky=min(3, len(x_centers) - 1),
+                                   bbox=bbox)
+
+    def _evaluate(self, spline, region):
+        if region is None:
+            region = (slice(None), slice(None))
+        rows = np.arange(self.shape[0])[region[0]]
+        cols = np.arange(self.shape[1])[region[1]]
+        return spline(rows, cols)
+
+    def background(self, region=None):
+        """
+        The background, for the whole image or for ``region``, a tuple of
+        two slices with positive steps.
+        """
+        return self._evaluate(self._splines[0], region)
+
+    def rms(self, region=None):
+        """
+        The background RMS, for the whole image or for ``region``.
+        """
+        return self._evaluate(self._splines[1], region)
+
+    def subtract(self, data, tile_rows=512, out=None):
+        """
+        Subtract the background from an image a tile of rows at a time.
+
+        Parameters
+        ----------
+
+        data : numpy array
+            The image.
+
+        tile_rows : int, optional
+            Number of rows of background evaluated at once.
+
+        out : numpy array, optional
+            Where to put the result; it can be ``data`` itself if that is a
+            floating point array. By default a new float64 array is made.
+
+        Returns
+        -------
+
+        numpy array
+            The background-subtracted image.
+        """
+        if out is None:
+            out = np.empty(self.shape)
+        for start in range(0, self.shape[0], tile_rows):
+            rows = slice(start, min(start + tile_rows, self.shape[0]))
+            out[rows] = data[rows] - self.background((rows, slice(None)))
+        return out
+
+
+class BackgroundMesh:
+    """
+    Layout of the background boxes for images of one shape and mask.
+
+    Parameters
+    ----------
+
+    shape : tuple of int
+        Shape of the images.
+
+    box_size : int or tuple of int, optional
+        Size of the boxes, in pixels; a tuple gives (rows, columns). Boxes
+        at the top and right edges are padded if the image is not a whole
+        number of boxes.
+
+    mask : numpy array of bool, optional
+        Pixels to leave out, for example bad pixels and a `source_mask`.
+
+    filter_size : int, optional
+        Size, in boxes, of the median filter applied to the box values.
+
+    max_masked_fraction : float, optional
+        Boxes with a larger fraction of their pixels masked are not used;
+        their values are filled in from the boxes around them.
+
+    sigma : float, optional
+        Clipping threshold, in standard deviations, for the box statistics.
+
+    maxiters : int, optional
+        Maximum number of clipping iterations; the default is the same as
+        for ``astropy.stats.SigmaClip``.
+    """
+    def __init__(self, shape, box_size=64, mask=None, filter_size=3,
+                 max_masked_fraction=0.1, sigma=3, maxiters=5):
+        self.shape = tuple(shape)
+        self.box_size = np.broadcast_to(box_size, 2).astype(int)
+        self.filter_size = filter_size
+        self.sigma = sigma
+        self.maxiters = maxiters
+
+        ny, nx = self.shape
+        by, bx = self.box_size
+        self.n_boxes = (math.ceil(ny / by), math.ceil(nx / bx))
+        nby, nbx = self.n_boxes
+
+        # Index of each pixel in the flattened image, laid out as a cube of
+        # (box row, box column, pixel in box). Padding and masked pixels
+        # point one past the end of the image, where estimate puts a NaN.
+        rows = np.arange(nby * by)
+        cols = np.arange(nbx * bx)
+        index = rows[:, np.newaxis] * nx + cols
+        outside = (rows[:, np.newaxis] >= ny) | (cols >= nx)
+        if mask is not None:
+            padded_mask = np.zeros(outside.shape, dtype=bool)
+            padded_mask[:ny, :nx] = mask
+            outside |= padded_mask
+        index[outside] = ny * nx
+        dtype = np.int32 if ny * nx < 2**31 else np.int64
+        self._index = (index.reshape(nby, by, nbx, bx)
+                            .transpose(0, 2, 1, 3)
+                            .reshape(nby, nbx, by * bx)
+                            .astype(dtype))
+
+        masked = outside.reshape(nby, by, nbx, bx).sum(axis=(1, 3))
+        self.excluded = masked > max_masked_fraction * by * bx
+
+        self.y_centers = (np.arange(nby) + 0.5) * by - 0.5
+        self.x_centers = (np.arange(nbx) + 0.5) * bx - 0.5
+
+    def estimate(self, data, max_workers=None):
+        """
+        Estimate the background of an image.
+
+        Parameters
+        ----------
+
+        data : numpy array
+            Image with the shape of this mesh.
+
+        max_workers : int, optional
+            Maximum number of threads; the default is chosen by
+            ``concurrent.futures``.
+
+        Returns
+        -------
+
+        `Background`
+        """
+        if np.shape(data) != self.shape:
+            raise ValueError(f'Image shape {np.shape(data)} does not match '
+                             f'mesh shape {self.shape}.')
+        flat = np.empty(data.size + 1, dtype=np.float32)
+        flat[:-1] = np.ravel(data)
+        flat[-1] = np.nan
+
+        def strip_stats(row):
+            return clipped_box_stats(flat[self._index[row]], sigma=self.sigma,
+                                     maxiters=self.maxiters)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(strip_stats, range(self.n_boxes[0])))
+        mesh = np.array([median for median, _ in results])
+        mesh_rms = np.array([std for _, std in results])
+
+        mesh[self.excluded] = np.nan
+        mesh_rms[self.excluded] = np.nan
+        mesh = _fill_missing(mesh)
+        mesh_rms = _fill_missing(mesh_rms)
+        if self.filter_size > 1:
+            mesh = ndimage.median_filter(mesh, self.filter_size,
+                                         mode='nearest')
+            mesh_rms = ndimage.median_filter(mesh_rms, self.filter_size,
+                                             mode='nearest')
+
+        return Background(self.shape, self.y_centers, self.x_centers,
+                          mesh, mesh_rms)
+
+
+def background_mesh(shape, box_size=64, mask=None, **mesh_kwargs):
+    """
+    `BackgroundMesh` for this geometry and mask, reusing one already made.
+
+    Parameters are the same as for `BackgroundMesh`.
+    """
+    digest = sha256()
+    digest.update(str((tuple(shape), box_size,
+                       sorted(mesh_kwargs.items()))).encode())
+    if mask is not None:
+        digest.update(np.packbits(np.asarray(mask, dtype=bool)).tobytes())
+    key = digest.hexdigest()
+    if key not in _mesh_cache:
+        if len(_mesh_cache) >= MESH_CACHE_SIZE:
+            # Dictionaries keep insertion order, so this is the oldest.
+            del _mesh_cache[next(iter(_mesh_cache))]
+        _mesh_cache[key] = BackgroundMesh(shape, box_size=box_size, mask=mask,
+                                          **mesh_kwargs)
+    return _mesh_cache[key]
@@ -0,0 +1,147 @@
+"""
+Run ``ccdp.ccdmask`` on tiles of a large flat ratio in parallel.
+
+``ccdmask`` compares each pixel to a median-filtered version of the image
+and to a sigma estimated from the pixels around it, so each pixel depends
+only on a small neighborhood. That makes it possible to split the image into
+overlapping tiles, mask the tiles in separate processes and stitch the
+results back together without changing the mask.
+
+The one step that is not local is the search for short unmasked segments
+of bad columns done when ``findbadcolumns=True``; that runs once on the
+stitched mask, with a vectorized version of the loop in ``ccdmask``.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import math
+
+import numpy as np
+
+from astropy.nddata import CCDData
+
+import ccdproc as ccdp
+
+from tiling import overlapping_tiles
+
+# Defaults of the ccdmask parameters that determine how far apart pixels
+# can be and still affect each other.
+CCDMASK_DEFAULTS = dict(ncmed=7, nlmed=7, ncsig=15, nlsig=15, ngood=5)
+
+
+def fill_short_column_gaps(mask, ngood=5):
+    """
+    Mask short unmasked segments between masked pixels in each column.
+
+    This gives the same result as the final loop in ``ccdp.ccdmask`` when
+    ``findbadcolumns=True``: a run of at most ``ngood`` unmasked pixels with
+    masked pixels immediately above and below it is masked, as long as the
+    masked pixel below the run is not in the last ``ngood + 1`` lines.
+
+    Parameters
+    ----------
+
+    mask : numpy array of bool
+        The mask, modified in place.
+
+    ngood : int, optional
+        Longest segment that is filled in.
+
+    Returns
+    -------
+
+    numpy array of bool
+        The mask.
+    """
+    nlines = mask.shape[0]
+
+    # Masked pixels ordered by column, then line.
+    cols, lines = np.nonzero(mask.T)
+    same_column = cols[1:] == cols[:-1]
+    gap = lines[1:] - lines[:-1] - 1
+    fill = (same_column & (gap >= 1) & (gap <= ngood) &
+            (lines[:-1] < nlines - ngood - 1))
+
+    starts = lines[:-1][fill] + 1
+    stops = lines[1:][fill]
+    fill_cols = cols[:-1][fill]
+
+    # Mark the start and end of each segment and use a cumulative sum down
+    # each column to fill in everything between them.
+    edges = np.zeros((nlines + 1, mask.shape[1]), dtype=np.int32)
+    np.add.at(edges, (starts, fill_cols), 1)
+    np.add.at(edges, (stops, fill_cols), -1)
+    mask |= np.cumsum(edges, axis=0)[:-1] > 0
+
+    return mask
+
+
+def _mask_tile(tile_data, ccdmask_kwargs):
+    return ccdp.ccdmask(CCDData(tile_data, unit='adu'), **ccdmask_kwargs)
+
+
+def tiled_ccdmask(ratio, tile_size=1024, max_workers=None,
+                  findbadcolumns=False, byblocks=False, **ccdmask_kwargs):
+    """
+    Equivalent of ``ccdp.ccdmask`` that works on tiles in parallel.
+
+    Parameters
+    ----------
+
+    ratio : ``CCDData`` or numpy array
+        The image to mask, usually the ratio of two flats.
+
+    tile_size : int, optional
+        Size of the tiles, not counting the overlap. It is rounded up to a
+        multiple of the block size if ``byblocks=True``.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    findbadcolumns, byblocks
+        See ``ccdp.ccdmask``.
+
+    ccdmask_kwargs
+        Other arguments for ``ccdp.ccdmask``, like ``nlmed`` or ``hsigma``.
+
+    Returns
+    -------
+
+    numpy array of bool
+        The mask, ``True`` for bad pixels.
+    """
+    data = getattr(ratio, 'data', ratio)
+    params = dict(CCDMASK_DEFAULTS, **ccdmask_kwargs)
+
+    # Furthest a pixel can be from one that affects it: half the median
+    # filter plus the size of the region used for the sigma.
+    overlap = [params['nlmed'] // 2 + params['nlsig'],
+               params['ncmed'] // 2 + params['ncsig']]
+
+    if byblocks:
+        # The blocks sigma is calculated in are laid out from the corner of
+        # the image, so tiles must start on block boundaries.
+        block = (params['nlsig'], params['ncsig'])
+        tile_size = [math.ceil(tile_size / b) * b for b in block]
+        overlap = [math.ceil(o / b) * b for o, b in zip(overlap, block)]
+        # Bad columns within a block are found block by block, which is
+        # local, so let the tiles do that part.
+        tile_findbadcolumns = findbadcolumns
+    else:
+        tile_findbadcolumns = False
+
+    tile_kwargs = dict(params, byblocks=byblocks,
+                       findbadcolumns=tile_findbadcolumns)
+
+    tiles = overlapping_tiles(data.shape, tile_size, overlap)
+    mask = np.empty(data.shape, dtype=bool)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_mask_tile, data[tile.padded], tile_kwargs)
+                   for tile in tiles]
+        for tile, future in zip(tiles, futures):
+            mask[tile.core] = future.result()[tile.core_in_padded]
+
+    if findbadcolumns:
+        fill_short_column_gaps(mask, ngood=params['ngood'])
+
+    return mask
@@ -0,0 +1,73 @@
+"""
+Split an image into overlapping tiles and put the results back together.
+
+Operations like cosmic ray detection only look at the neighborhood of each
+pixel, so they can be run on tiles of an image in parallel. Each tile is
+padded by an overlap on every side; only the central, unpadded part of each
+tile is kept when the results are stitched together, so pixels near tile
+edges are handled with the same neighborhood as in the full image.
+"""
+from collections import namedtuple
+
+Tile = namedtuple('Tile', ['padded', 'core', 'core_in_padded'])
+Tile.__doc__ = """
+Slices describing one tile.
+
+padded : tuple of slice
+    Region of the full image, including the overlap, to process.
+core : tuple of slice
+    Region of the full image this tile is responsible for.
+core_in_padded : tuple of slice
+    Location of ``core`` within the padded tile.
+"""
+
+
+def _axis_tiles(length, tile_size, overlap):
+    for start in range(0, length, tile_size):
+        stop = min(start + tile_size, length)
+        pad_start = max(start - overlap, 0)
+        pad_stop = min(stop + overlap, length)
+        yield (slice(pad_start, pad_stop), slice(start, stop),
+               slice(start - pad_start, stop - pad_start))
+
+
+def overlapping_tiles(shape, tile_size, overlap):
+    """
+    Tiles covering a 2D image of the given shape.
+
+    Parameters
+    ----------
+
+    shape : tuple of int
+        Shape of the image.
+
+    tile_size : int or tuple of int
+        Size of the core of each tile, in pixels. Tiles at the top and right
+        edges may be smaller.
+
+    overlap : int or tuple of int
+        Number of pixels of padding on each side of a tile. This should be
+        at least as large as the distance over which the operation being done
+        on the tiles looks at neighboring pixels.
+
+    Returns
+    -------
+
+    list of `Tile`
+        The tiles; their cores cover the image exactly once.
+    """
+    try:
+        size_y, size_x = tile_size
+    except TypeError:
+        size_y = size_x = tile_size
+
+    try:
+        overlap_y, overlap_x = overlap
+    except TypeError:
+        overlap_y = overlap_x = overlap
+
+    tiles = []
+    for pad_y, core_y, in_y in _axis_tiles(shape[0], size_y, overlap_y):
+        for pad_x, core_x, in_x in _axis_tiles(shape[1], size_x, overlap_x):
+            tiles.append(Tile((pad_y, pad_x), (core_y, core_x), (in_y, in_x)))
+    return tiles
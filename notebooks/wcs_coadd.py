@@ -0,0 +1,314 @@
+"""
+Reproject calibrated images onto a common WCS and add them together.
+
+For each pair of input and output WCS a table of where every output pixel
+lands in the input image is calculated once and cached, in memory and on
+disk. Images taken at the same pointing have the same WCS, so only the first
+of them pays for the (slow) world coordinate transformations; the rest are
+just interpolated. Frames are resampled in parallel, a few at a time, and
+accumulated into memory-mapped sum and weight images, so neither the size
+of the co-add nor the number of frames is limited by memory.
+"""
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from hashlib import sha256
+import os
+from pathlib import Path
+import tempfile
+
+import numpy as np
+from scipy import ndimage
+
+from astropy import units as u
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.wcs import WCS
+
+# Number of mappings kept in memory in each process. Each one is two float32
+# images the size of the input, and frames that have been plate solved
+# separately rarely share a WCS, so only the most recent few are kept.
+MAPPING_CACHE_SIZE = 4
+
+# Mappings already calculated in this process, keyed by mapping_key, least
+# recently used first.
+_mapping_cache = OrderedDict()
+
+
+def mapping_key(input_wcs, input_shape, output_wcs, output_shape):
+    """
+    Key identifying the pixel mapping between two WCS.
+    """
+    digest = sha256()
+    for wcs, shape in [(input_wcs, input_shape), (output_wcs, output_shape)]:
+        digest.update(wcs.to_header_string(relax=True).encode())
+        digest.update(str(tuple(shape)).encode())
+    return digest.hexdigest()
+
+
+def output_wcs_for(wcs_list, shapes, reference=0):
+    """
+    WCS, based on one of the inputs, big enough to hold all of the images.
+
+    Parameters
+    ----------
+
+    wcs_list : list of ``astropy.wcs.WCS``
+        WCS of each image.
+
+    shapes : list of tuple
+        Shape of each image.
+
+    reference : int, optional
+        Index of the image whose WCS (projection, pixel scale and
+        orientation) is used for the output.
+
+    Returns
+    -------
+
+    wcs, shape
+        The output WCS and the shape of the output image.
+    """
+    ref = wcs_list[reference].deepcopy()
+    corners_x = []
+    corners_y = []
+    for wcs, (ny, nx) in zip(wcs_list, shapes):
+        x = np.array([-0.5, nx - 0.5, nx - 0.5, -0.5])
+        y = np.array([-0.5, -0.5, ny - 0.5, ny - 0.5])
+        world = wcs.pixel_to_world_values(x, y)
+        ref_x, ref_y = ref.world_to_pixel_values(*world)
+        corners_x.extend(ref_x)
+        corners_y.extend(ref_y)
+
+    x_min = np.floor(np.min(corners_x) + 0.5)
+    y_min = np.floor(np.min(corners_y) + 0.5)
+    x_max = np.ceil(np.max(corners_x) + 0.5)
+    y_max = np.ceil(np.max(corners_y) + 0.5)
+
+    # Shift the reference pixel so that the lower left corner is at zero.
+    ref.wcs.crpix = ref.wcs.crpix - [x_min, y_min]
+    shape = (int(y_max - y_min), int(x_max - x_min))
+    return ref, shape
+
+
+def _remember_mapping(key, mapping):
+    _mapping_cache[key] = mapping
+    _mapping_cache.move_to_end(key)
+    while len(_mapping_cache) > MAPPING_CACHE_SIZE:
+        _mapping_cache.popitem(last=False)
+
+
+def pixel_mapping(input_wcs, input_shape, output_wcs, output_shape,
+                  cache_dir=None):
+    """
+    Input pixel coordinates of each output pixel that overlaps the input.
+
+    Parameters
+    ----------
+
+    input_wcs, output_wcs : ``astropy.wcs.WCS``
+        The WCS of the input and output images.
+
+    input_shape, output_shape : tuple of int
+        Shapes of the input and output images.
+
+    cache_dir : str, optional
+        If given, mappings are saved in and loaded from this directory.
+
+    Returns
+    -------
+
+    bbox, x, y
+        ``bbox`` is a tuple of slices giving the region of the output that
+        the input covers; ``x`` and ``y`` are the input pixel coordinates of
+        each output pixel in that region.
+    """
+    key = mapping_key(input_wcs, input_shape, output_wcs, output_shape)
+    if key in _mapping_cache:
+        _mapping_cache.move_to_end(key)
+        return _mapping_cache[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir) / f'{key}.npz'
+        if cache_file.exists():
+            stored = np.load(cache_file)
+            y0, y1, x0, x1 = stored['bbox']
+            mapping = ((slice(y0, y1), slice(x0, x1)),
+                       stored['x'], stored['y'])
+            _remember_mapping(key, mapping)
+            return mapping
+
+    # Find the part of the output the input covers from its corners (plus a
+    # pixel of margin), so only those output pixels need transforming.
+    ny, nx = input_shape
+    x = np.array([-0.5, nx - 0.5, nx - 0.5, -0.5])
+    y = np.array([-0.5, -0.5, ny - 0.5, ny - 0.5])
+    out_x, out_y = output_wcs.world_to_pixel_values(
+        *input_wcs.pixel_to_world_values(x, y))
+    x0 = int(max(np.floor(out_x.min()) - 1, 0))
+    y0 = int(max(np.floor(out_y.min()) - 1, 0))
+    x1 = int(min(np.ceil(out_x.max()) + 2, output_shape[1]))
+    y1 = int(min(np.ceil(out_y.max()) + 2, output_shape[0]))
+
+    grid_y, grid_x = np.mgrid[y0:y1, x0:x1]
+    in_x, in_y = input_wcs.world_to_pixel_values(
+        *output_wcs.pixel_to_world_values(grid_x, grid_y))
+    in_x = in_x.astype('float32')
+    in_y = in_y.astype('float32')
+
+    mapping = ((slice(y0, y1), slice(x0, x1)), in_x, in_y)
+    _remember_mapping(key, mapping)
+    if cache_file is not None:
+        # Write to a temporary file and move it into place so that other
+        # processes never load a partly written mapping.
+        handle, temp_name = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, bbox=[y0, y1, x0, x1], x=in_x, y=in_y)
+            os.replace(temp_name, cache_file)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+    return mapping
+
+
+def reproject_image(ccd, output_wcs, output_shape, cache_dir=None, order=1):
+    """
+    Resample an image onto the output WCS.
+
+    Parameters
+    ----------
+
+    ccd : ``CCDData``
+        Image with a WCS. Masked pixels are not used.
+
+    output_wcs, output_shape
+        The output WCS and shape.
+
+    cache_dir : str, optional
+        Directory for cached pixel mappings; see `pixel_mapping`.
+
+    order : int, optional
+        Order of the spline interpolation; 1 is bilinear.
+
+    Returns
+    -------
+
+    bbox, values, weights
+        The region of the output covered, the resampled values in that
+        region and a weight that is 1 where there is good data and 0
+        elsewhere.
+    """
+    bbox, in_x, in_y = pixel_mapping(ccd.wcs, ccd.shape, output_wcs,
+                                     output_shape, cache_dir=cache_dir)
+
+    data = np.asarray(ccd.data, dtype=np.float64)
+    bad = ~np.isfinite(data)
+    if ccd.mask is not None:
+        bad |= ccd.mask
+
+    coords = np.array([in_y, in_x])
+    values = ndimage.map_coordinates(np.where(bad, 0, data), coords,
+                                     order=order, cval=np.nan)
+    # Any output pixel that draws on a bad input pixel gets no weight.
+    touched_bad = ndimage.map_coordinates(bad.astype('float32'), coords,
+                                          order=1, cval=1) > 0
+    weights = np.where(touched_bad | np.isnan(values), 0.0, 1.0)
+    values = np.where(weights > 0, values, 0)
+
+    return bbox, values, weights
+
+
+def _reproject_file(file_name, output_wcs, output_shape, cache_dir, order):
+    ccd = CCDData.read(file_name)
+    return reproject_image(ccd, output_wcs, output_shape,
+                           cache_dir=cache_dir, order=order)
+
+
+def coadd(files, output_wcs=None, output_shape=None, work_dir=None,
+          mapping_cache_dir=None, max_workers=None, order=1):
+    """
+    Reproject images onto a common WCS and average them.
+
+    Parameters
+    ----------
+
+    files : list of str
+        Calibrated images, each with a WCS in its header.
+
+    output_wcs, output_shape : optional
+        WCS and shape of the co-added image. By default the WCS of the first
+        image, extended to cover all of the images, is used.
+
+    work_dir : str, optional
+        Directory for the memory-mapped sum and weight images; they are
+        left there as ``coadd_sum.npy`` and ``coadd_weight.npy``. By default a
+        temporary directory is used and they are removed.
+
+    mapping_cache_dir : str, optional
+        Directory in which pixel mappings are cached between runs.
+
+    max_workers : int, optional
+        Maximum number of processes to use; the default is the number of
+        CPUs.
+
+    order : int, optional
+        Order of the interpolation.
+
+    Returns
+    -------
+
+    coadded, weight
+        The co-added ``CCDData`` and the weight map (the number of images
+        contributing to each pixel).
+    """
+    files = [str(f) for f in files]
+    headers = [fits.getheader(name) for name in files]
+    if output_wcs is None:
+        wcs_list = [WCS(header) for header in headers]
+        shapes = [(header['naxis2'], header['naxis1']) for header in headers]
+        output_wcs, output_shape = output_wcs_for(wcs_list, shapes)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(work_dir or tmp)
+        total = np.lib.format.open_memmap(directory / 'coadd_sum.npy',
+                                          mode='w+', dtype=np.float64,
+                                          shape=output_shape)
+        weight = np.lib.format.open_memmap(directory / 'coadd_weight.npy',
+                                           mode='w+', dtype=np.float32,
+                                           shape=output_shape)
+
+        # The workers only resample; the accumulation happens here, so there
+        # is never more than one process writing to the output. Only a few
+        # frames are submitted ahead of the ones being accumulated, and each
+        # is let go once it has been added in, so no more than that many
+        # resampled frames are held in memory at once.
+        window = 2 * (max_workers or os.cpu_count() or 1)
+        names = iter(files)
+        pending = set()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                for name in names:
+                    pending.add(executor.submit(_reproject_file, name,
+                                                output_wcs, output_shape,
+                                                mapping_cache_dir, order))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bbox, values, weights = future.result()
+                    total[bbox] += values * weights
+                    weight[bbox] += weights
+                del done, future, values, weights
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            average = np.where(weight > 0, total / weight, np.nan)
+        weight_map = np.array(weight)
+        del total, weight
+
+    coadded = CCDData(average, unit=u.Unit(headers[0].get('bunit', 'adu')),
+                      mask=weight_map == 0, wcs=output_wcs)
+    coadded.meta['ncombine'] = len(files)
+    return coadded, weight_map
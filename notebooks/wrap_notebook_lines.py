@@ -6,6 +6,21 @@ import nbformat as nbf
 
 from link_fix import markdown_cells
 
+# Markdown links, [some txt](A-url.ext) or ![Alt text](cool-image.png).
+MARKDOWN_LINK = \
+    re.compile(r"!?\[(?P<link_text>.+?\n*?.*?)\]\((?P<link_url>.+?)\)",
+               flags=re.MULTILINE)
+
+# Latex blocks, which begin and end with $$.
+LATEX_BLOCK = re.compile(r"\$\$.*?\$\$", flags=re.MULTILINE + re.DOTALL)
+
+# While a cell is wrapped each link or latex block is replaced by a
+# placeholder: a character from the Unicode private use area followed by the
+# index of what it replaces. It is as long as the UUIDs protect_from_wrap
+# uses, so lines are wrapped exactly as they were with those.
+PLACEHOLDER_LENGTH = 32
+PRIVATE_USE = range(0xE000, 0xF900)
+
 
 def find_links(text):
     """
@@ -29,10 +44,7 @@ def find_links(text):
         the square brackets, and 'link',which is the URL (or file name for an
         image).
     """
-    markdown_link = \
-        re.compile(r"!?\[(?P<link_text>.+?\n*?.*?)\]\((?P<link_url>.+?)\)",
-                   flags=re.MULTILINE)
-    groups = [m for m in markdown_link.finditer(text)]
+    groups = [m for m in MARKDOWN_LINK.finditer(text)]
     return groups
 
 
@@ -54,8 +66,7 @@ def find_latex(text):
     list
         List of ``re.Match`` objects, one for each latex block found.
     """
-    markdown_link = re.compile(r"\$\$.*?\$\$", flags=re.MULTILINE + re.DOTALL)
-    groups = [m for m in markdown_link.finditer(text)]
+    groups = [m for m in LATEX_BLOCK.finditer(text)]
     return groups
 
 
@@ -102,30 +113,124 @@ def restore_protected_content(text, restore_dict):
     return text
 
 
+def _wrap_lines(text, wrapper):
+    new_lines = []
+    for line in text.split('\n'):
+        if line:
+            new_lines.extend(wrapper.wrap(line))
+        else:
+            new_lines.append('')
+    return '\n'.join(new_lines)
+
+
+def _wrapper(wrap_at):
+    return TextWrapper(width=wrap_at, break_long_words=False,
+                       break_on_hyphens=False,
+                       replace_whitespace=False, drop_whitespace=True)
+
+
+def _unused_character(text):
+    return next(chr(c) for c in PRIVATE_USE if chr(c) not in text)
+
+
+def wrap_markdown(text, wrap_at=80):
+    """
+    Wrap the lines of markdown text, leaving links and latex intact.
+
+    This does the same as `protect_from_wrap`, wrapping and
+    `restore_protected_content`, but each of those steps is one pass over
+    the text, so the time taken grows linearly with the number of links and
+    equations in a cell rather than with its square.
+
+    Parameters
+    ----------
+
+    text : str
+        The markdown source of a cell.
+
+    wrap_at : int, optional
+        Length at which to wrap lines.
+    """
+    marker = _unused_character(text)
+    protected_spans = []
+
+    def protect(match):
+        protected_spans.append(match.group(0))
+        index = len(protected_spans) - 1
+        return f'{marker}{index:0{PLACEHOLDER_LENGTH - 1}d}'
+
+    # Links first, then latex in what is left, as before.
+    protected = MARKDOWN_LINK.sub(protect, text)
+    protected = LATEX_BLOCK.sub(protect, protected)
+
+    wrapped = _wrap_lines(protected, _wrapper(wrap_at))
+
+    placeholder = re.compile(re.escape(marker) +
+                             r'(\d{%d})' % (PLACEHOLDER_LENGTH - 1))
+
+    def restore(match):
+        # A latex block can contain a link placeholder.
+        return placeholder.sub(restore,
+                               protected_spans[int(match.group(1))])
+
+    return placeholder.sub(restore, wrapped)
+
+
 def wrap_notebook_markdown(nb_name, wrap_at=80):
     with open(nb_name) as f:
         nb = nbf.read(f, as_version=4)
 
-    wrapper = TextWrapper(width=wrap_at, break_long_words=False,
-                          break_on_hyphens=False,
-                          replace_whitespace=False, drop_whitespace=True)
-
     for cell in markdown_cells(nb):
-        link_groups = find_links(cell['source'])
-        protected, restore = protect_from_wrap(cell['source'], link_groups)
-        latex_groups = find_latex(protected)
-        protected, restore = protect_from_wrap(protected, latex_groups,
-                                               restore_info=restore)
-        lines = protected.split('\n')
-
-        new_lines = []
-        for line in lines:
-            if line:
-                new_lines.extend(wrapper.wrap(line))
-            else:
-                new_lines.append('')
-
-        new_source = '\n'.join(new_lines)
-        cell['source'] = restore_protected_content(new_source, restore)
+        cell['source'] = wrap_markdown(cell['source'], wrap_at=wrap_at)
 
     return nb
+
+
+def _wrap_markdown_with_uuids(text, wrap_at=80):
+    # How cells were wrapped before wrap_markdown; kept for the benchmark.
+    protected, restore = protect_from_wrap(text, find_links(text))
+    protected, restore = protect_from_wrap(protected, find_latex(protected),
+                                           restore_info=restore)
+    wrapped = _wrap_lines(protected, _wrapper(wrap_at))
+    return restore_protected_content(wrapped, restore)
+
+
+def benchmark(n_items=(100, 1000, 5000), wrap_at=80):
+    """
+    Time wrapping one very long cell with many links and equations, with
+    `wrap_markdown` and with the UUID-based approach it replaced.
+
+    Parameters
+    ----------
+
+    n_items : list of int, optional
+        Numbers of links (and as many equations) in the cell.
+
+    wrap_at : int, optional
+        Length at which to wrap lines.
+
+    Returns
+    -------
+
+    list of dict
+        The number of items, both times in seconds and whether the results
+        are the same, for each cell.
+    """
+    from time import perf_counter
+
+    results = []
+    for n in n_items:
+        text = ' '.join(f'See [section {i}](notebook-{i}.ipynb#part-{i}) '
+                        f'and $$E_{i} = m_{i} c^2$$ for some more words'
+                        for i in range(n))
+        start = perf_counter()
+        new = wrap_markdown(text, wrap_at=wrap_at)
+        new_time = perf_counter() - start
+        start = perf_counter()
+        old = _wrap_markdown_with_uuids(text, wrap_at=wrap_at)
+        old_time = perf_counter() - start
+        results.append(dict(n_items=n, wrap_markdown=new_time,
+                            uuids=old_time, same=new == old))
+        print(f'{n:6d} links and equations: {new_time:8.4f} s now, '
+              f'{old_time:8.4f} s with UUIDs')
+    return results
@@ -1,13 +1,9 @@
 from pathlib import Path
 
-import nbformat as nbf
-
-from wrap_notebook_lines import wrap_notebook_markdown
+from notebook_pipeline import process_notebooks
 
 notebooks = Path('.').glob('??-??-*.ipynb')
 
-for notebook in notebooks:
-    print(f'Wrapping {notebook}...')
-    new_source = wrap_notebook_markdown(notebook, wrap_at=80)
-    with open(notebook, 'w') as f:
-        nbf.write(new_source, f, version=4)
+if __name__ == '__main__':
+    print('Wrapping notebooks...')
+    process_notebooks(notebooks, [('wrap', dict(wrap_at=80))])